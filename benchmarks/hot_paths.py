@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Time the lookup paths of Dataset, and compare the results between releases.
+
+Usage:
+    hot_paths.py (-h | --help)
+    hot_paths.py [--tile-shape WxH] [--points N] [--repeat N] [--threads N]
+        [--seed SEED] [--cold] [--only NAMES] [--output FILE]
+        [--compare FILE] [--threshold PCT] <dataset>
+    hot_paths.py compare [--threshold PCT] <baseline> <results>
+
+Options:
+    -h, --help                  Show a brief usage summary.
+
+    --tile-shape WxH            Expected shape of chunks is W pixels wide and
+                                H pixels high. [default: 14401x10801]
+    --points N                  Points looked up by each run. [default: 100000]
+    --repeat N                  Runs of each benchmark with a warm cache; the
+                                fastest is reported. [default: 5]
+    --threads N                 Also run the batch lookups with N threads.
+                                [default: 1]
+    --seed SEED                 Seed for choosing points. [default: 0]
+    --cold                      Also run each benchmark once with the dataset
+                                dropped from the page cache beforehand.
+    --only NAMES                Only run the benchmarks named, separated by
+                                commas.
+
+    --output FILE               Write the results to FILE as JSON.
+    --compare FILE              Compare with the results in FILE, from an
+                                earlier release on the same machine. The exit
+                                status is 1 if anything got slower by more
+                                than the threshold.
+    --threshold PCT             Percentage slowdown counted as a regression.
+                                [default: 10]
+
+    <dataset>                   Ruaumoko dataset to benchmark, in any layout.
+    <baseline>, <results>       Results written by earlier runs, to compare.
+
+Each benchmark looks up points in three patterns: "random", spread uniformly
+over the globe; "clustered", around a few centres, as when many users ask
+about the same area; and "track", along the paths of flights one cell apart,
+as a predictor does. Opening the dataset is timed too.
+
+Warm runs follow an untimed run of the same lookups, so that the pages and
+tiles they need are already in memory. Cold runs use a freshly opened dataset
+after asking the kernel to drop its files from the page cache
+(POSIX_FADV_DONTNEED), which works without root but leaves pages that some
+other process has mapped. The fraction of the dataset still resident when the
+run starts is recorded, so check it.
+
+Times are only comparable between runs on the same machine. The machine, the
+versions of Ruaumoko and Python and the parameters are saved with the results,
+and --compare warns if they differ.
+"""
+
+from __future__ import print_function, division
+
+import gc
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from array import array
+
+import docopt
+
+import ruaumoko
+from ruaumoko import Dataset
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+PATTERNS = ('random', 'clustered', 'track')
+
+# Clustered points lie within this many degrees of one of a few centres
+N_CLUSTERS = 20
+CLUSTER_SIZE = 0.5
+
+# Each track is this many points long, with waypoints for profiles this often
+TRACK_LENGTH = 10000
+WAYPOINT_EVERY = 100
+
+def random_points(rng, n):
+    """Points spread uniformly over the sphere."""
+    lats = array('d', (math.degrees(math.asin(rng.uniform(-1, 1)))
+                       for _ in range(n)))
+    lngs = array('d', (rng.uniform(0, 360) for _ in range(n)))
+    return lats, lngs
+
+def clustered_points(rng, n):
+    """Points around a few centres."""
+    centres = list(zip(*random_points(rng, N_CLUSTERS)))
+    lats, lngs = array('d'), array('d')
+    for _ in range(n):
+        lat, lng = rng.choice(centres)
+        lats.append(max(-90, min(90, lat + rng.uniform(-1, 1) * CLUSTER_SIZE)))
+        lngs.append((lng + rng.uniform(-1, 1) * CLUSTER_SIZE) % 360)
+    return lats, lngs
+
+def track_points(rng, n, expected_res):
+    """Points one cell apart along wandering paths."""
+    step = 45.0 / (expected_res[1] - 1)
+    lats, lngs = array('d'), array('d')
+    while len(lats) < n:
+        (lat,), (lng,) = random_points(rng, 1)
+        heading = rng.uniform(0, 2 * math.pi)
+        for _ in range(min(TRACK_LENGTH, n - len(lats))):
+            heading += rng.gauss(0, 0.01)
+            lat += step * math.cos(heading)
+            if not -90 <= lat <= 90:
+                lat = math.copysign(180, lat) - lat
+                heading = math.pi - heading
+            lng = (lng + step * math.sin(heading) /
+                   max(math.cos(math.radians(lat)), 0.01)) % 360
+            lats.append(lat)
+            lngs.append(lng)
+    return lats, lngs
+
+def make_points(pattern, n, seed, expected_res):
+    rng = random.Random('{0}-{1}'.format(seed, pattern))
+    if pattern == 'random':
+        return random_points(rng, n)
+    elif pattern == 'clustered':
+        return clustered_points(rng, n)
+    return track_points(rng, n, expected_res)
+
+def bench_get(ds, lats, lngs, threads):
+    get = ds.get
+    for k in range(len(lats)):
+        get(lats[k], lngs[k])
+    return len(lats)
+
+def bench_get_many(ds, lats, lngs, threads):
+    ds.get_many(lats, lngs, threads=threads)
+    return len(lats)
+
+def bench_interpolate(ds, lats, lngs, threads):
+    interpolate = ds.interpolate
+    for k in range(len(lats)):
+        interpolate(lats[k], lngs[k])
+    return len(lats)
+
+def bench_bilinear_many(ds, lats, lngs, threads):
+    ds.interpolate_many(lats, lngs, "bilinear", threads=threads)
+    return len(lats)
+
+def bench_bicubic_many(ds, lats, lngs, threads):
+    ds.interpolate_many(lats, lngs, "bicubic", threads=threads)
+    return len(lats)
+
+def bench_profile(ds, lats, lngs, threads):
+    distances, _ = ds.profile(lats[::WAYPOINT_EVERY], lngs[::WAYPOINT_EVERY],
+                              method="bilinear")
+    return len(distances)
+
+def bench_intersect(ds, lats, lngs, threads):
+    # Descend from 40 km to below sea level along each track, so that the
+    # whole track is searched unless it hits high ground
+    n = 0
+    for start in range(0, len(lats), TRACK_LENGTH):
+        track_lats = lats[start:start + TRACK_LENGTH]
+        track_lngs = lngs[start:start + TRACK_LENGTH]
+        alts = array('d', (40000 - 41000.0 * k / len(track_lats)
+                           for k in range(len(track_lats))))
+        ds.intersect(track_lats, track_lngs, alts)
+        n += len(track_lats)
+    return n
+
+# Name, function, patterns, whether it is a batch lookup that takes threads
+BENCHMARKS = [
+    ('get', bench_get, PATTERNS, False),
+    ('get_many', bench_get_many, PATTERNS, True),
+    ('interpolate', bench_interpolate, PATTERNS, False),
+    ('interpolate_many_bilinear', bench_bilinear_many, PATTERNS, True),
+    ('interpolate_many_bicubic', bench_bicubic_many, PATTERNS, True),
+    ('profile', bench_profile, ('track',), False),
+    ('intersect', bench_intersect, ('track',), False),
+]
+
+def dataset_files(filename):
+    """The files of a dataset and of its overviews and index."""
+    filename = filename.rstrip(os.sep)
+    if os.path.isdir(filename):
+        files = [os.path.join(filename, name)
+                 for name in os.listdir(filename)]
+    else:
+        files = [filename]
+    directory, base = os.path.split(os.path.abspath(filename))
+    files += [os.path.join(directory, name) for name in os.listdir(directory)
+              if name.startswith(base + '.')]
+    return [path for path in files if os.path.isfile(path)]
+
+def drop_cache(filename):
+    """Ask the kernel to drop a dataset from the page cache. Returns False
+    if that isn't possible here."""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for path in dataset_files(filename):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # Dirty pages are not dropped, so write them out first
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+def faults():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_minflt, usage.ru_majflt
+
+def resident_fraction(ds):
+    resident, total = ds.resident()
+    return resident / total if total else 0.0
+
+def timed(func, *args):
+    """Time a call, returning the seconds taken, the result and the minor
+    and major faults incurred."""
+    before = faults()
+    start = clock()
+    result = func(*args)
+    elapsed = clock() - start
+    after = faults()
+    return elapsed, result, after[0] - before[0], after[1] - before[1]
+
+def record(name, pattern, cache, threads, times, points, minor, major,
+        resident=None):
+    best = min(times)
+    return {
+        'name': name, 'pattern': pattern, 'cache': cache, 'threads': threads,
+        'points': points, 'runs': len(times), 'times': times,
+        'best': best, 'median': sorted(times)[len(times) // 2],
+        'ns_per_point': 1e9 * best / points if points else None,
+        'points_per_second': points / best if best else None,
+        'minor_faults': minor, 'major_faults': major,
+        'resident_fraction': resident,
+    }
+
+def run(filename, expected_res, n_points, repeat, threads, seed, cold,
+        only=None):
+    """Run the benchmarks, returning the results as a dictionary that may be
+    serialised as JSON."""
+    results = []
+    can_drop = cold and drop_cache(filename)
+    if cold and not can_drop:
+        print('Cannot drop pages from the cache here, skipping cold runs',
+              file=sys.stderr)
+
+    def wanted(name):
+        return only is None or name in only
+
+    if wanted('open'):
+        open_ds = lambda: Dataset(filename, expected_res=expected_res)
+        times = [timed(open_ds)[0] for _ in range(repeat)]
+        results.append(record('open', None, 'warm', 1, times, 1, None, None))
+        if can_drop:
+            gc.collect()
+            drop_cache(filename)
+            elapsed, _, minor, major = timed(open_ds)
+            results.append(record('open', None, 'cold', 1, [elapsed], 1,
+                                  minor, major))
+
+    thread_counts = [1] if threads == 1 else [1, threads]
+    for pattern in PATTERNS:
+        lats, lngs = make_points(pattern, n_points, seed, expected_res)
+        for name, func, patterns, batch in BENCHMARKS:
+            if pattern not in patterns or not wanted(name):
+                continue
+            for t in (thread_counts if batch else [1]):
+                if can_drop:
+                    gc.collect()
+                    drop_cache(filename)
+                    ds = Dataset(filename, expected_res=expected_res)
+                    resident = resident_fraction(ds)
+                    elapsed, points, minor, major = timed(func, ds, lats,
+                                                          lngs, t)
+                    results.append(record(name, pattern, 'cold', t,
+                                          [elapsed], points, minor, major,
+                                          resident))
+                    del ds
+
+                ds = Dataset(filename, expected_res=expected_res)
+                func(ds, lats, lngs, t)
+                times = []
+                minor = major = 0
+                for _ in range(repeat):
+                    elapsed, points, mi, ma = timed(func, ds, lats, lngs, t)
+                    times.append(elapsed)
+                    minor += mi
+                    major += ma
+                results.append(record(name, pattern, 'warm', t, times,
+                                      points, minor // repeat,
+                                      major // repeat, resident_fraction(ds)))
+                print('{0:<26} {1:<10} {2:<5} {3:>2} {4:>12.1f} ns/point'
+                      .format(name, pattern, 'warm', t,
+                              results[-1]['ns_per_point']), file=sys.stderr)
+                del ds
+
+    ds = Dataset(filename, expected_res=expected_res)
+    return {
+        'ruaumoko': ruaumoko.__version__,
+        'python': platform.python_version(),
+        'machine': {
+            'node': platform.node(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        },
+        'dataset': {
+            'path': os.path.abspath(filename),
+            'layout': ds.layout,
+            'build_id': ds.build_id,
+            'resolution': list(expected_res),
+        },
+        'parameters': {
+            'points': n_points, 'repeat': repeat, 'threads': threads,
+            'seed': seed, 'cold': cold,
+        },
+        'time': time.time(),
+        'results': results,
+    }
+
+def key(result):
+    return (result['name'], result['pattern'], result['cache'],
+            result['threads'])
+
+def compare(baseline, current, threshold):
+    """Print how each result compares with the baseline, and return the
+    keys of those that got slower by more than `threshold` percent."""
+    for section in ('machine', 'dataset', 'parameters'):
+        if baseline.get(section) != current.get(section):
+            print('Warning: {0} differs from the baseline'.format(section),
+                  file=sys.stderr)
+
+    before = dict((key(r), r) for r in baseline['results'])
+    regressions = []
+    print('{0:<26} {1:<10} {2:<5} {3:>7} {4:>12} {5:>12} {6:>8}'.format(
+        'benchmark', 'pattern', 'cache', 'threads',
+        'baseline', 'current', 'change'))
+    for result in current['results']:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        change = 100 * (result['best'] / old['best'] - 1)
+        slower = change > threshold
+        if slower:
+            regressions.append(key(result))
+        print('{0:<26} {1:<10} {2:<5} {3:>7} {4:>11.4f}s {5:>11.4f}s '
+              '{6:>+7.1f}%{7}'.format(result['name'], result['pattern'] or '',
+              result['cache'], result['threads'], old['best'],
+              result['best'], change, ' SLOWER' if slower else ''))
+    return regressions
+
+def main():
+    opts = docopt.docopt(__doc__)
+    threshold = float(opts['--threshold'])
+    baseline = opts['<baseline>'] or opts['--compare']
+
+    if opts['compare']:
+        with open(opts['<results>']) as f:
+            current = json.load(f)
+    else:
+        expected_res = tuple(int(x) for x in opts['--tile-shape'].split('x'))
+        only = opts['--only'].split(',') if opts['--only'] else None
+        current = run(opts['<dataset>'], expected_res, int(opts['--points']),
+                      int(opts['--repeat']), int(opts['--threads']),
+                      int(opts['--seed']), opts['--cold'], only)
+        if opts['--output']:
+            with open(opts['--output'], 'w') as f:
+                json.dump(current, f, indent=2, sort_keys=True)
+        elif not opts['--compare']:
+            print(json.dumps(current, indent=2, sort_keys=True))
+
+    if baseline:
+        with open(baseline) as f:
+            if compare(json.load(f), current, threshold):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Count page faults per region query for one or more datasets.
+
+Usage:
+    region_faults.py (-h | --help)
+    region_faults.py [--tile-shape WxH] [--size DEGREES] [--queries N]
+        [--seed SEED] <dataset>...
+
+Options:
+    -h, --help                  Show a brief usage summary.
+
+    --tile-shape WxH            Expected shape of chunks is W pixels wide and
+                                H pixels high. [default: 14401x10801]
+    --size DEGREES              Side of each square region. [default: 0.5]
+    --queries N                 Number of regions to query. [default: 200]
+    --seed SEED                 Seed for choosing regions. [default: 0]
+
+Each query looks up every cell in a randomly placed region through a freshly
+opened Dataset, so that every page it touches has to be faulted in to the new
+mapping. Pass datasets in different layouts (for example, the original file
+and the output of ruaumoko-convert) to compare them. Minor faults are counted
+even when the data is in the page cache; major faults need it to be cold.
+
+The kernel maps several pages per fault (fault-around, large folios), so the
+counts are only comparable between runs on the same machine, and only regions
+at the full dataset resolution show the real difference between layouts.
+"""
+
+from __future__ import print_function
+
+import random
+import resource
+from array import array
+
+import docopt
+
+from ruaumoko import Dataset
+
+def region(lat, lng, size, lat_step, lng_step):
+    """Latitudes and longitudes of the cells in a region."""
+    lats = array('d')
+    lngs = array('d')
+    y = 0.0
+    while y <= size:
+        x = 0.0
+        while x <= size:
+            lats.append(lat - y)
+            lngs.append((lng + x) % 360)
+            x += lng_step
+        y += lat_step
+    return lats, lngs
+
+def faults():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_minflt, usage.ru_majflt
+
+def measure(filename, expected_res, regions):
+    minor = major = 0
+    for lats, lngs in regions:
+        ds = Dataset(filename, expected_res=expected_res)
+        before = faults()
+        ds.get_many(lats, lngs)
+        after = faults()
+        minor += after[0] - before[0]
+        major += after[1] - before[1]
+        del ds
+    return minor / float(len(regions)), major / float(len(regions))
+
+def main():
+    opts = docopt.docopt(__doc__)
+    expected_res = tuple(int(x) for x in opts['--tile-shape'].split('x'))
+    size = float(opts['--size'])
+    n_queries = int(opts['--queries'])
+
+    # One cell in each direction
+    lat_step = 45.0 / (expected_res[1] - 1)
+    lng_step = 60.0 / (expected_res[0] - 1)
+
+    rng = random.Random(int(opts['--seed']))
+    regions = []
+    for _ in range(n_queries):
+        lat = rng.uniform(-90 + size, 90)
+        lng = rng.uniform(0, 360)
+        regions.append(region(lat, lng, size, lat_step, lng_step))
+
+    print('{0:<40} {1:>14} {2:>14}'.format('dataset', 'minor/query', 'major/query'))
+    for filename in opts['<dataset>']:
+        minor, major = measure(filename, expected_res, regions)
+        print('{0:<40} {1:>14.1f} {2:>14.1f}'.format(filename, minor, major))
+
+if __name__ == '__main__':
+    main()
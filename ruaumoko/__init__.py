@@ -22,4 +22,5 @@ __version__ = "0.2.0"
 __version_info__ = tuple([int(d) for d in __version__.split(".")])
 __licence__ = "GPL v3"
 
-from .dataset import Dataset
+from .dataset import (Dataset, MissingChunkError, BadChunkError,
+        OutOfRangeError, StaleBuildWarning)
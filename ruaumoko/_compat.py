@@ -84,3 +84,18 @@ except ImportError:
                 _shutil.rmtree(self.name)
                 self._closed = True
 
+
+try:
+    from os import pwrite # py 3.3+
+except ImportError:
+    import os as _os
+    import threading as _threading
+
+    _pwrite_lock = _threading.Lock()
+
+    def pwrite(fd, data, offset):
+        """Write data to fd at offset. Not atomic with respect to other
+        writers to fd which don't use this function."""
+        with _pwrite_lock:
+            _os.lseek(fd, offset, _os.SEEK_SET)
+            return _os.write(fd, data)
@@ -0,0 +1,335 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Asynchronous elevation server, which batches concurrent lookups.
+
+Usage:
+    {me} (-h | --help)
+    {me} [--host HOST] [--port PORT] [--window MS] [--batch-size N]
+
+Options:
+    -h, --help                  Show a brief usage summary.
+
+    --host HOST                 Address to listen on. [default: 127.0.0.1]
+    --port PORT                 Port to listen on. [default: 8000]
+
+    --window MS                 Longest time in milliseconds that a lookup
+                                waits for others to batch with it. The
+                                default is ELEVATION_BATCH_WINDOW, or {def_window}.
+    --batch-size N              Largest number of lookups in a batch. A
+                                full batch is looked up at once. The default
+                                is ELEVATION_BATCH_SIZE, or {def_batch_size}.
+
+Single-point requests (/<latitude>,<longitude>) that arrive close together
+are answered by a single call to Dataset.get_many, off the event loop, so
+that one process can serve many concurrent clients. /batch accepts a JSON
+array of [latitude, longitude] pairs or packed binary points, as for the
+Flask API. Other settings, such as the dataset location, are read from the
+file named by RUAUMOKO_SETTINGS.
+
+The server needs uvicorn. The application, ruaumoko.aio:app, may also be run
+with any other ASGI server. ELEVATION_BATCH_WINDOW is in seconds.
+"""
+
+from __future__ import print_function
+
+import asyncio
+import json
+import logging
+import os
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+import docopt
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+from . import api, MissingChunkError, OutOfRangeError
+
+DEFAULT_WINDOW = 0.001
+DEFAULT_BATCH_SIZE = 256
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_window = DEFAULT_WINDOW * 1000,
+    def_batch_size = DEFAULT_BATCH_SIZE,
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+class MicroBatcher(object):
+    """Coalesce lookups of single points into batches.
+
+    A batch is looked up once `max_size` points are waiting, or `window`
+    seconds after its first point arrived, whichever is sooner. Batches are
+    looked up one at a time on a separate thread, so points arriving while
+    one is in progress join the next.
+    """
+
+    def __init__(self, dataset, window=DEFAULT_WINDOW,
+                 max_size=DEFAULT_BATCH_SIZE, threads=1):
+        self.dataset = dataset
+        self.window = window
+        self.max_size = max_size
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = []
+        self.timer = None
+
+        # Totals, for monitoring
+        self.batches = 0
+        self.points = 0
+
+    def lookup(self, lat, lng):
+        """Future elevation of a point, which must be in range."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((lat, lng, future))
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return future
+
+    def flush(self):
+        """Start looking up the waiting points."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        self.batches += 1
+        self.points += len(batch)
+        lats = array('d', (point[0] for point in batch))
+        lngs = array('d', (point[1] for point in batch))
+        lookup = asyncio.get_event_loop().run_in_executor(self.executor,
+                self.dataset.get_many, lats, lngs, None, self.threads)
+        lookup.add_done_callback(lambda done: self.resolve(batch, done))
+
+    def resolve(self, batch, done):
+        error = done.exception()
+        if isinstance(error, MissingChunkError):
+            # Only points in the missing chunk should fail. They are looked up
+            # one at a time on the lookup thread, as lookups may block.
+            loop = asyncio.get_event_loop()
+            loop.run_in_executor(self.executor, self.retry, loop, batch)
+            return
+
+        for k, (lat, lng, future) in enumerate(batch):
+            if error is not None:
+                settle(future, None, error)
+            else:
+                settle(future, done.result()[k], None)
+
+    def retry(self, loop, batch):
+        """Look up each point of a batch on its own, settling their futures
+        on the event loop."""
+        for lat, lng, future in batch:
+            if future.done():
+                continue
+            try:
+                result, error = self.dataset.get(lat, lng), None
+            except Exception as e:
+                result, error = None, e
+            loop.call_soon_threadsafe(settle, future, result, error)
+
+
+def settle(future, result, error):
+    """Set the result or exception of a future, unless it was cancelled
+    (e.g. by the client going away)."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class ElevationApp(object):
+    """ASGI application serving elevations from the dataset configured for
+    the Flask API."""
+
+    def __init__(self, config=None):
+        self.config = api.app.config if config is None else config
+        self.batcher = None
+
+    def start(self):
+        if self.batcher is not None:
+            return
+        api.open_dataset()
+        self.batcher = MicroBatcher(api.elevation,
+            window=self.config.get('ELEVATION_BATCH_WINDOW', DEFAULT_WINDOW),
+            max_size=self.config.get('ELEVATION_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+            threads=self.config.get('ELEVATION_LOOKUP_THREADS', 1))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            # Servers without lifespan support open the dataset lazily
+            self.start()
+            status, headers, body = await self.handle(scope, receive)
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': headers + [
+                            (b'content-length', str(len(body)).encode())]})
+            await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    self.start()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, receive):
+        """Response to a request, as (status, headers, body)."""
+        path = scope['path']
+        if path == '/batch' and scope['method'] == 'POST':
+            return await self.batch(scope, await read_body(receive))
+
+        try:
+            lat, lng = (float(x) for x in path.lstrip('/').split(','))
+        except ValueError:
+            return json_response(404, {"error": "Not found"})
+        if not (-90 <= lat <= 90 and 0 <= lng < 360):
+            return json_response(400, {"error": "Position out of range"})
+
+        # Cacheable until the dataset is rebuilt, as for the Flask API
+        etag = '"{0}"'.format(self.config.get('ELEVATION_BUILD_ID') or
+                              api.elevation.build_id).encode()
+        cache = [(b'etag', etag), (b'cache-control', 'public, max-age={0}'.format(
+            self.config.get('ELEVATION_CACHE_MAX_AGE',
+                            api.DEFAULT_CACHE_MAX_AGE)).encode())]
+        if etag in dict(scope['headers']).get(b'if-none-match', b''):
+            return 304, cache, b''
+
+        try:
+            result = await self.batcher.lookup(lat, lng)
+        except MissingChunkError as e:
+            return json_response(503, {"error": str(e), "chunk": e.chunk})
+        status, headers, body = json_response(200, {"elevation": result})
+        return status, headers + cache, body
+
+    async def batch(self, scope, body):
+        headers = dict(scope['headers'])
+        binary = headers.get(b'content-type', b'').split(b';')[0] == \
+                api.BINARY_MIMETYPE.encode()
+        try:
+            if binary:
+                lats, lngs = api.unpack_points(body)
+            else:
+                points = json.loads(body.decode('utf-8'))
+                if not all(isinstance(p, list) and len(p) == 2 for p in points):
+                    raise ValueError("Points must be [latitude, longitude] pairs")
+                lats = array('d', (p[0] for p in points))
+                lngs = array('d', (p[1] for p in points))
+        except (TypeError, ValueError) as e:
+            return json_response(400, {"error": str(e)})
+
+        max_size = self.config.get('ELEVATION_MAX_BATCH_SIZE',
+                                   api.DEFAULT_MAX_BATCH_SIZE)
+        if len(lats) > max_size:
+            return json_response(413,
+                    {"error": "Too many points (maximum {0})".format(max_size)})
+
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(None,
+                    api.elevation.get_many, lats, lngs, None,
+                    self.config.get('ELEVATION_LOOKUP_THREADS', 1))
+        except OutOfRangeError as e:
+            return json_response(400, {"error": str(e), "indices": e.indices})
+        except MissingChunkError as e:
+            return json_response(503, {"error": str(e), "chunk": e.chunk})
+
+        if binary:
+            return (200, [(b'content-type', api.BINARY_MIMETYPE.encode())],
+                    api.pack_elevations(result))
+        return json_response(200, {"elevations": result.tolist()})
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def json_response(status, body):
+    return (status, [(b'content-type', b'application/json')],
+            json.dumps(body).encode('utf-8'))
+
+
+app = ElevationApp()
+
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(format='%(name)s:%(levelname)s: %(message)s')
+
+    if uvicorn is None:
+        LOG.error('The asynchronous server needs uvicorn')
+        return 1
+
+    if 'RUAUMOKO_SETTINGS' in os.environ:
+        api.app.config.from_envvar('RUAUMOKO_SETTINGS')
+
+    try:
+        port = int(opts['--port'])
+        if opts['--window'] is not None:
+            window = float(opts['--window']) / 1000
+            if window < 0:
+                raise ValueError()
+            api.app.config['ELEVATION_BATCH_WINDOW'] = window
+        if opts['--batch-size'] is not None:
+            batch_size = int(opts['--batch-size'])
+            if batch_size < 1:
+                raise ValueError()
+            api.app.config['ELEVATION_BATCH_SIZE'] = batch_size
+    except ValueError:
+        LOG.error('Invalid window, batch size or port')
+        return 1
+
+    uvicorn.run(app, host=opts['--host'], port=port)
+    return 0 # success
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
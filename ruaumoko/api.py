@@ -18,30 +18,546 @@
 
 from __future__ import print_function
 
+import atexit
+import functools
+import hashlib
+import os
 import sys
-from flask import Flask, abort, jsonify
+import tempfile
+from array import array
+from datetime import datetime
+from flask import (Flask, Response, abort, g, jsonify, make_response,
+                   redirect, request)
 
-from . import Dataset
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from . import Dataset, MissingChunkError, OutOfRangeError, polyline
+from .dataset import interpolation_methods
+from .metrics import CONTENT_TYPE, OTHER_ROUTE, Metrics, clock
+from .residency import DEFAULT_TILE_SIZE, write_heatmap
+from .sharedcache import SharedCache
 
 app = Flask(__name__)
 
+DEFAULT_MAX_BATCH_SIZE = 10000
+DEFAULT_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Where the metrics file goes without ELEVATION_METRICS
+DEFAULT_METRICS_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') \
+                            else tempfile.gettempdir()
+
+BINARY_MIMETYPE = 'application/octet-stream'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+elevation = None
+result_cache = None
+metrics = None
+
+
+def regions(setting):
+    """Regions named by a warm-up or locking setting: True for the whole
+    dataset, or a list of chunks and boxes (see Dataset.advise)."""
+    if setting is True:
+        return [None]
+    return setting or []
+
 
 @app.before_first_request
 def open_dataset():
-    global elevation
+    global elevation, result_cache
+
+    if elevation is not None:
+        # Already opened by preload
+        return
+
+    dir = app.config.get('ELEVATION_DIRECTORY', Dataset.default_location)
+    res = app.config.get('ELEVATION_TILE_RESOLUTION', Dataset.default_res)
+    cache = app.config.get('ELEVATION_TILE_CACHE_SIZE',
+                           Dataset.default_cache_tiles)
+    missing = app.config.get('ELEVATION_MISSING_FILL')
+    dataset = Dataset(dir, expected_res=res, cache_tiles=cache,
+                      missing=missing)
+
+    advice = app.config.get('ELEVATION_ACCESS_ADVICE')
+    if advice is not None:
+        dataset.advise(advice)
+    for region in regions(app.config.get('ELEVATION_WARM')):
+        dataset.warm(region)
+    for region in regions(app.config.get('ELEVATION_MLOCK')):
+        dataset.lock(region)
+
+    sampling = app.config.get('ELEVATION_ACCESS_SAMPLING')
+    if sampling:
+        dataset.count_accesses(sampling, DEFAULT_TILE_SIZE)
+
+    path = app.config.get('ELEVATION_RESULT_CACHE')
+    if path is not None:
+        result_cache = SharedCache(path,
+            size=app.config.get('ELEVATION_RESULT_CACHE_SIZE', SharedCache.default_size),
+            slot_size=app.config.get('ELEVATION_RESULT_CACHE_SLOT',
+                                     SharedCache.default_slot_size))
+
+    elevation = dataset
 
+
+@app.before_first_request
+def open_metrics():
+    """Open the metrics file named by ELEVATION_METRICS, or without one the
+    default file of the application and dataset."""
+    global metrics
+
+    if metrics is not None:
+        return
+
+    routes = [rule.rule for rule in app.url_map.iter_rules()
+              if rule.endpoint != 'static']
+    path = app.config.get('ELEVATION_METRICS') or default_metrics_path()
+    metrics = Metrics(routes, path,
+                      slots=app.config.get('ELEVATION_METRICS_SLOTS',
+                                           Metrics.default_slots))
+
+
+def default_metrics_path():
+    """A metrics file named for the application, its dataset and the user, so
+    that workers started separately for the same dataset share it."""
     dir = app.config.get('ELEVATION_DIRECTORY', Dataset.default_location)
+    key = '\0'.join([app.import_name, os.path.abspath(dir),
+                      str(os.getuid())])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(DEFAULT_METRICS_DIRECTORY,
+                        'ruaumoko-metrics-{0}'.format(digest))
+
+
+def current_route():
+    """The route of the current request, as a label for its metrics."""
+    if request.url_rule is None:
+        return OTHER_ROUTE
+    return request.url_rule.rule
+
+
+@app.before_request
+def start_timer():
+    g.request_started = clock()
+    g.request_counted = False
+
+
+@app.after_request
+def count_request(response):
+    if metrics is not None and not g.get('request_counted', True):
+        metrics.request(current_route(), response.status_code,
+                        clock() - g.request_started)
+        g.request_counted = True
+    return response
+
+
+@app.teardown_request
+def count_failed_request(exc):
+    # Unhandled exceptions skip after_request, and become 500 responses
+    if metrics is not None and not g.get('request_counted', True):
+        metrics.request(current_route(), 500, clock() - g.request_started)
+
+
+def lookup():
+    """Context in which to call the dataset, timing the call and counting
+    the page faults it takes."""
+    return metrics.lookup(current_route())
+
+
+def out_of_range(e):
+    """Respond to positions outside the dataset."""
+    metrics.out_of_range(current_route())
+    return error_response(400, str(e), indices=e.indices)
+
+
+def save_heatmap():
+    """Write this process's sampled access counts, if any, to the file named
+    by ELEVATION_ACCESS_HEATMAP with the process ID appended."""
+    path = app.config.get('ELEVATION_ACCESS_HEATMAP')
+    if elevation is None or path is None or elevation.access_counts is None:
+        return None
+
+    path = '{0}.{1}'.format(path, os.getpid())
     res = app.config.get('ELEVATION_TILE_RESOLUTION', Dataset.default_res)
-    elevation = Dataset(dir, expected_res=res)
+    write_heatmap(path, res, elevation.access_counts)
+    return path
+
+atexit.register(save_heatmap)
+
+
+def build_id():
+    """Identifier of the dataset build, used as the ETag of responses."""
+    return app.config.get('ELEVATION_BUILD_ID') or elevation.build_id
+
+
+def cache_headers(response):
+    """Mark a response as cacheable until the dataset is rebuilt."""
+    response.set_etag(build_id())
+    response.last_modified = datetime.utcfromtimestamp(int(elevation.modified))
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('ELEVATION_CACHE_MAX_AGE',
+                                                    DEFAULT_CACHE_MAX_AGE)
+    return response
+
+
+def not_modified():
+    """Whether a conditional request's copy is from the current build."""
+    if request.if_none_match:
+        return request.if_none_match.contains(build_id())
+    if request.if_modified_since is not None:
+        modified = datetime.utcfromtimestamp(int(elevation.modified))
+        return modified <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def inputs_in_url():
+    """Whether the request is a GET whose inputs are all in its URL, so that
+    caches keyed by URL may share its response."""
+    return (request.method == 'GET' and not request.get_data() and
+            request.mimetype not in (BINARY_MIMETYPE,) + MSGPACK_MIMETYPES)
+
+
+def check_not_modified():
+    """Answer a conditional request for the current build with 304.
+
+    Views call this once the request is known to be valid, before looking
+    anything up.
+    """
+    if inputs_in_url() and not_modified():
+        abort(cache_headers(Response(status=304)))
+
+
+def cacheable(view):
+    """Add caching headers to successful GET responses whose inputs are all
+    in the URL. Other GET responses, such as those to points in the body,
+    mustn't be stored by shared caches.
+
+    """
+    @functools.wraps(view)
+    def cached_view(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if inputs_in_url():
+            if response.status_code in (200, 301):
+                cache_headers(response)
+        elif request.method == 'GET':
+            response.cache_control.private = True
+            response.cache_control.no_store = True
+        return response
+    return cached_view
+
+
+def cache_key(*parts):
+    """Normalised key of a query for the result cache.
+
+    Arrays are keyed by their values, so that the same points given in any
+    format share an entry. The dataset build is part of every key.
+    """
+    key = [build_id().encode('utf-8')]
+    for part in parts:
+        if isinstance(part, (array, memoryview)):
+            values = array('d', part)
+            if sys.byteorder != 'little':
+                values.byteswap()
+            key.append(values.tobytes())
+        else:
+            key.append(repr(part).encode('utf-8'))
+    return b'\0'.join(key)
+
+
+def cached_result(key, compute):
+    """Response to a query from the result cache, or from calling `compute`
+    and caching its response if successful.
+
+    """
+    if result_cache is not None:
+        body = result_cache.get(key)
+        if body is not None:
+            return Response(body, mimetype='application/json')
+
+    response = compute()
+    if result_cache is not None and response.status_code == 200:
+        result_cache.put(key, response.get_data())
+    return response
+
+
+def canonical(value):
+    """Format a coordinate as in canonical URLs."""
+    return '{0:.6f}'.format(round(value, 6) + 0.0).rstrip('0').rstrip('.')
 
 
 @app.route('/<latitude>,<longitude>')
+@cacheable
 def get_elevation(latitude, longitude):
     try:
-        latitude = float(latitude)
-        longitude = float(longitude)
-        result = elevation.get(latitude, longitude)
+        lat = float(latitude)
+        lng = float(longitude)
     except ValueError:
         abort(400)
 
+    try:
+        elevation.check([lat], [lng])
+    except ValueError:
+        metrics.out_of_range(current_route())
+        abort(400)
+    check_not_modified()
+
+    with lookup():
+        result = elevation.get(lat, lng)
+
+    if app.config.get('ELEVATION_SNAP_REDIRECT'):
+        # Send every position in a cell to the same URL, so that caches
+        # share the response
+        lat, lng = elevation.snap(lat, lng)
+        lat, lng = canonical(lat), canonical(round(lng, 6) % 360)
+        if (latitude, longitude) != (lat, lng):
+            return redirect('{0}/{1},{2}'.format(request.script_root, lat, lng),
+                            301)
+
     return jsonify({"elevation": result})
+
+
+def error_response(status, message, **kwargs):
+    response = jsonify(dict(error=message, **kwargs))
+    response.status_code = status
+    return response
+
+
+@app.errorhandler(MissingChunkError)
+def missing_chunk(e):
+    # Nodes may serve only some chunks of a split dataset
+    return error_response(503, str(e), chunk=e.chunk)
+
+
+def unpack_points(data):
+    """View packed little-endian float64 (latitude, longitude) pairs as
+    latitudes and longitudes, without copying on little-endian machines.
+
+    """
+    if len(data) % 16:
+        raise ValueError("Packed points must be 16 bytes each")
+    if sys.byteorder == 'little':
+        values = memoryview(data).cast('d')
+    else:
+        values = array('d')
+        values.frombytes(data)
+        values.byteswap()
+        values = memoryview(values)
+    return values[0::2], values[1::2]
+
+
+def pack_elevations(result):
+    """Pack an array of elevations as little-endian int16."""
+    if sys.byteorder != 'little':
+        result.byteswap()
+    return result.tobytes()
+
+
+def request_points():
+    """Parse the points of a batch request.
+
+    With a JSON body, points are either an array of ``[latitude, longitude]``
+    pairs, or a polyline given as the ``polyline`` query parameter or as an
+    object ``{"polyline": ...}``.
+
+    An ``application/octet-stream`` body is a sequence of packed
+    little-endian float64 latitude, longitude pairs. A msgpack body is a map
+    with either ``points`` (packed as binary, or an array of pairs) or
+    ``polyline``.
+
+    Returns arrays of latitudes and longitudes.
+    """
+    if request.mimetype == BINARY_MIMETYPE:
+        return unpack_points(request.get_data())
+
+    encoded = request.args.get('polyline')
+    if encoded is not None:
+        return polyline.decode(encoded)
+
+    if request.mimetype in MSGPACK_MIMETYPES:
+        try:
+            body = msgpack.unpackb(request.get_data(), raw=False)
+        except Exception:
+            raise ValueError("Bad msgpack body")
+        if not isinstance(body, dict):
+            raise ValueError("Expected a map of points or a polyline")
+        body = body.get('points', body)
+        if isinstance(body, bytes):
+            return unpack_points(body)
+    else:
+        body = request.get_json(force=True, silent=True)
+
+    if isinstance(body, dict) and 'polyline' in body:
+        return polyline.decode(body['polyline'])
+    if not isinstance(body, list):
+        raise ValueError("Expected a list of points or a polyline")
+    if not all(isinstance(p, list) and len(p) == 2 for p in body):
+        raise ValueError("Points must be [latitude, longitude] pairs")
+    return (array('d', (p[0] for p in body)),
+            array('d', (p[1] for p in body)))
+
+
+def elevations_response(result):
+    """Respond with elevations in the same format as the request."""
+    if request.mimetype == BINARY_MIMETYPE:
+        return Response(pack_elevations(result), mimetype=BINARY_MIMETYPE)
+    if request.mimetype in MSGPACK_MIMETYPES:
+        body = msgpack.packb({"elevations": pack_elevations(result)},
+                             use_bin_type=True)
+        return Response(body, mimetype=MSGPACK_MIMETYPES[0])
+    return jsonify({"elevations": result.tolist()})
+
+
+def batch_points():
+    """Points of a batch request, aborting if they are malformed, out of
+    range or if there are too many of them.
+
+    """
+    if request.mimetype in MSGPACK_MIMETYPES and msgpack is None:
+        abort(error_response(415, "msgpack is not installed"))
+
+    try:
+        lats, lngs = request_points()
+    except (TypeError, ValueError) as e:
+        abort(error_response(400, str(e)))
+
+    max_size = app.config.get('ELEVATION_MAX_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE)
+    if len(lats) > max_size:
+        abort(error_response(413,
+                "Too many points (maximum {0})".format(max_size)))
+
+    metrics.batch(current_route(), len(lats))
+    try:
+        elevation.check(lats, lngs)
+    except OutOfRangeError as e:
+        abort(out_of_range(e))
+    return lats, lngs
+
+
+@app.route('/batch', methods=['GET', 'POST'])
+@cacheable
+def get_elevations():
+    lats, lngs = batch_points()
+    check_not_modified()
+
+    threads = app.config.get('ELEVATION_LOOKUP_THREADS', 1)
+    with lookup():
+        result = elevation.get_many(lats, lngs, threads=threads)
+
+    return elevations_response(result)
+
+
+@app.route('/profile', methods=['GET', 'POST'])
+@cacheable
+def get_profile():
+    """Elevation profile along the great circles joining a list of points.
+
+    Points are given as for batches. The ``step`` query parameter sets the
+    sampling interval in metres (by default, the dataset resolution) and
+    ``method`` sets the interpolation method.
+    """
+    lats, lngs = batch_points()
+    try:
+        step = float(request.args.get('step', 0))
+    except ValueError:
+        return error_response(400, "Bad step")
+    method = request.args.get('method', 'nearest')
+    if method not in interpolation_methods:
+        return error_response(400,
+                              "Unknown interpolation method {0!r}".format(method))
+    check_not_modified()
+    max_size = app.config.get('ELEVATION_MAX_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE)
+
+    def compute():
+        try:
+            with lookup():
+                distances, elevations = elevation.profile(lats, lngs,
+                        step=step, method=method, max_samples=max_size)
+        except ValueError as e:
+            return error_response(400, str(e))
+
+        return jsonify({
+            "distances": distances.tolist(),
+            "elevations": elevations.tolist(),
+        })
+
+    return cached_result(
+        cache_key('profile', step, method, max_size, lats, lngs), compute)
+
+
+@app.route('/intersect', methods=['POST'])
+def get_intersection():
+    """Where a descending trajectory first meets the ground.
+
+    The body is a JSON array of ``[latitude, longitude, altitude, time]``
+    samples. The response gives the interpolated position and time of the
+    first point that is not above the ground, or null if there is none.
+    """
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, list) or \
+            not all(isinstance(p, list) and len(p) == 4 for p in body):
+        return error_response(400,
+                "Expected a list of [latitude, longitude, altitude, time]")
+
+    max_size = app.config.get('ELEVATION_MAX_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE)
+    if len(body) > max_size:
+        return error_response(413,
+                "Too many points (maximum {0})".format(max_size))
+    metrics.batch(current_route(), len(body))
+
+    try:
+        samples = [array('d', (p[k] for p in body)) for k in range(4)]
+    except (TypeError, ValueError) as e:
+        return error_response(400, str(e))
+    method = request.args.get('method', 'bilinear')
+
+    def compute():
+        try:
+            with lookup():
+                result = elevation.intersect(*samples, method=method)
+        except OutOfRangeError as e:
+            return out_of_range(e)
+        except ValueError as e:
+            return error_response(400, str(e))
+
+        if result is not None:
+            result = dict(zip(("latitude", "longitude", "altitude", "time"),
+                              result))
+        return jsonify({"intersection": result})
+
+    return cached_result(cache_key('intersect', method, *samples), compute)
+
+
+@app.route('/cache-stats')
+def get_cache_stats():
+    """Counters of the result cache, shared by all workers."""
+    if result_cache is None:
+        return error_response(404, "The result cache is not enabled")
+    return jsonify(result_cache.stats())
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Metrics of every worker, in the Prometheus text format."""
+    extra = []
+    if result_cache is not None:
+        stats = result_cache.stats()
+        for counter in ('hits', 'misses', 'stores', 'evictions'):
+            extra.append(('result_cache_{0}_total'.format(counter), 'counter',
+                          'Result cache {0} in every worker.'.format(counter),
+                          stats[counter]))
+        extra.append(('result_cache_entries', 'gauge',
+                      'Entries in the result cache.', stats['entries']))
+    return Response(metrics.exposition(extra), content_type=CONTENT_TYPE)
+
+
+# Open the dataset when the module is imported rather than on the first
+# request. Under uwsgi (without lazy-apps) this happens in the master, so the
+# dataset is opened, warmed and locked once and shared by every worker, as are
+# the metrics.
+if os.environ.get('RUAUMOKO_PRELOAD'):
+    if 'RUAUMOKO_SETTINGS' in os.environ:
+        app.config.from_envvar('RUAUMOKO_SETTINGS')
+    open_dataset()
+    open_metrics()
@@ -64,7 +64,9 @@ def main():
     ds_loc = opts['<dataset>'] or Dataset.default_location
     ds = Dataset(ds_loc, expected_res=tile_res)
 
-    # Generate elevation image
+    # Generate elevation image, using overviews (if built) at the resolution
+    # of a character.
+    resolution = min(178.0 / shape[1], 359.0 / shape[0])
     elev_img = []
     max_elev = 0.0
     for row in range(shape[1]):
@@ -72,7 +74,7 @@ def main():
         lat = - ((float(row) / shape[1]) * 178 - 89)
         for col in range(shape[0]):
             lng = (180 + (float(col) / shape[0]) * 359 + 1) % 360
-            elev = math.sqrt(max(0, ds.get(lat, lng)))
+            elev = math.sqrt(max(0, ds.get_overview(lat, lng, resolution)))
             max_elev = max(elev, max_elev)
             elev_row.append(elev)
         elev_img.append(elev_row)
@@ -31,50 +31,1053 @@ memory access.
 import sys
 import os
 import os.path
+import json
 import mmap
+import struct
+import warnings
+import zlib
 
 from magicmemoryview import MagicMemoryView
 
-from libc.math cimport round
+from cpython cimport array
+import array
+
+from libc.string cimport memcpy
+from libc.errno cimport errno
+from posix.mman cimport (posix_madvise, mlock, munlock, POSIX_MADV_NORMAL,
+                         POSIX_MADV_RANDOM, POSIX_MADV_SEQUENTIAL,
+                         POSIX_MADV_WILLNEED, POSIX_MADV_DONTNEED)
+from cpython.pythread cimport (PyThread_type_lock, PyThread_allocate_lock,
+                               PyThread_free_lock, PyThread_acquire_lock,
+                               PyThread_release_lock, WAIT_LOCK)
+from libc.math cimport (round, fmod, floor, ceil, sin, cos, asin, atan2,
+                        sqrt, M_PI)
+from cython.parallel cimport prange
+
+cdef extern from "<sys/mman.h>" nogil:
+    int mincore(void *addr, size_t length, unsigned char *vec)
+
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #define RUAUMOKO_HAVE_OPENMP 1
+    #else
+    #define RUAUMOKO_HAVE_OPENMP 0
+    #endif
+    """
+    bint RUAUMOKO_HAVE_OPENMP
+
+# Whether the module was built with OpenMP. If not, batch lookups ignore the
+# threads argument and always run on a single core.
+have_openmp = RUAUMOKO_HAVE_OPENMP
 
 # In this module, everything is indexed [row][col] (or, [lat][lon]).
 
-cell_shape = (4, 6)
+cdef enum:
+    CHUNK_ROWS = 4
+    CHUNK_COLS = 6
+
+    # Batches smaller than this aren't worth starting threads for, and
+    # threads take work this many points at a time.
+    PARALLEL_MIN_POINTS = 4096
+    PARALLEL_CHUNK = 1024
+
+    # Side, in cells, of the blocks summarised by the coarse maximum
+    # elevation grid used to skip trajectory segments that are well clear of
+    # the ground, and the marker for blocks yet to be summarised. Maxima are
+    # stored as ints, so that the marker is below any int16 cell, voids
+    # included.
+    COARSE_BLOCK = 64
+    COARSE_UNKNOWN = -2147483648
+
+    # Bisection steps used to refine a ground intersection.
+    BISECTION_STEPS = 40
+
+cdef enum:
+    NEAREST
+    BILINEAR
+    BICUBIC
+
+# Names accepted for the `method` argument of interpolated lookups.
+interpolation_methods = {
+    "nearest": NEAREST,
+    "bilinear": BILINEAR,
+    "bicubic": BICUBIC,
+}
+
+cdef enum:
+    LAYOUT_RAW
+    LAYOUT_TILED
+    LAYOUT_COMPRESSED
+    LAYOUT_SPLIT
+
+# States of the chunks of a split dataset
+cdef enum:
+    CHUNK_UNMAPPED
+    CHUNK_MAPPED
+    CHUNK_MISSING
+    N_CHUNKS = CHUNK_ROWS * CHUNK_COLS
+
+cell_shape = (CHUNK_ROWS, CHUNK_COLS)
+
+# Names of the chunks, in order by row then column, as used for the files of
+# the source data.
+chunk_names = tuple(chr(ord('A') + k) for k in range(N_CHUNKS))
+
+# Names of the files of a split dataset (a directory with a file per chunk)
+# when there is no manifest saying otherwise.
+SPLIT_PATTERN = '15-{0}.tif'
+
+# Tiled datasets start with a header, followed by a table with an entry for
+# each tile, in order of chunk, then tile row, then tile column. The tiles
+# themselves may be stored in any order.
+TILED_MAGIC = b'RUAUMOKO'
+TILED_VERSION = 1
+TILED_HEADER = struct.Struct('<8sHHIIIHHQQ')
+TILED_ENTRY = struct.Struct('<QIhH')
+
+# Layouts of tiled datasets, and orders in which tiles may be stored. In
+# compressed datasets each tile is compressed with zlib, except for tiles
+# where every cell has the same value, which are flagged as constant in the
+# table and not stored at all.
+TILED_PLAIN = 1
+TILED_COMPRESSED = 2
+TILE_ORDERS = ('row', 'morton')
+TILE_CONSTANT = 1
+
+# The index of a dataset, stored next to it, holds the minimum and maximum of
+# each tile of its chunks: a header, then the minima and maxima as int16, in
+# order of chunk, tile row and tile column. Tiles of the index need not be
+# those of a tiled dataset. The header names the build of the dataset that was
+# indexed, and an index of any other build is ignored.
+INDEX_MAGIC = b'RUAUMIDX'
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('<8sHHII40s')
+
+# An overview level of a dataset, stored next to it, holds the mean, minimum
+# and maximum of blocks of cells: a header naming the level, the chunk shape
+# and the build of the dataset it was made from, padded to a page so that the
+# rest may be mapped, then the three planes of int16.
+OVERVIEW_MAGIC = b'RUAUMOVR'
+OVERVIEW_VERSION = 1
+OVERVIEW_HEADER = struct.Struct('<8sHHII40s')
+OVERVIEW_HEADER_SIZE = 4096
+
+# Access hints that may be given to Dataset.advise
+access_advice = {
+    "normal": POSIX_MADV_NORMAL,
+    "random": POSIX_MADV_RANDOM,
+    "sequential": POSIX_MADV_SEQUENTIAL,
+    "willneed": POSIX_MADV_WILLNEED,
+    "dontneed": POSIX_MADV_DONTNEED,
+}
+
+# Planes of an overview level.
+overview_kinds = {
+    "mean": 0,
+    "min": 1,
+    "max": 2,
+}
+
+# Mean radius of the Earth in metres, used to measure distances along paths.
+earth_radius = 6371009.0
+cdef double EARTH_RADIUS = earth_radius
+cdef double DEGREES = M_PI / 180
+
+cdef array.array _short_template = array.array('h')
+cdef array.array _double_template = array.array('d')
+cdef array.array _count_template = array.array('q')
+
+# Somewhere to put the bytes read when prefaulting pages, so that the reads
+# aren't optimised away
+cdef unsigned long _prefault_sink = 0
+
+
+class MissingChunkError(IOError):
+    """Raised when a lookup needs a chunk of a split dataset whose file is
+    missing, and no value to fill missing chunks with was given.
+
+    The chunk's name is available as ``chunk``.
+    """
+
+    def __init__(self, chunk, filename):
+        self.chunk = chunk
+        IOError.__init__(self, "Chunk {0} of the dataset is missing ({1})"
+                         .format(chunk, filename))
+
+
+class BadChunkError(MissingChunkError):
+    """Raised when the file of a chunk of a split dataset is present but
+    can't be mapped, as it is compressed or of the wrong size.
+
+    The chunk's name is available as ``chunk``, and why it can't be mapped as
+    ``reason``.
+    """
+
+    def __init__(self, chunk, filename, reason):
+        self.chunk = chunk
+        self.reason = reason
+        IOError.__init__(self, "Chunk {0} of the dataset can't be read ({1})"
+                         .format(chunk, reason))
+
+
+class StaleBuildWarning(UserWarning):
+    """Warned when a file built from a dataset, such as its index or
+    overviews, is of another build of it and so is ignored."""
+
+
+class OutOfRangeError(ValueError):
+    """Raised by batch lookups when some points lie outside the dataset.
+
+    The positions of the offending points in the input are available as
+    ``indices``.
+    """
+
+    def __init__(self, indices):
+        self.indices = list(indices)
+        ValueError.__init__(self,
+            "{0} point(s) out of range (first at index {1})"
+            .format(len(self.indices), self.indices[0]))
+
+
+def overview_path(filename, level):
+    """Filename of an overview level of a dataset."""
+    return '{0}.overview-{1}'.format(filename, level)
+
+
+def index_path(filename):
+    """Filename of the index of a dataset."""
+    return '{0}.index'.format(filename)
+
+
+def manifest_path(filename):
+    """Filename of the manifest of a dataset, or of a directory of chunks."""
+    return '{0}.manifest'.format(filename.rstrip(os.sep))
+
+
+def split_chunk_files(directory, expected_res):
+    """Filenames of the chunks of a split dataset, in order.
+
+    The manifest written by ruaumoko-download, if there is one, says which
+    file holds each chunk. Otherwise the original names of the source files
+    are assumed.
+    """
+    files = [os.path.join(directory, SPLIT_PATTERN.format(name))
+             for name in chunk_names]
+
+    try:
+        with open(manifest_path(directory)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return files
+
+    if tuple(manifest.get('resolution', ())) == tuple(expected_res):
+        for k, name in enumerate(chunk_names):
+            entry = manifest.get('chunks', {}).get(name, {})
+            if 'file' in entry:
+                files[k] = os.path.join(directory, entry['file'])
+    return files
+
+
+def chunk_offset(k, filename, expected_res):
+    """Offset of the cells in the file of chunk k of a split dataset,
+    raising BadChunkError if they can't be mapped."""
+    from .tiff import raw_offset
+
+    try:
+        return raw_offset(filename, tuple(expected_res[::-1]))
+    except ValueError as e:
+        raise BadChunkError(chunk_names[k], filename, e)
+
+
+def dataset_build(filename, expected_res):
+    """Identifier of the build of a dataset, and its modification time.
+
+    Rebuilding the dataset, or rewriting, adding or removing any chunk of a
+    split dataset, changes its size or modification time and so the build.
+    """
+    if os.path.isdir(filename):
+        files = [f for f in split_chunk_files(filename.rstrip(os.sep),
+                                              expected_res)
+                 if os.path.exists(f)]
+    else:
+        files = [filename]
+
+    size = mtime = 0
+    for name in files:
+        st = os.stat(name)
+        size += st.st_size
+        mtime = max(mtime, st.st_mtime_ns)
+    return '{0:x}-{1:x}'.format(size, mtime), mtime / 1e9
+
+
+def read_index(filename, expected_res):
+    """Read an index, returning its tile size, arrays of the minimum and
+    maximum of each tile, and the build ID of the dataset it was built from.
+
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size or not header.startswith(INDEX_MAGIC):
+            raise ValueError("{0} is not a dataset index".format(filename))
+        _, version, tile_size, width, height, build_id = \
+            INDEX_HEADER.unpack(header)
+        if version != INDEX_VERSION:
+            raise ValueError("Unsupported index version {0}; rebuild it with "
+                             "ruaumoko-build-index".format(version))
+        if (width, height) != tuple(expected_res):
+            raise ValueError("Index is for chunks of {0}, expected {1}"
+                             .format((width, height), tuple(expected_res)))
+
+        tile_rows, tile_cols = tile_grid(expected_res, tile_size)
+        n_tiles = CHUNK_ROWS * CHUNK_COLS * tile_rows * tile_cols
+        minima = array.array('h')
+        maxima = array.array('h')
+        try:
+            minima.fromfile(f, n_tiles)
+            maxima.fromfile(f, n_tiles)
+        except EOFError:
+            raise ValueError("Index {0} is truncated".format(filename))
+
+    if sys.byteorder != 'little':
+        minima.byteswap()
+        maxima.byteswap()
+    return tile_size, minima, maxima, build_id.rstrip(b'\0').decode('ascii')
+
+
+def read_overview(filename, expected_res, level):
+    """Read the header of an overview level and map its planes, returning
+    the build ID of the dataset it was built from and the planes.
+
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(OVERVIEW_HEADER.size)
+    if len(header) < OVERVIEW_HEADER.size or \
+            not header.startswith(OVERVIEW_MAGIC):
+        raise ValueError("{0} is not an overview; rebuild it with "
+                         "ruaumoko-build-overviews".format(filename))
+    _, version, file_level, width, height, build_id = \
+        OVERVIEW_HEADER.unpack(header)
+    if version != OVERVIEW_VERSION:
+        raise ValueError("Unsupported overview version {0}".format(version))
+    if (file_level, width, height) != (level,) + tuple(expected_res):
+        raise ValueError("{0} is level {1} for chunks of {2}, expected level "
+                         "{3} for {4}".format(filename, file_level,
+                             (width, height), level, tuple(expected_res)))
+
+    planes = _map(filename, (3,) + grid_shape(expected_res, level),
+                  OVERVIEW_HEADER_SIZE)
+    return build_id.rstrip(b'\0').decode('ascii'), planes
+
+
+def grid_shape(expected_res, level=0):
+    """Shape of the whole grid, without chunk overlaps, at an overview level.
+
+    Level 0 is the full dataset, which has a row at each pole but wraps around
+    in longitude. Each level halves the resolution of the one before.
+    """
+    rows = CHUNK_ROWS * (expected_res[1] - 1) + 1
+    cols = CHUNK_COLS * (expected_res[0] - 1)
+    for _ in range(level):
+        rows = (rows + 1) // 2
+        cols = (cols + 1) // 2
+    return rows, cols
+
+
+def read_tiled_header(f):
+    """Read the header of a tiled dataset from a file object.
+
+    Returns a dict of the header fields, or None if the file isn't a tiled
+    dataset.
+    """
+    header = f.read(TILED_HEADER.size)
+    if len(header) < TILED_HEADER.size or not header.startswith(TILED_MAGIC):
+        return None
+
+    (_, version, layout, tile_size, width, height, order, _,
+        table_offset, data_offset) = TILED_HEADER.unpack(header)
+    if version != TILED_VERSION:
+        raise ValueError("Unsupported tiled dataset version {0}".format(version))
+
+    return dict(layout=layout, tile_size=tile_size, res=(width, height),
+                order=TILE_ORDERS[order], table_offset=table_offset,
+                data_offset=data_offset)
+
+
+def tile_grid(expected_res, tile_size):
+    """Number of (rows, columns) of tiles covering a chunk."""
+    return (-(-expected_res[1] // tile_size), -(-expected_res[0] // tile_size))
+
+
+def _map(filename, shape, offset=0):
+    """Map a file of int16, from `offset` on, into memory as an array of the
+    given shape."""
+    prot = mmap.PROT_READ
+    flags = mmap.MAP_SHARED
+
+    with open(filename) as f:
+        m = mmap.mmap(f.fileno(), length=0, prot=prot, flags=flags,
+                      offset=offset)
+        return MagicMemoryView(m, shape, b'h')
+
+
+cdef int _method(object name) except -1:
+    try:
+        return interpolation_methods[name]
+    except KeyError:
+        raise ValueError("Unknown interpolation method {0!r}".format(name))
+
+
+cdef inline void _cubic_weights(double t, double w[4]) noexcept nogil:
+    # Catmull-Rom spline weights for samples at -1, 0, 1 and 2.
+    w[0] = ((-0.5 * t + 1.0) * t - 0.5) * t
+    w[1] = (1.5 * t - 2.5) * t * t + 1.0
+    w[2] = ((-1.5 * t + 2.0) * t + 0.5) * t
+    w[3] = (0.5 * t - 0.5) * t * t
+
+
+cdef inline double _angular_distance(double lat1, double lng1,
+                                    double lat2, double lng2) noexcept nogil:
+    # Haversine formula; arguments in radians.
+    cdef double a = (sin((lat2 - lat1) / 2) ** 2 +
+                     cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2)
+    return 2 * asin(sqrt(a))
+
+
+cdef inline void _great_circle_point(double lat1, double lng1,
+                                     double lat2, double lng2, double d,
+                                     double f, double *lat,
+                                     double *lng) noexcept nogil:
+    # The point a fraction f of the way along the great circle between
+    # (lat1, lng1) and (lat2, lng2), which are d radians apart. Arguments in
+    # radians; results in degrees, with longitude in [0, 360).
+    cdef double a, b, x, y, z
+
+    if d == 0:
+        lat[0] = lat1 / DEGREES
+        lng[0] = lng1 / DEGREES
+        return
+
+    a = sin((1 - f) * d) / sin(d)
+    b = sin(f * d) / sin(d)
+    x = a * cos(lat1) * cos(lng1) + b * cos(lat2) * cos(lng2)
+    y = a * cos(lat1) * sin(lng1) + b * cos(lat2) * sin(lng2)
+    z = a * sin(lat1) + b * sin(lat2)
+
+    lat[0] = atan2(z, sqrt(x * x + y * y)) / DEGREES
+    lng[0] = fmod(atan2(y, x) / DEGREES + 360, 360)
+    if lng[0] >= 360:
+        lng[0] = 0
+
+
+cdef const double[:] _as_doubles(object values):
+    """View `values` as doubles, copying only if it isn't a float64 buffer."""
+    try:
+        return values
+    except (TypeError, ValueError):
+        return array.array('d', values)
+
 
 cdef class Dataset:
     default_location = "/srv/ruaumoko-dataset"
     default_res = (14401, 10801)
 
+    default_cache_tiles = 1024
+
+    cdef int storage
     cdef short[:, :, :, :] data
-    cdef size_t block_rows
-    cdef size_t block_cols
+    cdef long tile_size, tile_rows, tile_cols
+
+    # Tiled layout: the whole file, as int16, and the offset of each tile in
+    # cells
+    cdef short[:] tiled
+    cdef long long[:] tile_offsets
+
+    # Compressed layout: the file, the table of (offset, length) of each tile
+    # and the value of constant tiles.
+    cdef object compressed
+    cdef list tile_table
+    cdef unsigned char[:] tile_constant
+    cdef short[:] tile_values
+
+    # Split layout: a file per chunk, each mapped when first needed. For each
+    # chunk, the address of its first cell once mapped and the offset of that
+    # cell in the file. Missing chunks read as missing_value if fill_missing
+    # is set.
+    cdef list chunk_files
+    cdef list chunk_maps
+    cdef const short *chunk_cells[N_CHUNKS]
+    cdef size_t chunk_offsets[N_CHUNKS]
+    cdef int chunk_state[N_CHUNKS]
+    cdef bint fill_missing
+    cdef short missing_value
+
+    # The first error met while reading tiles or chunks without the GIL,
+    # raised by check_tiles
+    cdef object tile_error
+
+    # Compressed layout: a cache of decompressed tiles, evicting the least
+    # recently used. tile_slot maps tiles to slots in the cache (or -1), and
+    # slots are kept in a doubly linked list from most to least recently used.
+    # All of it is protected by cache_lock.
+    cdef PyThread_type_lock cache_lock
+    cdef short[:] cache
+    cdef int[:] tile_slot
+    cdef long[:] slot_tile
+    cdef int[:] slot_prev
+    cdef int[:] slot_next
+    cdef int cache_size, cache_used, cache_head, cache_tail
+    cdef unsigned long long cache_hits, cache_misses
+
+    cdef long block_rows
+    cdef long block_cols
+    cdef long n_rows, n_cols
     cdef double lng_resolution, lat_resolution
+    cdef object coarse_max
+    cdef int[:] coarse_max_v
+    cdef list overviews
+    cdef long coarse_rows, coarse_cols
+
+    # Minimum and maximum of each tile of the index, if there is one
+    cdef long index_size, index_rows, index_cols
+    cdef short[:] index_min
+    cdef short[:] index_max
+
+    # Sampled counts of lookups in each tile, if enabled. Every
+    # access_every'th lookup is counted.
+    cdef long access_every, access_countdown
+    cdef long access_size, access_rows, access_cols
+    cdef object access_tiles
+    cdef unsigned int[:] access_counts_v
+
+    # Identifies this build of the dataset, and when it was made
+    cdef readonly object build_id
+    cdef readonly double modified
 
-    def __init__(self, filename=default_location, expected_res=default_res):
-        prot = mmap.PROT_READ
-        flags = mmap.MAP_SHARED
+    def __cinit__(self):
+        self.cache_lock = PyThread_allocate_lock()
+        if self.cache_lock == NULL:
+            raise MemoryError()
 
-        shape = cell_shape + expected_res[::-1]
-        with open(filename) as f:
-            m = mmap.mmap(f.fileno(), length=0, prot=prot, flags=flags)
-            self.data = MagicMemoryView(m, shape, b'h')
+    def __dealloc__(self):
+        if self.cache_lock != NULL:
+            PyThread_free_lock(self.cache_lock)
+
+    def __init__(self, filename=default_location, expected_res=default_res,
+                 cache_tiles=default_cache_tiles, missing=None):
+        if os.path.isdir(filename):
+            filename = filename.rstrip(os.sep)
+            self.open_split(filename, expected_res, missing)
+        else:
+            with open(filename, 'rb') as f:
+                header = read_tiled_header(f)
+            self.build_id, self.modified = dataset_build(filename,
+                                                         expected_res)
+
+            if header is None:
+                self.storage = LAYOUT_RAW
+                self.data = _map(filename,
+                                 cell_shape + tuple(expected_res[::-1]))
+            else:
+                self.open_tiled(filename, header, expected_res, cache_tiles)
+
+        # Overview levels, if they have been built from this build
+        self.overviews = []
+        while os.path.exists(overview_path(filename, len(self.overviews) + 1)):
+            level = len(self.overviews) + 1
+            build_id, planes = read_overview(overview_path(filename, level),
+                                             expected_res, level)
+            if build_id != self.build_id:
+                warnings.warn("Ignoring overviews of {0}, which are of another "
+                              "build of the dataset; rebuild them with "
+                              "ruaumoko-build-overviews".format(filename),
+                              StaleBuildWarning)
+                self.overviews = []
+                break
+            self.overviews.append(planes)
+
+        if os.path.exists(index_path(filename)):
+            index = read_index(index_path(filename), expected_res)
+            if index[3] != self.build_id:
+                # Its constant tiles would answer lookups with old values
+                warnings.warn("Ignoring index {0}, which is of another build "
+                              "of the dataset; rebuild it with "
+                              "ruaumoko-build-index"
+                              .format(index_path(filename)), StaleBuildWarning)
+            else:
+                self.index_size, self.index_min, self.index_max, _ = index
+                self.index_rows, self.index_cols = \
+                    tile_grid(expected_res, self.index_size)
 
         self.block_rows = expected_res[1] - 1
         self.block_cols = expected_res[0] - 1
 
+        # Size of the whole grid, not counting the overlap between chunks.
+        # Rows run from 0 to n_rows inclusive (pole to pole); columns wrap
+        # around modulo n_cols.
+        self.n_rows = CHUNK_ROWS * self.block_rows
+        self.n_cols = CHUNK_COLS * self.block_cols
+
         # Tile resolution is computed assuming 60 degrees longitude and 45 degrees longitude
         self.lng_resolution = self.block_cols / 60.0
         self.lat_resolution = self.block_rows / 45.0
 
-    cdef short get_cell(self, int row, int col):
-        cdef int block_r, block_c
+    cdef open_split(self, directory, expected_res, missing):
+        """Open a directory holding a file per chunk.
+
+        Nothing is mapped until a chunk is first needed, so the files of
+        chunks that are never used need not be present. Those that are present
+        are checked now, raising BadChunkError if any can't be mapped.
+        """
+        cdef int k
+
+        self.storage = LAYOUT_SPLIT
+        self.chunk_files = split_chunk_files(directory, expected_res)
+        self.chunk_maps = [None] * N_CHUNKS
+        for k in range(N_CHUNKS):
+            self.chunk_cells[k] = NULL
+            self.chunk_state[k] = CHUNK_UNMAPPED
+        self.fill_missing = missing is not None
+        self.missing_value = missing if missing is not None else 0
+
+        self.build_id, self.modified = dataset_build(directory, expected_res)
+
+        for k in range(N_CHUNKS):
+            if os.path.exists(self.chunk_files[k]):
+                chunk_offset(k, self.chunk_files[k], expected_res)
+
+    cdef int map_chunk(self, long block) except -1:
+        """Map the file of a chunk of a split dataset, if that hasn't been
+        done. Raises MissingChunkError if it is missing and there is no fill
+        value, and BadChunkError if it can't be mapped.
+        """
+        cdef const unsigned char[:] view
+
+        if self.chunk_state[block] != CHUNK_UNMAPPED:
+            return 0
+
+        filename = self.chunk_files[block]
+        if not os.path.exists(filename):
+            if self.fill_missing:
+                self.chunk_state[block] = CHUNK_MISSING
+                return 0
+            raise MissingChunkError(chunk_names[block], filename)
+
+        offset = chunk_offset(block, filename,
+                              (self.block_cols + 1, self.block_rows + 1))
+        with open(filename, 'rb') as f:
+            m = mmap.mmap(f.fileno(), length=0, prot=mmap.PROT_READ,
+                          flags=mmap.MAP_SHARED)
+
+        # Another thread may have got here first while the GIL was released
+        if self.chunk_state[block] != CHUNK_UNMAPPED:
+            return 0
+
+        view = m
+        self.chunk_maps[block] = m
+        self.chunk_offsets[block] = offset
+        self.chunk_cells[block] = <const short *> &view[offset]
+        self.chunk_state[block] = CHUNK_MAPPED
+        return 0
+
+    cdef bint chunk_present(self, long block) except -1:
+        """Map a chunk of a split dataset if need be, returning whether it is
+        present. Missing chunks have nothing to warm, lock or count."""
+        try:
+            self.map_chunk(block)
+        except MissingChunkError:
+            return False
+        return self.chunk_state[block] == CHUNK_MAPPED
+
+    cdef short split_cell(self, long block, long offset) noexcept nogil:
+        """Elevation of a cell of a split dataset whose chunk hasn't been
+        mapped, mapping it."""
+        with gil:
+            try:
+                self.map_chunk(block)
+            except Exception as e:
+                if self.tile_error is None:
+                    self.tile_error = e
+                return 0
+        if self.chunk_state[block] == CHUNK_MAPPED:
+            return self.chunk_cells[block][offset]
+        return self.missing_value
+
+    property missing_chunks:
+        """Names of the chunks of a split dataset whose files are missing."""
+        def __get__(self):
+            if self.storage != LAYOUT_SPLIT:
+                return []
+            return [chunk_names[k] for k in range(N_CHUNKS)
+                    if not os.path.exists(self.chunk_files[k])]
+
+    cdef open_tiled(self, filename, header, expected_res, cache_tiles):
+        if header['layout'] not in (TILED_PLAIN, TILED_COMPRESSED):
+            raise ValueError("Unsupported tiled dataset layout {0}"
+                             .format(header['layout']))
+        if tuple(header['res']) != tuple(expected_res):
+            raise ValueError("Dataset has tiles of resolution {0}, expected {1}"
+                             .format(header['res'], tuple(expected_res)))
+
+        self.tile_size = header['tile_size']
+        self.tile_rows, self.tile_cols = tile_grid(expected_res, self.tile_size)
+
+        n_tiles = CHUNK_ROWS * CHUNK_COLS * self.tile_rows * self.tile_cols
+        with open(filename, 'rb') as f:
+            f.seek(header['table_offset'])
+            table = f.read(n_tiles * TILED_ENTRY.size)
+            size = os.fstat(f.fileno()).st_size
+
+        if len(table) != n_tiles * TILED_ENTRY.size:
+            raise ValueError("Tile table is truncated")
+        entries = [TILED_ENTRY.unpack_from(table, k * TILED_ENTRY.size)
+                   for k in range(n_tiles)]
+        for k, (offset, length, _, flags) in enumerate(entries):
+            if offset + length > size:
+                raise ValueError("Bad tile table entry {0}".format(k))
+
+        if header['layout'] == TILED_COMPRESSED:
+            self.open_compressed(filename, entries, cache_tiles)
+            return
+
+        # Offsets are kept in units of cells rather than bytes
+        offsets = array.array('q', [0]) * n_tiles
+        for k, (offset, length, _, _) in enumerate(entries):
+            if offset % 2 or length != 2 * self.tile_size ** 2:
+                raise ValueError("Bad tile table entry {0}".format(k))
+            offsets[k] = offset // 2
+
+        self.storage = LAYOUT_TILED
+        self.tile_offsets = offsets
+        self.tiled = _map(filename, (size // 2,))
+
+    cdef open_compressed(self, filename, entries, cache_tiles):
+        cdef int k
+        cdef long tile_cells = self.tile_size * self.tile_size
+
+        if cache_tiles < 1:
+            raise ValueError("Bad tile cache size {0}".format(cache_tiles))
+
+        self.storage = LAYOUT_COMPRESSED
+        self.tile_table = [(offset, length) for offset, length, _, _ in entries]
+        self.tile_constant = array.array(
+            'B', [bool(flags & TILE_CONSTANT) for _, _, _, flags in entries])
+        self.tile_values = array.array('h', [value for _, _, value, _ in entries])
+
+        with open(filename, 'rb') as f:
+            self.compressed = mmap.mmap(f.fileno(), length=0,
+                                        prot=mmap.PROT_READ,
+                                        flags=mmap.MAP_SHARED)
+
+        self.cache_size = cache_tiles
+        self.cache = array.clone(_short_template, cache_tiles * tile_cells,
+                                 zero=False)
+        self.tile_slot = array.array('i', [-1]) * len(entries)
+        self.slot_tile = array.array('l', [-1]) * cache_tiles
+        self.slot_prev = array.array('i', [-1]) * cache_tiles
+        self.slot_next = array.array('i', [-1]) * cache_tiles
+        self.cache_used = 0
+        self.cache_head = self.cache_tail = -1
+
+    cdef inline void unlink_slot(self, int slot) noexcept nogil:
+        if self.slot_prev[slot] >= 0:
+            self.slot_next[self.slot_prev[slot]] = self.slot_next[slot]
+        else:
+            self.cache_head = self.slot_next[slot]
+        if self.slot_next[slot] >= 0:
+            self.slot_prev[self.slot_next[slot]] = self.slot_prev[slot]
+        else:
+            self.cache_tail = self.slot_prev[slot]
+
+    cdef inline void use_slot(self, int slot) noexcept nogil:
+        """Move a slot to the front of the cache's LRU list."""
+        if self.cache_head == slot:
+            return
+        if self.slot_prev[slot] >= 0 or self.slot_next[slot] >= 0 or \
+                self.cache_tail == slot:
+            self.unlink_slot(slot)
+        self.slot_prev[slot] = -1
+        self.slot_next[slot] = self.cache_head
+        if self.cache_head >= 0:
+            self.slot_prev[self.cache_head] = slot
+        self.cache_head = slot
+        if self.cache_tail < 0:
+            self.cache_tail = slot
+
+    cdef bytes read_tile(self, long tile):
+        """Decompress a tile, or return None and record the error."""
+        offset, length = self.tile_table[tile]
+        try:
+            data = zlib.decompress(self.compressed[offset:offset + length])
+            if len(data) != 2 * self.tile_size * self.tile_size:
+                raise ValueError("tile has wrong size")
+            return data
+        except Exception as e:
+            if self.tile_error is None:
+                self.tile_error = IOError("Corrupt tile {0}: {1}".format(tile, e))
+            return None
+
+    cdef short cached_cell(self, long tile, long offset) noexcept nogil:
+        """Elevation of a cell in a compressed tile, via the cache."""
+        cdef int slot
+        cdef short value = 0
+        cdef const char *src
+
+        PyThread_acquire_lock(self.cache_lock, WAIT_LOCK)
+        slot = self.tile_slot[tile]
+        if slot >= 0:
+            self.cache_hits += 1
+            self.use_slot(slot)
+            value = self.cache[slot * self.tile_size * self.tile_size + offset]
+            PyThread_release_lock(self.cache_lock)
+            return value
+        PyThread_release_lock(self.cache_lock)
+
+        # The cache lock is never held while waiting for the GIL, so that
+        # threads which hold the GIL may safely wait for the lock.
+        with gil:
+            data = self.read_tile(tile)
+            if data is None:
+                return 0
+            src = data
+
+            PyThread_acquire_lock(self.cache_lock, WAIT_LOCK)
+            slot = self.tile_slot[tile]
+            if slot < 0:
+                # Not loaded by another thread in the meantime
+                self.cache_misses += 1
+                if self.cache_used < self.cache_size:
+                    slot = self.cache_used
+                    self.cache_used += 1
+                else:
+                    slot = self.cache_tail
+                    self.tile_slot[self.slot_tile[slot]] = -1
+                memcpy(&self.cache[slot * self.tile_size * self.tile_size], src,
+                       len(data))
+                self.tile_slot[tile] = slot
+                self.slot_tile[slot] = tile
+            self.use_slot(slot)
+            value = self.cache[slot * self.tile_size * self.tile_size + offset]
+            PyThread_release_lock(self.cache_lock)
+
+        return value
+
+    cdef int check_tiles(self) except -1:
+        """Raise any error met while reading compressed tiles or the chunks
+        of a split dataset."""
+        if self.tile_error is not None:
+            error, self.tile_error = self.tile_error, None
+            raise error
+        return 0
+
+    property cache_stats:
+        """Hits, misses and size of the tile cache of a compressed dataset."""
+        def __get__(self):
+            return dict(hits=self.cache_hits, misses=self.cache_misses,
+                        tiles=self.cache_used, size=self.cache_size)
+
+    property layout:
+        """How the dataset is stored: "raw", "tiled", "compressed" or "split"."""
+        def __get__(self):
+            return ("raw", "tiled", "compressed", "split")[self.storage]
+
+    cdef inline short chunk_cell(self, long block_r, long block_c,
+                                 long row, long col) noexcept nogil:
+        """Elevation of a cell within a chunk."""
+        cdef long tile, offset
+
+        # Constant tiles are answered from the index, without touching the
+        # dataset.
+        if self.index_size:
+            tile = self.index_tile(block_r, block_c, row, col)
+            if self.index_min[tile] == self.index_max[tile]:
+                return self.index_min[tile]
+
+        if self.storage == LAYOUT_RAW:
+            return self.data[block_r, block_c, row, col]
+
+        if self.storage == LAYOUT_SPLIT:
+            tile = block_r * CHUNK_COLS + block_c
+            offset = row * (self.block_cols + 1) + col
+            if self.chunk_state[tile] == CHUNK_MAPPED:
+                return self.chunk_cells[tile][offset]
+            if self.chunk_state[tile] == CHUNK_MISSING:
+                return self.missing_value
+            return self.split_cell(tile, offset)
+
+        tile = (((block_r * CHUNK_COLS + block_c) * self.tile_rows +
+                 row // self.tile_size) * self.tile_cols + col // self.tile_size)
+        offset = (row % self.tile_size) * self.tile_size + col % self.tile_size
+
+        if self.storage == LAYOUT_TILED:
+            return self.tiled[self.tile_offsets[tile] + offset]
+        if self.tile_constant[tile]:
+            return self.tile_values[tile]
+        return self.cached_cell(tile, offset)
+
+    cdef inline long index_tile(self, long block_r, long block_c,
+                                long row, long col) noexcept nogil:
+        """Tile of the index holding a cell within a chunk."""
+        return (((block_r * CHUNK_COLS + block_c) * self.index_rows +
+                 row // self.index_size) * self.index_cols +
+                col // self.index_size)
+
+    cdef inline short get_cell(self, long row, long col) noexcept nogil:
+        """Elevation of a cell in the whole grid.
+
+        Rows are clamped to the poles; columns wrap around the antimeridian.
+        """
+        cdef long block_r, block_c
+
+        self.locate(&row, &col, &block_r, &block_c)
+        return self.chunk_cell(block_r, block_c, row, col)
+
+    cdef inline void locate(self, long *row, long *col,
+                            long *block_r, long *block_c) noexcept nogil:
+        """Find the chunk holding a cell of the whole grid, and the cell's
+        position within it.
 
-        block_r = row // self.block_rows
-        row %= self.block_rows
-        block_c = col // self.block_cols
-        col %= self.block_cols
+        """
+        if row[0] < 0:
+            row[0] = 0
+        elif row[0] > self.n_rows:
+            row[0] = self.n_rows
+        col[0] %= self.n_cols
+        if col[0] < 0:
+            col[0] += self.n_cols
 
-        return self.data[block_r, block_c, row, col]
+        block_r[0] = row[0] // self.block_rows
+        row[0] %= self.block_rows
+        block_c[0] = col[0] // self.block_cols
+        col[0] %= self.block_cols
+
+        # The last row of the grid only exists as the overlap row of the
+        # final chunk.
+        if block_r[0] == CHUNK_ROWS:
+            block_r[0] -= 1
+            row[0] = self.block_rows
+
+    cdef inline bint in_range(self, double lat, double lng) noexcept nogil:
+        return -90 <= lat <= 90 and 0 <= lng < 360
+
+    cdef inline void position(self, double lat, double lng,
+                              double *y, double *x) noexcept nogil:
+        """Fractional (row, col) of (lat, lng), which must be in range."""
+        y[0] = (90 - lat) * self.lat_resolution
+        x[0] = fmod(lng + 180, 360) * self.lng_resolution
+
+    cdef inline short lookup(self, double lat, double lng) noexcept nogil:
+        """Nearest-cell elevation at (lat, lng), which must be in range."""
+        cdef double y, x
+        self.position(lat, lng, &y, &x)
+        if self.access_every:
+            self.count_access(y, x)
+        return self.get_cell(<long> round(y), <long> round(x))
+
+    cdef void count_access(self, double y, double x) noexcept nogil:
+        """Count a sample of lookups at fractional grid positions.
+
+        Threads may race on the counters, so counts are approximate when
+        batches are split across threads.
+        """
+        cdef long row, col, block_r, block_c
+
+        self.access_countdown -= 1
+        if self.access_countdown > 0:
+            return
+        self.access_countdown = self.access_every
+
+        row = <long> round(y)
+        col = <long> round(x)
+        self.locate(&row, &col, &block_r, &block_c)
+        self.access_counts_v[
+            ((block_r * CHUNK_COLS + block_c) * self.access_rows +
+             row // self.access_size) * self.access_cols +
+            col // self.access_size] += 1
+
+    cdef double interpolate_at(self, double lat, double lng,
+                               int method) noexcept nogil:
+        """Interpolated elevation at (lat, lng), which must be in range."""
+        cdef double y, x, fy, fx, row_value, value
+        cdef double wy[4]
+        cdef double wx[4]
+        cdef long i, j, di, dj
+
+        if method == NEAREST:
+            return self.lookup(lat, lng)
+
+        self.position(lat, lng, &y, &x)
+        if self.access_every:
+            self.count_access(y, x)
+        i = <long> floor(y)
+        j = <long> floor(x)
+        fy = y - i
+        fx = x - j
+
+        if method == BILINEAR:
+            return ((1 - fy) * ((1 - fx) * self.get_cell(i, j) +
+                                fx * self.get_cell(i, j + 1)) +
+                    fy * ((1 - fx) * self.get_cell(i + 1, j) +
+                          fx * self.get_cell(i + 1, j + 1)))
+
+        _cubic_weights(fy, wy)
+        _cubic_weights(fx, wx)
+        value = 0
+        for di in range(4):
+            row_value = 0
+            for dj in range(4):
+                row_value += wx[dj] * self.get_cell(i + di - 1, j + dj - 1)
+            value += wy[di] * row_value
+        return value
+
+    cdef Py_ssize_t check_batch(self, const double[:] lat_v,
+                                const double[:] lng_v, int threads) except -1:
+        """Validate a batch, returning its length."""
+        cdef Py_ssize_t k, bad = 0
+        cdef Py_ssize_t n = lat_v.shape[0]
+
+        if lng_v.shape[0] != n:
+            raise ValueError("Got {0} latitudes but {1} longitudes"
+                             .format(n, lng_v.shape[0]))
+        if threads < 0:
+            raise ValueError("Bad thread count {0}".format(threads))
+
+        with nogil:
+            for k in range(n):
+                if not self.in_range(lat_v[k], lng_v[k]):
+                    bad += 1
+
+        if bad:
+            raise OutOfRangeError([
+                k for k in range(n) if not self.in_range(lat_v[k], lng_v[k])
+            ])
+
+        return n
+
+    def check(self, lats, lngs):
+        """Validate points as :meth:`get_many` does, without looking any up.
+
+        Raises :class:`OutOfRangeError` listing the indices of the points
+        that are out of range.
+        """
+        self.check_batch(_as_doubles(lats), _as_doubles(lngs), 1)
+
+    def snap(self, double lat, double lng):
+        """Position of the centre of the cell nearest (lat, lng), which
+        :meth:`get` reads, as ``(latitude, longitude)``.
+
+        """
+        cdef double y, x
+        cdef long row, col
+
+        if not self.in_range(lat, lng):
+            raise ValueError("Bad position {0}, {1}".format(lat, lng))
+
+        self.position(lat, lng, &y, &x)
+        row = <long> round(y)
+        col = <long> round(x) % self.n_cols
+        return (90 - row / self.lat_resolution,
+                (col / self.lng_resolution + 180) % 360)
 
     def get(self, double lat, double lng):
         if not -90 <= lat <= 90:
@@ -82,14 +1085,858 @@ cdef class Dataset:
         if not 0 <= lng < 360:
             raise ValueError("Bad longitude {0}".format(lng))
 
-        cdef double i_f, j_f
+        value = self.lookup(lat, lng)
+        self.check_tiles()
+        return value
+
+    def get_many(self, lats, lngs, out=None, int threads=1):
+        """Look up the elevation of many points at once.
+
+        `lats` and `lngs` may be any float64 buffer (e.g., a NumPy array or
+        an ``array.array('d')``) or sequence of floats. Results are written
+        to `out`, a writable int16 buffer of the same length, which is
+        allocated as an ``array.array('h')`` if not given. Each result is
+        identical to calling :meth:`get` on the corresponding point.
+
+        All points are validated before any are looked up; if some are out of
+        range, :class:`OutOfRangeError` is raised listing their indices.
+
+        If the module was built with OpenMP (see `have_openmp`), the batch is
+        split across `threads` threads, so that page faults on a cold dataset
+        are serviced concurrently. Zero means the OpenMP default (usually one
+        thread per core).
+        """
+        cdef const double[:] lat_v = _as_doubles(lats)
+        cdef const double[:] lng_v = _as_doubles(lngs)
+        cdef Py_ssize_t k, n = self.check_batch(lat_v, lng_v, threads)
+
+        if out is None:
+            out = array.clone(_short_template, n, zero=False)
+        cdef short[:] out_v = out
+        if out_v.shape[0] != n:
+            raise ValueError("Output has length {0}, expected {1}"
+                             .format(out_v.shape[0], n))
+
+        with nogil:
+            if threads == 1 or n < PARALLEL_MIN_POINTS:
+                for k in range(n):
+                    out_v[k] = self.lookup(lat_v[k], lng_v[k])
+            elif threads == 0:
+                for k in prange(n, schedule='dynamic', chunksize=PARALLEL_CHUNK):
+                    out_v[k] = self.lookup(lat_v[k], lng_v[k])
+            else:
+                for k in prange(n, schedule='dynamic', chunksize=PARALLEL_CHUNK,
+                                num_threads=threads):
+                    out_v[k] = self.lookup(lat_v[k], lng_v[k])
+
+        self.check_tiles()
+        return out
+
+    def interpolate(self, double lat, double lng, method="bilinear"):
+        """Interpolated elevation at (lat, lng).
+
+        `method` is one of "nearest" (the same as :meth:`get`), "bilinear"
+        or "bicubic" (Catmull-Rom). Neighbouring cells are taken from across
+        chunk boundaries and the antimeridian; at the poles the edge row is
+        repeated.
+        """
+        cdef int m = _method(method)
+
+        if not -90 <= lat <= 90:
+            raise ValueError("Bad latitude {0}".format(lat))
+        if not 0 <= lng < 360:
+            raise ValueError("Bad longitude {0}".format(lng))
+
+        value = self.interpolate_at(lat, lng, m)
+        self.check_tiles()
+        return value
+
+    def interpolate_many(self, lats, lngs, method="bilinear", out=None,
+                         int threads=1):
+        """Interpolated elevation of many points at once.
+
+        Arguments are as for :meth:`get_many` and :meth:`interpolate`,
+        except that `out` is a float64 buffer, allocated as an
+        ``array.array('d')`` if not given.
+        """
+        cdef int m = _method(method)
+        cdef const double[:] lat_v = _as_doubles(lats)
+        cdef const double[:] lng_v = _as_doubles(lngs)
+        cdef Py_ssize_t k, n = self.check_batch(lat_v, lng_v, threads)
+
+        if out is None:
+            out = array.clone(_double_template, n, zero=False)
+        cdef double[:] out_v = out
+        if out_v.shape[0] != n:
+            raise ValueError("Output has length {0}, expected {1}"
+                             .format(out_v.shape[0], n))
+
+        with nogil:
+            if threads == 1 or n < PARALLEL_MIN_POINTS:
+                for k in range(n):
+                    out_v[k] = self.interpolate_at(lat_v[k], lng_v[k], m)
+            elif threads == 0:
+                for k in prange(n, schedule='dynamic', chunksize=PARALLEL_CHUNK):
+                    out_v[k] = self.interpolate_at(lat_v[k], lng_v[k], m)
+            else:
+                for k in prange(n, schedule='dynamic', chunksize=PARALLEL_CHUNK,
+                                num_threads=threads):
+                    out_v[k] = self.interpolate_at(lat_v[k], lng_v[k], m)
+
+        self.check_tiles()
+        return out
+
+    def profile(self, lats, lngs, double step=0, method="nearest",
+                max_samples=None):
+        """Elevation profile along a path.
+
+        The path visits each of the waypoints given by `lats` and `lngs` in
+        turn, following great circles between them, and is sampled every
+        `step` metres along each leg. The step is never finer than the
+        dataset resolution, which is also the default. If `max_samples` is
+        given, the step is lengthened as needed so that no more than that
+        many samples are taken. Elevations are found as for
+        :meth:`interpolate`.
+
+        Returns a pair of ``array.array('d')``: the distance of each sample
+        from the start of the path in metres, and its elevation. Both
+        waypoints are included at the ends of each leg.
+        """
+        cdef int m = _method(method)
+        cdef const double[:] lat_v = _as_doubles(lats)
+        cdef const double[:] lng_v = _as_doubles(lngs)
+        cdef Py_ssize_t n = self.check_batch(lat_v, lng_v, 1)
+        cdef Py_ssize_t i, k, s, count, total
+        cdef double length, angle, lat, lng, resolution
+
+        if n < 1:
+            raise ValueError("A path needs at least one waypoint")
+        if max_samples is not None and max_samples < n:
+            raise ValueError("max_samples is less than the number of waypoints")
+
+        legs = array.clone(_double_template, n, zero=True)
+        cdef double[:] legs_v = legs
+        length = 0
+        for k in range(n - 1):
+            legs_v[k] = _angular_distance(
+                lat_v[k] * DEGREES, lng_v[k] * DEGREES,
+                lat_v[k + 1] * DEGREES, lng_v[k + 1] * DEGREES)
+            if M_PI - legs_v[k] < 1e-9:
+                raise ValueError("Waypoints {0} and {1} are antipodal; the "
+                                 "great circle between them is ambiguous"
+                                 .format(k, k + 1))
+            length += legs_v[k]
+
+        # Step as an angle, no finer than one cell of latitude.
+        resolution = DEGREES / self.lat_resolution
+        angle = max(step / EARTH_RADIUS, resolution)
+        if max_samples is not None and length / angle > max_samples - n:
+            angle = length / max(max_samples - n, 1)
+
+        counts = array.clone(_count_template, n, zero=True)
+        cdef long long[:] counts_v = counts
+        total = 1
+        for k in range(n - 1):
+            counts_v[k] = max(<long long> ceil(legs_v[k] / angle), 1)
+            total += counts_v[k]
+
+        distances = array.clone(_double_template, total, zero=False)
+        elevations = array.clone(_double_template, total, zero=False)
+        cdef double[:] dist_v = distances
+        cdef double[:] elev_v = elevations
+
+        with nogil:
+            s = 0
+            length = 0
+            for k in range(n - 1):
+                count = counts_v[k]
+                for i in range(count):
+                    _great_circle_point(
+                        lat_v[k] * DEGREES, lng_v[k] * DEGREES,
+                        lat_v[k + 1] * DEGREES, lng_v[k + 1] * DEGREES,
+                        legs_v[k], i / <double> count, &lat, &lng)
+                    dist_v[s] = (length + legs_v[k] * i / count) * EARTH_RADIUS
+                    elev_v[s] = self.interpolate_at(lat, lng, m)
+                    s += 1
+                length += legs_v[k]
+
+            dist_v[s] = length * EARTH_RADIUS
+            elev_v[s] = self.interpolate_at(lat_v[n - 1], lng_v[n - 1], m)
+
+        self.check_tiles()
+        return distances, elevations
+
+    cdef int block_max(self, long ci, long cj) noexcept nogil:
+        """Highest cell in a coarse block, including the first row and
+        column of the next block, so that the result bounds any elevation
+        interpolated within it.
+
+        """
+        cdef long k = ci * self.coarse_cols + cj
+        cdef long row, col, row_end
+        cdef short value
+        cdef int highest
+
+        if self.coarse_max_v[k] != COARSE_UNKNOWN:
+            return self.coarse_max_v[k]
+
+        highest = COARSE_UNKNOWN
+        row_end = min((ci + 1) * COARSE_BLOCK, self.n_rows)
+        for row in range(ci * COARSE_BLOCK, row_end + 1):
+            for col in range(cj * COARSE_BLOCK, (cj + 1) * COARSE_BLOCK + 1):
+                value = self.get_cell(row, col)
+                if value > highest:
+                    highest = value
+
+        self.coarse_max_v[k] = highest
+        return highest
+
+    cdef double segment_max(self, double y0, double x0,
+                            double y1, double x1) noexcept nogil:
+        """Bound on the elevation anywhere along a segment between
+        fractional grid positions. x1 may lie outside the grid, if the
+        segment crosses the antimeridian.
+
+        """
+        cdef long ci, cj
+        cdef double highest = COARSE_UNKNOWN
+
+        for ci in range(<long> floor(min(y0, y1)) // COARSE_BLOCK,
+                        <long> ceil(max(y0, y1)) // COARSE_BLOCK + 1):
+            if ci >= self.coarse_rows:
+                break
+            for cj in range(<long> floor(min(x0, x1)) // COARSE_BLOCK,
+                            <long> ceil(max(x0, x1)) // COARSE_BLOCK + 1):
+                highest = max(highest, self.block_max(
+                    ci, (cj % self.coarse_cols + self.coarse_cols) %
+                        self.coarse_cols))
+
+        return highest
+
+    cdef double clearance(self, const double[:] lat_v, const double[:] lng_v,
+                          const double[:] alt_v, Py_ssize_t k, double f,
+                          int method, double *lat, double *lng) noexcept nogil:
+        """Height above ground a fraction f of the way from sample k to k+1,
+        and the position there.
+
+        """
+        cdef double dlng = lng_v[k + 1] - lng_v[k]
+        if dlng > 180:
+            dlng -= 360
+        elif dlng < -180:
+            dlng += 360
+
+        lat[0] = lat_v[k] + f * (lat_v[k + 1] - lat_v[k])
+        lng[0] = fmod(lng_v[k] + f * dlng + 360, 360)
+        return (alt_v[k] + f * (alt_v[k + 1] - alt_v[k]) -
+                self.interpolate_at(lat[0], lng[0], method))
+
+    cdef bint find_intersection(self, const double[:] lat_v,
+                                const double[:] lng_v, const double[:] alt_v,
+                                int method, Py_ssize_t *segment,
+                                double *fraction) noexcept nogil:
+        """First point of a trajectory of at least two samples that is not
+        above the ground, as a fraction of the way along a segment.
+
+        """
+        cdef Py_ssize_t k, n = lat_v.shape[0]
+        cdef long q, steps
+        cdef int b
+        cdef double lat, lng, y0, x0, y1, x1, lo, hi, mid
+
+        if self.clearance(lat_v, lng_v, alt_v, 0, 0, method, &lat, &lng) <= 0:
+            segment[0] = 0
+            fraction[0] = 0
+            return True
+
+        for k in range(n - 1):
+            self.position(lat_v[k], lng_v[k], &y0, &x0)
+            self.position(lat_v[k + 1], lng_v[k + 1], &y1, &x1)
+            if x1 - x0 > self.n_cols / 2.0:
+                x1 -= self.n_cols
+            elif x0 - x1 > self.n_cols / 2.0:
+                x1 += self.n_cols
+
+            if min(alt_v[k], alt_v[k + 1]) > self.segment_max(y0, x0, y1, x1):
+                continue
+
+            # Walk the segment no more than a cell at a time, then bisect
+            # the first step that ends below ground.
+            steps = <long> ceil(max(abs(y1 - y0), abs(x1 - x0))) + 1
+            for q in range(1, steps + 1):
+                hi = q / <double> steps
+                if self.clearance(lat_v, lng_v, alt_v, k, hi,
+                                  method, &lat, &lng) > 0:
+                    continue
+
+                lo = (q - 1) / <double> steps
+                for b in range(BISECTION_STEPS):
+                    mid = (lo + hi) / 2
+                    if self.clearance(lat_v, lng_v, alt_v, k, mid,
+                                      method, &lat, &lng) > 0:
+                        lo = mid
+                    else:
+                        hi = mid
+
+                segment[0] = k
+                fraction[0] = hi
+                return True
+
+        return False
+
+    def intersect(self, lats, lngs, alts, times=None, method="bilinear"):
+        """Find where a descending trajectory first meets the ground.
+
+        The trajectory is a sequence of samples with positions given by
+        `lats`, `lngs` and `alts` (altitudes in metres) at `times`, which
+        default to the sample indices. Between samples it is assumed to move
+        linearly.
+
+        Segments that are entirely above a coarse grid of maximum elevations
+        are skipped, and the rest are searched a cell at a time and refined
+        by bisection. `method` is "nearest" or "bilinear" (see
+        :meth:`interpolate`).
+
+        Returns ``(latitude, longitude, altitude, time)`` at the first point
+        not above the ground, or None if the trajectory stays above it.
+        """
+        cdef int m = _method(method)
+        cdef const double[:] lat_v = _as_doubles(lats)
+        cdef const double[:] lng_v = _as_doubles(lngs)
+        cdef const double[:] alt_v = _as_doubles(alts)
+        cdef const double[:] time_v
+        cdef Py_ssize_t segment, n = self.check_batch(lat_v, lng_v, 1)
+        cdef double fraction, lat, lng, alt, t
+        cdef bint found
+
+        if m == BICUBIC:
+            # Bicubic interpolation can overshoot the coarse maxima.
+            raise ValueError("Ground intersection does not support bicubic "
+                             "interpolation")
+        if n < 1:
+            raise ValueError("A trajectory needs at least one sample")
+        if alt_v.shape[0] != n:
+            raise ValueError("Got {0} positions but {1} altitudes"
+                             .format(n, alt_v.shape[0]))
+        if times is None:
+            time_v = array.array('d', range(n))
+        else:
+            time_v = _as_doubles(times)
+            if time_v.shape[0] != n:
+                raise ValueError("Got {0} positions but {1} times"
+                                 .format(n, time_v.shape[0]))
+
+        if n == 1:
+            found = alt_v[0] <= self.interpolate_at(lat_v[0], lng_v[0], m)
+            self.check_tiles()
+            if not found:
+                return None
+            return lat_v[0], lng_v[0], alt_v[0], time_v[0]
+
+        if self.coarse_max is None:
+            self.coarse_rows = self.n_rows // COARSE_BLOCK + 1
+            self.coarse_cols = (self.n_cols + COARSE_BLOCK - 1) // COARSE_BLOCK
+            self.coarse_max = array.array(
+                'i', [COARSE_UNKNOWN]) * (self.coarse_rows * self.coarse_cols)
+            self.coarse_max_v = self.coarse_max
+
+        with nogil:
+            found = self.find_intersection(lat_v, lng_v, alt_v, m,
+                                           &segment, &fraction)
+
+        if self.tile_error is not None:
+            # Coarse maxima may have been computed from unreadable tiles
+            self.coarse_max = None
+            self.check_tiles()
+        if not found:
+            return None
+
+        self.clearance(lat_v, lng_v, alt_v, segment, fraction, m, &lat, &lng)
+        alt = alt_v[segment] + fraction * (alt_v[segment + 1] - alt_v[segment])
+        t = time_v[segment] + fraction * (time_v[segment + 1] - time_v[segment])
+        return lat, lng, alt, t
+
+    property overview_levels:
+        """Number of overview levels available, not counting the dataset."""
+        def __get__(self):
+            return len(self.overviews)
+
+    def overview_level(self, double resolution):
+        """Coarsest level with cells no more than `resolution` degrees
+        across.
+
+        """
+        cdef double cell = max(1 / self.lat_resolution, 1 / self.lng_resolution)
+        cdef int level = 0
+
+        while level < len(self.overviews) and cell * 2 <= resolution:
+            cell *= 2
+            level += 1
+        return level
+
+    def get_overview(self, double lat, double lng, double resolution,
+                     kind="mean"):
+        """Summary of the elevation around (lat, lng) at a resolution of
+        `resolution` degrees.
+
+        The coarsest overview level (see ``ruaumoko-build-overviews``) with
+        cells no larger than `resolution` is used, so that coarse queries
+        touch far less data. `kind` picks the "mean", "min" or "max" of the
+        cell containing the point. If no level is coarse enough, this is the
+        same as :meth:`get`.
+        """
+        cdef short[:, :, :] overview
+        cdef double y, x
+        cdef long i, j
+        cdef int level
+
+        try:
+            plane = overview_kinds[kind]
+        except KeyError:
+            raise ValueError("Unknown overview kind {0!r}".format(kind))
+
+        if not -90 <= lat <= 90:
+            raise ValueError("Bad latitude {0}".format(lat))
+        if not 0 <= lng < 360:
+            raise ValueError("Bad longitude {0}".format(lng))
+
+        level = self.overview_level(resolution)
+        if level == 0:
+            value = self.lookup(lat, lng)
+            self.check_tiles()
+            return value
+
+        overview = self.overviews[level - 1]
+        self.position(lat, lng, &y, &x)
+        i = <long> round(y) >> level
+        j = (<long> round(x) % self.n_cols) >> level
+        return overview[plane, i, j]
+
+    property has_index:
+        """Whether the dataset has an index (see ``ruaumoko-build-index``)."""
+        def __get__(self):
+            return self.index_size > 0
+
+    cdef check_index(self):
+        if not self.index_size:
+            raise ValueError("Dataset has no index; build one with "
+                             "ruaumoko-build-index")
+
+    def tile_range(self, double lat, double lng):
+        """Minimum and maximum elevation of the index tile holding the cell
+        nearest (lat, lng), as a pair.
+
+        """
+        cdef double y, x
+        cdef long row, col, block_r, block_c, tile
+
+        self.check_index()
+        if not self.in_range(lat, lng):
+            raise ValueError("Bad position {0}, {1}".format(lat, lng))
+
+        self.position(lat, lng, &y, &x)
+        row = <long> round(y)
+        col = <long> round(x)
+        self.locate(&row, &col, &block_r, &block_c)
+        tile = self.index_tile(block_r, block_c, row, col)
+        return self.index_min[tile], self.index_max[tile]
+
+    def elevation_range(self, double lat0, double lng0,
+                        double lat1, double lng1):
+        """Bounds on the elevation of every cell that lookups and
+        interpolation may read within a box, as a pair (lowest, highest).
+
+        The box spans latitudes `lat0` to `lat1`, and longitudes east from
+        `lng0` to `lng1`, crossing the antimeridian if `lng1` is less than
+        `lng0`. The bounds come from the index and so are those of the tiles
+        overlapping the box, rather than exact.
+        """
+        cdef long block_r, block_c, r0, r1, c0, c1, tr, tc, tile
+        cdef short lowest = 32767, highest = -32768
+
+        self.check_index()
+        for block_r, block_c, r0, r1, c0, c1 in self.box_cells(
+                lat0, lng0, lat1, lng1):
+            for tr in range(r0 // self.index_size, r1 // self.index_size + 1):
+                for tc in range(c0 // self.index_size,
+                                c1 // self.index_size + 1):
+                    tile = self.index_tile(block_r, block_c,
+                                           tr * self.index_size,
+                                           tc * self.index_size)
+                    lowest = min(lowest, self.index_min[tile])
+                    highest = max(highest, self.index_max[tile])
+
+        return lowest, highest
+
+    cdef list box_cells(self, double lat0, double lng0,
+                        double lat1, double lng1):
+        """The cells of each chunk covering a box, as a list of tuples
+        ``(chunk_row, chunk_col, first_row, last_row, first_col, last_col)``.
+
+        The box spans latitudes `lat0` to `lat1`, and longitudes east from
+        `lng0` to `lng1`. The rows and columns that chunks share with their
+        neighbours are included in both.
+        """
+        cdef double y0, x0, y1, x1
+        cdef long row0, row1, col0, col1, block_r, abs_c
+
+        if not (self.in_range(lat0, lng0) and self.in_range(lat1, lng1)):
+            raise ValueError("Bad box {0}, {1} to {2}, {3}"
+                             .format(lat0, lng0, lat1, lng1))
+
+        self.position(max(lat0, lat1), lng0, &y0, &x0)
+        self.position(min(lat0, lat1), lng1, &y1, &x1)
+        row0 = <long> floor(y0)
+        row1 = min(<long> ceil(y1), self.n_rows)
+        col0 = <long> floor(x0)
+        col1 = <long> ceil(x1)
+        if x1 < x0:
+            col1 += self.n_cols
+        if col1 - col0 >= self.n_cols:
+            col0, col1 = 0, self.n_cols - 1
+
+        cells = []
+        for block_r in range(row0 // self.block_rows,
+                             min(row1 // self.block_rows, CHUNK_ROWS - 1) + 1):
+            for abs_c in range(col0 // self.block_cols,
+                               col1 // self.block_cols + 1):
+                cells.append((
+                    block_r, abs_c % CHUNK_COLS,
+                    max(row0 - block_r * self.block_rows, 0),
+                    min(row1 - block_r * self.block_rows, self.block_rows),
+                    max(col0 - abs_c * self.block_cols, 0),
+                    min(col1 - abs_c * self.block_cols, self.block_cols)))
+        return cells
+
+    cdef list chunk_ranges(self, long block_r, long block_c,
+                           long r0, long r1, long c0, long c1):
+        """Byte ranges of the mapped file holding some cells of a chunk.
+
+        For a split dataset, the ranges are relative to the chunk's first
+        cell.
+        """
+        cdef long chunk_rows = self.block_rows + 1
+        cdef long chunk_cols = self.block_cols + 1
+        cdef long row, tr, tc, tile
+
+        if self.storage in (LAYOUT_RAW, LAYOUT_SPLIT):
+            base = 0
+            if self.storage == LAYOUT_RAW:
+                base = (block_r * CHUNK_COLS + block_c) * chunk_rows * chunk_cols
+            return [(2 * (base + row * chunk_cols + c0), 2 * (c1 - c0 + 1))
+                    for row in range(r0, r1 + 1)]
+
+        ranges = []
+        for tr in range(r0 // self.tile_size, r1 // self.tile_size + 1):
+            for tc in range(c0 // self.tile_size, c1 // self.tile_size + 1):
+                tile = (((block_r * CHUNK_COLS + block_c) * self.tile_rows + tr)
+                        * self.tile_cols + tc)
+                if self.storage == LAYOUT_TILED:
+                    ranges.append((2 * self.tile_offsets[tile],
+                                   2 * self.tile_size * self.tile_size))
+                elif not self.tile_constant[tile]:
+                    ranges.append(self.tile_table[tile])
+        return ranges
+
+    cdef list mapped_ranges(self, long block_r, long block_c,
+                            long r0, long r1, long c0, long c1):
+        """Addresses and lengths of the memory holding some cells of a chunk,
+        mapping the chunk of a split dataset if need be. Missing chunks of a
+        split dataset have none.
+        """
+        cdef const unsigned char[:] compressed
+        cdef size_t base, size
+        cdef long block = block_r * CHUNK_COLS + block_c
+
+        if self.storage == LAYOUT_RAW:
+            base = <size_t> &self.data[0, 0, 0, 0]
+            size = 2 * self.data.size
+        elif self.storage == LAYOUT_TILED:
+            base = <size_t> &self.tiled[0]
+            size = 2 * self.tiled.shape[0]
+        elif self.storage == LAYOUT_COMPRESSED:
+            compressed = self.compressed
+            base = <size_t> &compressed[0]
+            size = compressed.shape[0]
+        else:
+            if not self.chunk_present(block):
+                return []
+            base = <size_t> self.chunk_cells[block]
+            size = 2 * (self.block_rows + 1) * (self.block_cols + 1)
+
+        return [(base + start, min(length, size - start))
+                for start, length in self.chunk_ranges(block_r, block_c,
+                                                       r0, r1, c0, c1)]
+
+    cdef list region_pages(self, region):
+        """Page-aligned address ranges ``[start, end)`` of the memory holding
+        a region (see :meth:`advise`), sorted and merged.
+
+        """
+        cdef const unsigned char[:] compressed
+        cdef size_t base, size
+
+        if region is None and self.storage != LAYOUT_SPLIT:
+            if self.storage == LAYOUT_RAW:
+                base = <size_t> &self.data[0, 0, 0, 0]
+                size = 2 * self.data.size
+            elif self.storage == LAYOUT_TILED:
+                base = <size_t> &self.tiled[0]
+                size = 2 * self.tiled.shape[0]
+            else:
+                compressed = self.compressed
+                base = <size_t> &compressed[0]
+                size = compressed.shape[0]
+            ranges = [(base, size)]
+        elif region is None:
+            # Each whole chunk of a split dataset is a single run
+            ranges = []
+            size = 2 * (self.block_rows + 1) * (self.block_cols + 1)
+            for block in range(N_CHUNKS):
+                if self.chunk_present(block):
+                    ranges.append((<size_t> self.chunk_cells[block], size))
+        elif len(region) == 2:
+            block_r, block_c = region
+            if not (0 <= block_r < CHUNK_ROWS and 0 <= block_c < CHUNK_COLS):
+                raise ValueError("Bad chunk {0}".format(region))
+            ranges = self.mapped_ranges(block_r, block_c, 0, self.block_rows,
+                                        0, self.block_cols)
+        elif len(region) == 4:
+            lat0, lng0, lat1, lng1 = region
+            ranges = []
+            for block_r, block_c, r0, r1, c0, c1 in self.box_cells(
+                    lat0, lng0, lat1, lng1):
+                ranges.extend(self.mapped_ranges(block_r, block_c,
+                                                 r0, r1, c0, c1))
+        else:
+            raise ValueError("Bad region {0!r}".format(region))
+
+        pages = []
+        last = None
+        for start, length in sorted(ranges):
+            if length <= 0:
+                continue
+            end = start + length
+            start -= start % mmap.PAGESIZE
+            end += -end % mmap.PAGESIZE
+            if last is not None and start <= last[1]:
+                last[1] = max(last[1], end)
+            else:
+                last = [start, end]
+                pages.append(last)
+        return pages
+
+    def advise(self, advice, region=None):
+        """Tell the kernel how a region of the dataset will be accessed.
+
+        `advice` is one of "normal", "random" (disable readahead, which
+        suits scattered single-point lookups), "sequential", "willneed"
+        (start reading the region in the background) or "dontneed".
+
+        `region` is None for the whole dataset, a pair ``(chunk_row,
+        chunk_col)`` for a chunk, or a box ``(lat0, lng0, lat1, lng1)`` as
+        for :meth:`elevation_range`. Only the parts of the file holding the
+        region are affected: whole rows of a chunk are not needed for a box
+        in the original layout, constant tiles of a compressed dataset are
+        not stored, and missing chunks of a split dataset are skipped.
+        """
+        cdef size_t start, end
+        cdef int err
+
+        try:
+            flag = access_advice[advice]
+        except KeyError:
+            raise ValueError("Unknown access advice {0!r}".format(advice))
+
+        for start, end in self.region_pages(region):
+            err = posix_madvise(<void *> start, end - start, flag)
+            if err:
+                raise OSError(err, os.strerror(err))
+
+    def warm(self, region=None):
+        """Read a region of the dataset into memory now, so that later
+        lookups don't fault. Returns the number of bytes touched.
+
+        The kernel is asked to read the region ahead, then every page is
+        touched. `region` is as for :meth:`advise`.
+        """
+        global _prefault_sink
+        cdef size_t address, start, end, total = 0
+        cdef size_t page = mmap.PAGESIZE
+        cdef unsigned long sink = 0
+
+        for start, end in self.region_pages(region):
+            posix_madvise(<void *> start, end - start, POSIX_MADV_WILLNEED)
+            with nogil:
+                address = start
+                while address < end:
+                    sink += (<const char *> address)[0]
+                    address += page
+            total += end - start
+
+        _prefault_sink += sink
+        return total
+
+    def lock(self, region=None):
+        """Lock a region of the dataset into memory, so that it is never
+        paged out. `region` is as for :meth:`advise`.
+
+        Locking needs enough ``RLIMIT_MEMLOCK`` (see ``ulimit -l``) or
+        ``CAP_IPC_LOCK``; OSError is raised if it fails.
+        """
+        cdef size_t start, end
+
+        for start, end in self.region_pages(region):
+            if mlock(<void *> start, end - start):
+                raise OSError(errno, os.strerror(errno))
+
+    def unlock(self, region=None):
+        """Undo :meth:`lock` for a region of the dataset."""
+        cdef size_t start, end
+
+        for start, end in self.region_pages(region):
+            if munlock(<void *> start, end - start):
+                raise OSError(errno, os.strerror(errno))
+
+    def resident(self, region=None):
+        """How much of a region of the dataset is in the page cache, as a
+        pair ``(resident_bytes, total_bytes)`` of the pages holding it.
+        `region` is as for :meth:`advise`.
+        """
+        cdef size_t start, end
+        cdef size_t page = mmap.PAGESIZE
+        cdef Py_ssize_t k, resident = 0, total = 0
+        cdef unsigned char[:] vec_v
+
+        for start, end in self.region_pages(region):
+            vec = bytearray((end - start) // page)
+            vec_v = vec
+            if mincore(<void *> start, end - start, &vec_v[0]):
+                raise OSError(errno, os.strerror(errno))
+            for k in range(vec_v.shape[0]):
+                resident += vec_v[k] & 1
+            total += vec_v.shape[0]
+
+        return resident * page, total * page
+
+    def tile_residency(self, long tile_size=256):
+        """Fraction of the pages holding each tile of the dataset that are in
+        the page cache, as an ``array.array('d')``.
+
+        Tiles are `tile_size` cells square and are in the same order as those
+        of an index (by chunk, tile row and tile column), whatever the layout
+        of the dataset. Constant tiles of a compressed dataset and missing
+        chunks of a split dataset are not stored and so count as resident.
+        """
+        cdef size_t base, end, offset, page = mmap.PAGESIZE
+        cdef unsigned char[:] vec_v
+        cdef double[:] out_v
+        cdef long tile_rows, tile_cols, block, tr, tc, r0, r1, c0, c1, row
+        cdef long chunk_rows = self.block_rows + 1
+        cdef long chunk_cols = self.block_cols + 1
+        cdef long p, p0, p1, last, resident, total, k = 0
+        cdef bint present = True
+
+        if tile_size < 1:
+            raise ValueError("Bad tile size {0}".format(tile_size))
+        if self.storage != LAYOUT_SPLIT:
+            # One map of the whole file
+            (base, end), = self.region_pages(None)
+            vec_v = self.page_residency(base, end)
+
+        tile_rows, tile_cols = tile_grid((chunk_cols, chunk_rows), tile_size)
+        out = array.clone(_double_template,
+                          CHUNK_ROWS * CHUNK_COLS * tile_rows * tile_cols,
+                          zero=True)
+        out_v = out
+
+        for block in range(CHUNK_ROWS * CHUNK_COLS):
+            # Offset in the map of the first cell of the chunk, if it is raw
+            offset = 0
+            if self.storage == LAYOUT_RAW:
+                offset = 2 * block * chunk_rows * chunk_cols
+            elif self.storage == LAYOUT_SPLIT:
+                # A map for each chunk, whose first cell may not be at the
+                # start of a page
+                present = self.chunk_present(block)
+                if present:
+                    offset = <size_t> self.chunk_cells[block] % page
+                    base = <size_t> self.chunk_cells[block] - offset
+                    end = base + offset + 2 * chunk_rows * chunk_cols
+                    end += -end % page
+                    vec_v = self.page_residency(base, end)
+
+            for tr in range(tile_rows):
+                r0 = tr * tile_size
+                r1 = min(r0 + tile_size, chunk_rows) - 1
+                for tc in range(tile_cols):
+                    c0 = tc * tile_size
+                    c1 = min(c0 + tile_size, chunk_cols) - 1
+
+                    resident = total = 0
+                    if not present:
+                        pass
+                    elif self.storage in (LAYOUT_RAW, LAYOUT_SPLIT):
+                        # Each row of the tile is a separate run of cells
+                        last = -1
+                        for row in range(r0, r1 + 1):
+                            p0 = (offset + 2 * (row * chunk_cols + c0)) // page
+                            p1 = (offset + 2 * (row * chunk_cols + c1)) // page
+                            for p in range(max(p0, last + 1), p1 + 1):
+                                resident += vec_v[p] & 1
+                                total += 1
+                            last = p1
+                    else:
+                        for start, length in self.chunk_ranges(
+                                block // CHUNK_COLS, block % CHUNK_COLS,
+                                r0, r1, c0, c1):
+                            for p in range(start // page,
+                                           (start + length - 1) // page + 1):
+                                resident += vec_v[p] & 1
+                                total += 1
+
+                    out_v[k] = resident / <double> total if total else 1
+                    k += 1
+
+        return out
+
+    cdef unsigned char[:] page_residency(self, size_t start, size_t end):
+        """mincore() of the page-aligned range of memory [start, end)."""
+        cdef unsigned char[:] vec_v = bytearray((end - start) // mmap.PAGESIZE)
+        if mincore(<void *> start, end - start, &vec_v[0]):
+            raise OSError(errno, os.strerror(errno))
+        return vec_v
 
-        i_f = 90 - lat
-        j_f = (lng + 180) % 360
+    def count_accesses(self, long every=100, long tile_size=256):
+        """Count a sample of lookups in each tile of the dataset.
 
-        cdef int i, j
+        One in `every` point lookups and interpolations is counted against
+        the tile holding it. Tiles are `tile_size` cells square, in the same
+        order as :meth:`tile_residency`. Counting starts afresh from zero;
+        `every` of zero stops it.
+        """
+        if every < 0 or tile_size < 1:
+            raise ValueError("Bad sampling of 1 in {0} with tiles of {1}"
+                             .format(every, tile_size))
+        if every == 0:
+            self.access_every = 0
+            return
 
-        i = <int> round(i_f * self.lat_resolution)
-        j = <int> round(j_f * self.lng_resolution)
+        self.access_size = tile_size
+        self.access_rows, self.access_cols = tile_grid(
+            (self.block_cols + 1, self.block_rows + 1), tile_size)
+        self.access_tiles = array.array('I', [0]) * (
+            CHUNK_ROWS * CHUNK_COLS * self.access_rows * self.access_cols)
+        self.access_counts_v = self.access_tiles
+        self.access_countdown = self.access_every = every
 
-        return self.get_cell(i, j)
+    property access_counts:
+        """Sampled lookup counts, as a dict of the sampling interval
+        (``every``), ``tile_size`` and the ``counts`` of each tile, or None
+        if counting was never started.
+        """
+        def __get__(self):
+            if self.access_tiles is None:
+                return None
+            return dict(every=self.access_every, tile_size=self.access_size,
+                        counts=array.array('I', self.access_tiles))
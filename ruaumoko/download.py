@@ -22,7 +22,7 @@ Usage:
     ruaumoko-download (-h | --help)
     ruaumoko-download [(-v | --verbose)] [--host HOSTNAME] [--chunks CHUNKS]
         [--chunk-file-prefix PREFIX] [--split-chunks] [--expect-resolution WxH]
-        [<dataset-location>]
+        [--jobs N] [--work-dir DIR] [--resume | --verify] [<dataset-location>]
 
 Options:
     -h, --help                      Print a brief usage summary.
@@ -42,11 +42,35 @@ Advanced options:
                                     server. See below.
     --expect-resolution WxH         Expect tiles to have width W and height H.
                                     [default: {default_res[0]}x{default_res[1]}]
+    -j, --jobs N                    Number of chunks to fetch and convert at
+                                    once. [default: {default_jobs}]
+    --work-dir DIR                  Directory for partial downloads. If unset,
+                                    a temporary directory is used.
 
     Specific chunks are specified as a comma-separated list of chunk ids. For
     example, the option "--chunks A,G,H" will fetch only chunks A, G and H from
     the server.
 
+    Chunks are fetched in parallel and streamed to disk. Each TIFF is decoded
+    straight into its place in the dataset, so chunks may complete in any
+    order. If a transfer is interrupted it is resumed with an HTTP Range
+    request. Partial downloads left in the --work-dir of an earlier, failed run
+    are resumed in the same way.
+
+Options for incremental downloads:
+    --resume                        Only fetch chunks which are not recorded in
+                                    the manifest or whose data is missing.
+    --verify                        As --resume, but also hash the data of
+                                    every recorded chunk, and fetch again any
+                                    chunk whose hash doesn't match.
+
+    A manifest is written next to the dataset, named after it with the suffix
+    ".manifest". It records the source URL, size and {hash_name} hash of each
+    chunk, and is updated as each chunk completes. Chunks fetched by --resume
+    or --verify are rewritten in place; the rest of the dataset is untouched.
+    Any index or overviews of the dataset are removed before chunks are
+    written, as they would no longer match; rebuild them afterwards.
+
 Options for saving individual chunks:
     --split-chunks                  If specified, save each chunk to its own file.
 
@@ -60,19 +84,20 @@ Options for saving individual chunks:
 
 from __future__ import print_function
 
-import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
 import logging
 import os
 import shutil
 import sys
-import tempfile
 import zipfile
 
 from docopt import docopt
 import requests
-from sh import convert
-
 from . import Dataset
+from .dataset import manifest_path, index_path, overview_path
+from .tiff import decode_chunk
 from ._compat import TemporaryDirectory, urlunsplit
 
 # Logger for the main utility
@@ -80,6 +105,16 @@ LOG = logging.getLogger(os.path.basename(sys.argv[0]))
 
 # Defaults
 DEFAULT_HOST = 'www.viewfinderpanoramas.org'
+DEFAULT_JOBS = 4
+
+# Download tuning
+STREAM_CHUNK_SIZE = 1 << 16
+MAX_ATTEMPTS = 5
+
+# Manifests
+MANIFEST_VERSION = 1
+MANIFEST_HASH = 'sha256'
+HASH_READ_SIZE = 1 << 22
 
 # Filename patterns
 TIFF_PATTERN = '15-<CHUNK>.tif'
@@ -91,6 +126,8 @@ __doc__ = __doc__.format(
     default_location = Dataset.default_location,
     default_host = DEFAULT_HOST,
     default_res = Dataset.default_res,
+    default_jobs = DEFAULT_JOBS,
+    hash_name = MANIFEST_HASH.upper(),
 )
 
 def char_range(frm, to):
@@ -106,78 +143,312 @@ def expand_pattern(pattern, **kwargs):
         pattern = pattern.replace('<'+k+'>', v)
     return pattern
 
-def download(target, temp_dir, host=DEFAULT_HOST, path=DEM_PATH,
-        zip_pattern=ZIP_PATTERN, tiff_pattern=TIFF_PATTERN, chunks=None,
-        chunk_prefix=None, chunk_directory=None, expect_res=Dataset.default_res):
-    tgt_path = os.path.join(temp_dir, "chunk")
+def fetch(url, part_path, attempts=MAX_ATTEMPTS):
+    """Stream *url* to *part_path*, resuming any partial download.
 
-    # Expected raw data size is 2-bytes (16-bits) per pixel
-    expect_size = expect_res[0] * expect_res[1] * 2
+    If *part_path* already exists the request asks only for the bytes after
+    it. Servers which ignore the Range header send the whole file again, in
+    which case the partial file is discarded. Interrupted transfers are
+    resumed up to *attempts* times.
 
-    chunks = chunks or CHUNKS
-    LOG.info('Fetching the following chunks: {0}'.format(','.join(chunks)))
+    """
+    for attempt in range(attempts):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
 
-    for chunk_idx, chunk in enumerate(chunks):
-        LOG.info('Fetching chunk {0}/{1}'.format(chunk_idx+1, len(chunks)))
-
-        tif_name = expand_pattern(tiff_pattern, CHUNK=chunk)
-        tif_path = os.path.join(temp_dir, tif_name)
-
-        url = urlunsplit((
-            'http', host, '/'.join((path, expand_pattern(zip_pattern, CHUNK=chunk))), '', ''
-        ))
-        LOG.info('GET-ing {0}'.format(url))
-        resp = requests.get(url)
-
-        if resp.status_code != 200:
-            LOG.error('Error fetching DEM: {0}'.format(resp.status_code))
-            raise RuntimeError('Error fetching DEM. (HTTP {0} error.)'.format(resp.status_code))
-
-        # Open downloaded content as a file object
-        content_fobj = io.BytesIO(resp.content)
-
-        # Open content as zip
-        with zipfile.ZipFile(content_fobj, 'r') as pack:
-            # Extract TIFF
+        LOG.info('GET-ing {0} from byte {1}'.format(url, offset))
+        try:
+            resp = requests.get(url, headers=headers, stream=True)
             try:
-                tiff_info = pack.getinfo(tif_name)
-            except KeyError:
-                # TODO: Decide if this should be a fatal error
-                LOG.error('DEM zip does not contain expected file {0}'.format(tif_name))
-                LOG.error('DEM zip contains: {0}'.format(pack.namelist()))
-                raise RuntimeError('Error fetching DEM. (Bad zip file.)')
-
-            tiff_fobj = pack.open(tiff_info)
-            with open(tif_path, 'wb') as out_fobj:
-                shutil.copyfileobj(tiff_fobj, out_fobj)
-
-        # Saving individual chunks
-        if chunk_directory is not None:
-            if chunk_prefix is not None:
-                # Use chunk prefix to calculate filename
-                chunk_filename = os.path.join(chunk_directory,
-                    chunk_prefix + '{0:02d}'.format(chunk_idx) + '.tiff')
+                if resp.status_code == 206:
+                    mode = 'ab'
+                elif resp.status_code == 200:
+                    mode = 'wb'
+                elif resp.status_code == 416 and offset:
+                    # Either we already have the whole file or our partial
+                    # file is no use to this server.
+                    content_range = resp.headers.get('Content-Range', '')
+                    if content_range == 'bytes */{0}'.format(offset):
+                        return
+                    LOG.warning('Discarding partial download of {0}'.format(url))
+                    os.unlink(part_path)
+                    continue
+                else:
+                    LOG.error('Error fetching DEM: {0}'.format(resp.status_code))
+                    raise RuntimeError('Error fetching DEM. (HTTP {0} error.)'.format(
+                        resp.status_code))
+
+                with open(part_path, mode) as part:
+                    for block in resp.iter_content(STREAM_CHUNK_SIZE):
+                        part.write(block)
+            finally:
+                resp.close()
+        except requests.RequestException as e:
+            LOG.warning('Transfer of {0} interrupted: {1}'.format(url, e))
+            continue
+
+        return
+
+    raise RuntimeError('Error fetching DEM. (Gave up on {0} after {1} attempts.)'.format(
+        url, attempts))
+
+def extract(zip_path, member, dst_path):
+    """Extract *member* from the zip at *zip_path* to *dst_path*."""
+    with zipfile.ZipFile(zip_path, 'r') as pack:
+        try:
+            info = pack.getinfo(member)
+        except KeyError:
+            # TODO: Decide if this should be a fatal error
+            LOG.error('DEM zip does not contain expected file {0}'.format(member))
+            LOG.error('DEM zip contains: {0}'.format(pack.namelist()))
+            raise RuntimeError('Error fetching DEM. (Bad zip file.)')
+
+        with pack.open(info) as src, open(dst_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+
+def read_manifest(path, expect_res):
+    """Return the chunk entries of the manifest at *path*.
+
+    Missing manifests, and manifests for a different resolution, are treated
+    as empty.
+
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        LOG.warning('Ignoring unreadable manifest {0}'.format(path))
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION or \
+            manifest.get('hash') != MANIFEST_HASH or \
+            tuple(manifest.get('resolution', ())) != tuple(expect_res):
+        LOG.warning('Ignoring incompatible manifest {0}'.format(path))
+        return {}
+    return manifest['chunks']
+
+def write_manifest(path, expect_res, entries):
+    """Atomically replace the manifest at *path*."""
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'hash': MANIFEST_HASH,
+        'resolution': list(expect_res),
+        'chunks': entries,
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def hash_range(filename, offset=0, size=None):
+    """Hex digest of *size* bytes of *filename* from *offset*, or of the rest
+    of the file if *size* is None."""
+    digest = hashlib.new(MANIFEST_HASH)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while size is None or size > 0:
+            block = f.read(HASH_READ_SIZE if size is None
+                    else min(size, HASH_READ_SIZE))
+            if not block:
+                break
+            digest.update(block)
+            if size is not None:
+                size -= len(block)
+    return digest.hexdigest()
+
+def stale_chunks(location, chunks, expect_res, split=False, verify=False,
+        jobs=DEFAULT_JOBS):
+    """Which of *chunks* need to be fetched again to complete the dataset at
+    *location*.
+
+    A chunk is stale if the manifest doesn't record it or its data is
+    missing. With *verify*, chunks whose data doesn't match the recorded hash
+    are stale too. Hashes are computed in parallel, *jobs* chunks at a time.
+
+    """
+    entries = read_manifest(manifest_path(location), expect_res)
+    expect_size = expect_res[0] * expect_res[1] * 2
+
+    stale = []
+    to_hash = []
+    for chunk_idx, chunk in enumerate(chunks):
+        entry = entries.get(chunk)
+        if entry is None:
+            LOG.info('Chunk {0} is not in the manifest'.format(chunk))
+            stale.append(chunk)
+            continue
+
+        if split:
+            filename = os.path.join(location, entry.get('file', ''))
+            offset = 0
+            present = os.path.isfile(filename) and \
+                    os.path.getsize(filename) == entry['size']
+        else:
+            filename = location
+            offset = chunk_idx * expect_size
+            present = entry.get('offset') == offset and \
+                    entry['size'] == expect_size and \
+                    os.path.isfile(filename) and \
+                    os.path.getsize(filename) >= offset + expect_size
+
+        if not present:
+            LOG.info('Data for chunk {0} is missing'.format(chunk))
+            stale.append(chunk)
+        elif verify:
+            to_hash.append((chunk, filename, offset, entry))
+
+    # hashlib releases the GIL for large updates, so threads suffice
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = dict(
+            (executor.submit(hash_range, filename, offset, entry['size']),
+                (chunk, entry))
+            for chunk, filename, offset, entry in to_hash
+        )
+        for future in as_completed(futures):
+            chunk, entry = futures[future]
+            if future.result() != entry[MANIFEST_HASH]:
+                LOG.warning('Chunk {0} is corrupt'.format(chunk))
+                stale.append(chunk)
             else:
-                # Use original filename
-                chunk_filename = os.path.join(chunk_directory, tif_name)
-            with open(chunk_filename, "wb") as dst, open(tif_path, "rb") as src:
-                shutil.copyfileobj(src, dst)
+                LOG.info('Chunk {0} is OK'.format(chunk))
+
+    return [chunk for chunk in chunks if chunk in stale]
+
+def remove_derived(location):
+    """Remove the index and overviews of the dataset at *location*, which
+    would describe the old data of chunks about to be rewritten."""
+    location = location.rstrip(os.sep)
+    paths = [index_path(location)]
+    level = 1
+    while os.path.exists(overview_path(location, level)):
+        paths.append(overview_path(location, level))
+        level += 1
+    for path in paths:
+        if os.path.exists(path):
+            LOG.info('Removing "{0}"; rebuild it once the download is '
+                     'complete'.format(path))
+            os.unlink(path)
+
+def download_chunk(chunk_idx, chunk, target, temp_dir, host, path,
+        zip_pattern, tiff_pattern, chunk_prefix, chunk_directory, expect_res):
+    """Fetch, unpack and store a single chunk.
+
+    The decoded data is written to the place of chunk *chunk_idx* in
+    *target*. Returns the chunk's manifest entry, describing the data in
+    *target* if given, otherwise the file in *chunk_directory*.
+
+    """
+    zip_name = expand_pattern(zip_pattern, CHUNK=chunk)
+    tif_name = expand_pattern(tiff_pattern, CHUNK=chunk)
+    part_path = os.path.join(temp_dir, zip_name + '.part')
+    tif_path = os.path.join(temp_dir, tif_name)
+
+    url = urlunsplit(('http', host, '/'.join((path, zip_name)), '', ''))
+    fetch(url, part_path)
+    entry = {'url': url, 'source_size': os.path.getsize(part_path)}
+
+    try:
+        extract(part_path, tif_name, tif_path)
+    except zipfile.BadZipfile:
+        # Don't try to resume a corrupt download next time
+        os.unlink(part_path)
+        raise RuntimeError('Error fetching DEM. (Corrupt zip file {0}.)'.format(zip_name))
+    os.unlink(part_path)
+
+    # Saving individual chunks
+    if chunk_directory is not None:
+        if chunk_prefix is not None:
+            # Use chunk prefix to calculate filename
+            chunk_basename = chunk_prefix + '{0:02d}'.format(chunk_idx) + '.tiff'
+        else:
+            # Use original filename
+            chunk_basename = tif_name
+        chunk_filename = os.path.join(chunk_directory, chunk_basename)
+        shutil.copyfile(tif_path, chunk_filename)
+        entry.update({
+            'file': chunk_basename,
+            'size': os.path.getsize(chunk_filename),
+            MANIFEST_HASH: hash_range(chunk_filename),
+        })
+
+    # Decoding the chunk into place in the single file
+    if target is not None:
+        expect_size = expect_res[0] * expect_res[1] * 2
+        digest = hashlib.new(MANIFEST_HASH)
+        try:
+            decode_chunk(tif_path, target, chunk_idx, expect_res, digest)
+        except ValueError as e:
+            raise ValueError("Bad TIFF for chunk {0}: {1}".format(chunk, e))
+        entry.update({
+            'offset': chunk_idx * expect_size,
+            'size': expect_size,
+            MANIFEST_HASH: digest.hexdigest(),
+        })
+        entry.pop('file', None)
+
+    os.unlink(tif_path)
+    return entry
 
-        # Concatenation of chunks
-        if target is not None:
-            convert(tif_path, '-quiet', 'GRAY:{}'.format(tgt_path))
+def download(target, temp_dir, host=DEFAULT_HOST, path=DEM_PATH,
+        zip_pattern=ZIP_PATTERN, tiff_pattern=TIFF_PATTERN, chunks=None,
+        chunk_prefix=None, chunk_directory=None, expect_res=Dataset.default_res,
+        jobs=DEFAULT_JOBS, only=None, manifest=None):
+    """Download *chunks* to *target* and/or *chunk_directory*.
 
-            target_size = os.stat(tgt_path).st_size
-            if target_size != expect_size:
-                raise ValueError("Bad converted size {1} in chunk {0} (expected {2})".format(
-                    chunk, target_size, expect_size))
+    *target*, if not None, is a file object open for writing. Chunk i is
+    written at its own offset, so up to *jobs* chunks are processed at once
+    and may finish in any order. Partial downloads are kept in *temp_dir* and
+    resumed if found there.
 
-            with open(tgt_path, "rb") as f:
-                shutil.copyfileobj(f, target)
+    If *only* is given, just those of *chunks* are fetched and the rest of
+    the dataset is left alone. If *manifest* is given, the manifest at that
+    path is updated as each chunk completes; unless *only* is given, it is
+    started afresh.
 
-            os.unlink(tgt_path)
+    """
+    # Expected raw data size is 2-bytes (16-bits) per pixel
+    expect_size = expect_res[0] * expect_res[1] * 2
 
-        os.unlink(tif_path)
+    chunks = chunks or CHUNKS
+    fetching = [(chunk_idx, chunk) for chunk_idx, chunk in enumerate(chunks)
+                if only is None or chunk in only]
+    LOG.info('Fetching the following chunks: {0}'.format(
+        ','.join(chunk for _, chunk in fetching)))
+
+    entries = {}
+    if manifest is not None and only is not None:
+        entries = dict(
+            (chunk, entry)
+            for chunk, entry in read_manifest(manifest, expect_res).items()
+            if chunk in chunks and chunk not in only
+        )
+
+    if target is not None:
+        # Size the file up front so that chunks can land in any order
+        target.truncate(len(chunks) * expect_size)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = dict(
+            (executor.submit(download_chunk, chunk_idx, chunk, target,
+                temp_dir, host, path, zip_pattern, tiff_pattern,
+                chunk_prefix, chunk_directory, expect_res), chunk)
+            for chunk_idx, chunk in fetching
+        )
+
+        try:
+            for done, future in enumerate(as_completed(futures)):
+                chunk = futures[future]
+                entries[chunk] = future.result()
+                LOG.info('Fetched chunk {0} ({1}/{2})'.format(
+                    chunk, done+1, len(fetching)))
+                if manifest is not None:
+                    write_manifest(manifest, expect_res, entries)
+        except:
+            for future in futures:
+                future.cancel()
+            raise
 
 def main():
     opts = docopt(__doc__)
@@ -201,26 +472,62 @@ def main():
             expect_res_string))
         return 1 # Error
 
+    try:
+        jobs = int(opts['--jobs'])
+    except ValueError:
+        LOG.error('Invalid number of jobs: {0}'.format(opts['--jobs']))
+        return 1 # Error
+
+    chunks = opts['--chunks']
+    if chunks is not None:
+        chunks = chunks.split(',')
+
+    if opts['--work-dir'] is not None:
+        work_dir = opts['--work-dir']
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+    else:
+        work_dir = None
+
+    incremental = opts['--resume'] or opts['--verify']
+    only = None
+    if incremental:
+        only = stale_chunks(target, chunks or CHUNKS, expect_res,
+                split=opts['--split-chunks'], verify=opts['--verify'],
+                jobs=jobs)
+        if not only:
+            LOG.info('Dataset is complete; nothing to fetch')
+            return 0 # Success
+
+    remove_derived(target)
+
     with TemporaryDirectory() as temp_dir:
+        if work_dir is not None:
+            temp_dir = work_dir
+
         if opts['--split-chunks']:
             # Save chunks
             LOG.info('Saving data as multiple chunks in "{0}"'.format(target))
             target_f = None
             chunk_dir = target
         else:
-            # Save traditional format
+            # Save traditional format, keeping existing data when resuming
             LOG.info('Saving data as single file to "{0}"'.format(target))
-            target_f = open(target, "wb")
+            mode = "r+b" if incremental and os.path.exists(target) else "w+b"
+            target_f = open(target, mode)
             chunk_dir = None
 
         def do_download():
             download(
                 target_f, temp_dir,
                 host = opts['--host'],
-                chunks = opts['--chunks'],
+                chunks = chunks,
                 chunk_prefix = opts['--chunk-file-prefix'],
                 chunk_directory = chunk_dir,
                 expect_res = expect_res,
+                jobs = jobs,
+                only = only,
+                manifest = manifest_path(target),
             )
 
         if target_f is not None:
@@ -0,0 +1,138 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Build the index of a Ruaumoko dataset.
+
+Usage:
+    {me} (-h | --help)
+    {me} [(-v | --verbose)] [--tile-shape WxH] [--tile-size N] [<dataset>]
+
+Options:
+    -h, --help                  Show a brief usage summary.
+    -v, --verbose               Be verbose in logging progress.
+
+    --tile-shape WxH            Expected shape of chunks is W pixels wide and
+                                H pixels high. [default: {def_tile_shape[0]}x{def_tile_shape[1]}]
+
+    --tile-size N               Summarise the data in N by N tiles. [default: {def_tile_size}]
+
+    <dataset>                   Ruaumoko dataset to index, in either layout.
+                                [default: {def_ds_loc}]
+
+The index is written next to the dataset as "<dataset>.index" and holds the
+minimum and maximum elevation of each tile. Dataset loads it when opening the
+dataset, answers lookups in tiles of a single value (such as the ocean) from
+it, and uses it for range queries.
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import sys
+
+import docopt
+import numpy as np
+
+from . import Dataset
+from .asciiart import parse_shape
+from .dataset import (cell_shape, tile_grid, index_path, dataset_build,
+        INDEX_MAGIC, INDEX_VERSION, INDEX_HEADER)
+from .tiles import read_chunks
+
+DEFAULT_TILE_SIZE = 64
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_tile_shape = Dataset.default_res,
+    def_tile_size = DEFAULT_TILE_SIZE,
+    def_ds_loc = Dataset.default_location,
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+def chunk_range(chunk, tile_size):
+    """Minimum and maximum of each tile of a chunk, as two arrays of shape
+    (tile rows, tile columns)."""
+    tile_rows, tile_cols = tile_grid(chunk.shape[::-1], tile_size)
+    # Padding with the edge values doesn't change the extremes
+    padded = np.pad(chunk, ((0, tile_rows * tile_size - chunk.shape[0]),
+                            (0, tile_cols * tile_size - chunk.shape[1])),
+                    mode='edge')
+    tiles = padded.reshape(tile_rows, tile_size, tile_cols, tile_size)
+    return tiles.min(axis=(1, 3)), tiles.max(axis=(1, 3))
+
+def build_index(filename, expected_res=Dataset.default_res,
+        tile_size=DEFAULT_TILE_SIZE):
+    """Build the index of a dataset, returning its filename."""
+    filename = filename.rstrip(os.sep)
+    tile_rows, tile_cols = tile_grid(expected_res, tile_size)
+    shape = cell_shape + (tile_rows, tile_cols)
+    minima = np.empty(shape, dtype='<i2')
+    maxima = np.empty(shape, dtype='<i2')
+
+    # The index is only used with the build it was made from
+    build_id, _ = dataset_build(filename, expected_res)
+
+    for (chunk_r, chunk_c), chunk in read_chunks(filename, expected_res):
+        LOG.info('Indexing chunk {0}'.format(chunk_r * cell_shape[1] + chunk_c))
+        minima[chunk_r, chunk_c], maxima[chunk_r, chunk_c] = \
+                chunk_range(chunk, tile_size)
+
+    path = index_path(filename)
+    LOG.info('{0} of {1} tiles are constant'.format(
+        np.count_nonzero(minima == maxima), minima.size))
+    with open(path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, tile_size,
+            expected_res[0], expected_res[1], build_id.encode('ascii')))
+        f.write(minima.tobytes())
+        f.write(maxima.tobytes())
+
+    return path
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO if opts['--verbose'] else logging.WARN,
+        format='%(name)s:%(levelname)s: %(message)s'
+    )
+
+    try:
+        tile_res = parse_shape(opts['--tile-shape'], 'tile shape')
+    except ValueError:
+        return 1
+
+    try:
+        tile_size = int(opts['--tile-size'])
+        if tile_size < 1:
+            raise ValueError()
+    except ValueError:
+        LOG.error('Invalid tile size: {0}'.format(opts['--tile-size']))
+        return 1
+
+    ds_loc = opts['<dataset>'] or Dataset.default_location
+    build_index(ds_loc, tile_res, tile_size)
+    return 0 # success
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
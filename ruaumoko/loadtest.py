@@ -0,0 +1,453 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Load test the elevation API.
+
+Usage:
+    {me} (-h | --help)
+    {me} [(-v | --verbose)] [--url URL | --server MODE] [--workload NAME]
+        [--concurrency N] [--duration S | --requests N] [--warmup S]
+        [--batch N] [--binary] [--hot-fraction F] [--seed N] [--json]
+        [<log>...]
+
+Options:
+    -h, --help                  Show a brief usage summary.
+    -v, --verbose               Be verbose in logging progress.
+
+    --url URL                   Load test the API at URL, rather than starting
+                                a server.
+    --server MODE               Start the API in a child process, on a free
+                                port, to load test it. MODE is "threaded"
+                                (the Flask app, one thread per request) or
+                                "async" (ruaumoko-api-async, which needs
+                                uvicorn). Settings are read from the file
+                                named by RUAUMOKO_SETTINGS. [default: threaded]
+
+    --workload NAME             What to ask for: "uniform" (points spread over
+                                the globe), "hotspot" (mostly points around a
+                                few launch sites) or "replay" (the requests
+                                in the access logs given). [default: uniform]
+    -c, --concurrency N         Number of requests kept in flight. [default: {def_concurrency}]
+    -d, --duration S            Seconds to run for, after the warm-up.
+                                [default: {def_duration}]
+    -n, --requests N            Stop after N requests instead, after the
+                                warm-up.
+    --warmup S                  Seconds of requests sent first and not counted.
+                                [default: {def_warmup}]
+
+    --batch N                   Send N points per POST /batch request, rather
+                                than one point per GET. Not for "replay".
+    --binary                    Send batches as packed binary points.
+    --hot-fraction F            Fraction of "hotspot" points that are near a
+                                launch site. [default: {def_hot_fraction}]
+    --seed N                    Seed for choosing points. [default: 0]
+    --json                      Print the report as JSON.
+
+    <log>                       Access logs to replay, in the common or
+                                combined log format, or with a path per line.
+                                GET requests are replayed in order, over and
+                                over.
+
+Each of the --concurrency clients sends a request, waits for the response,
+and sends the next, over a connection that is kept open. The report gives
+the throughput and the 50th, 95th and 99th percentile and the largest
+latencies. Responses with status 400 or more count as errors.
+
+The clients are threads in this process, so at high concurrency they may
+limit the throughput themselves: the report includes the CPU time they used,
+and if it approaches the duration, the numbers describe the load tester
+rather than the server. Run it on another machine, or several copies at once.
+"""
+
+from __future__ import print_function, division
+
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import Counter
+
+import docopt
+import requests
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 10
+DEFAULT_WARMUP = 1
+DEFAULT_HOT_FRACTION = 0.9
+
+# Where balloons are launched from, and so where their landing sites are
+# predicted: (name, latitude, longitude in [0, 360))
+LAUNCH_SITES = [
+    ('Cambridge', 52.2135, 0.0964),
+    ('Boulder', 40.0150, 254.7295),
+    ('Spaceport America', 32.9903, 253.0310),
+    ('Esrange', 67.8933, 21.1067),
+    ('Woomera', -31.1998, 136.8326),
+]
+
+# Spread of points around a launch site, in degrees
+HOTSPOT_SPREAD = 0.5
+
+# A request in an access log
+LOG_REQUEST = re.compile(r'"(?P<method>[A-Z]+) (?P<path>\S+) HTTP/[0-9.]+"')
+
+# Longest wait for a server to start listening, in seconds
+SERVER_START_TIMEOUT = 30
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_concurrency = DEFAULT_CONCURRENCY,
+    def_duration = DEFAULT_DURATION,
+    def_warmup = DEFAULT_WARMUP,
+    def_hot_fraction = DEFAULT_HOT_FRACTION,
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+def uniform_point(rng):
+    """A point chosen uniformly over the sphere."""
+    return (math.degrees(math.asin(rng.uniform(-1, 1))),
+            rng.uniform(0, 360))
+
+def hotspot_point(rng, hot_fraction=DEFAULT_HOT_FRACTION):
+    """A point near a launch site, or anywhere at all."""
+    if rng.random() >= hot_fraction:
+        return uniform_point(rng)
+    _, lat, lng = rng.choice(LAUNCH_SITES)
+    lat = max(-90, min(90, rng.gauss(lat, HOTSPOT_SPREAD)))
+    return lat, rng.gauss(lng, HOTSPOT_SPREAD) % 360
+
+class PointWorkload(object):
+    """Requests for points chosen by `point(rng)`: one per GET, or
+    `batch` per POST /batch."""
+
+    def __init__(self, point, batch=None, binary=False):
+        self.point = point
+        self.batch = batch
+        self.binary = binary
+
+    def request(self, rng):
+        """A request, as ``(method, path, body, content type, points)``."""
+        if self.batch is None:
+            lat, lng = self.point(rng)
+            return 'GET', '/{0:.6f},{1:.6f}'.format(lat, lng), None, None, 1
+
+        points = [self.point(rng) for _ in range(self.batch)]
+        if self.binary:
+            body = b''.join(struct.pack('<dd', lat, lng)
+                            for lat, lng in points)
+            return ('POST', '/batch', body, 'application/octet-stream',
+                    self.batch)
+        body = json.dumps([list(p) for p in points]).encode('utf-8')
+        return 'POST', '/batch', body, 'application/json', self.batch
+
+def read_log(lines):
+    """Paths of the GET requests in the lines of an access log."""
+    paths = []
+    for line in lines:
+        match = LOG_REQUEST.search(line)
+        if match is not None:
+            if match.group('method') == 'GET':
+                paths.append(match.group('path'))
+        elif line.startswith('/'):
+            paths.append(line.split()[0])
+    return paths
+
+class ReplayWorkload(object):
+    """The GET requests from access logs, in order, over and over, shared
+    between the clients."""
+
+    def __init__(self, paths):
+        if not paths:
+            raise ValueError('No GET requests to replay')
+        self.paths = paths
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def request(self, rng):
+        with self.lock:
+            path = self.paths[self.next]
+            self.next = (self.next + 1) % len(self.paths)
+        # Points in a batch can't be told from the path
+        points = 0 if path.startswith('/batch') else 1
+        return 'GET', path, None, None, points
+
+def percentile(values, p):
+    """The `p`th percentile of sorted `values`, by the nearest rank."""
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def client(url, workload, rng, results, started, deadline, warmup_end,
+        remaining):
+    """Send requests one after the other until the deadline passes or no
+    requests remain, appending ``(latency, status, points)`` for those
+    after the warm-up to `results`."""
+    session = requests.Session()
+    started.wait()
+    while clock() < deadline:
+        counted = clock() >= warmup_end
+        if counted and remaining is not None:
+            with remaining['lock']:
+                if remaining['count'] <= 0:
+                    break
+                remaining['count'] -= 1
+
+        method, path, body, content_type, points = workload.request(rng)
+        headers = {'Content-Type': content_type} if content_type else {}
+        start = clock()
+        try:
+            response = session.request(method, url + path, data=body,
+                                       headers=headers, allow_redirects=False)
+            response.content
+            status = response.status_code
+        except requests.RequestException as e:
+            LOG.debug('Request failed: {0}'.format(e))
+            status = 'failed'
+        latency = clock() - start
+
+        if counted:
+            results.append((latency, status, points))
+
+def run(url, workload, concurrency=DEFAULT_CONCURRENCY,
+        duration=DEFAULT_DURATION, n_requests=None, warmup=DEFAULT_WARMUP,
+        seed=0):
+    """Load test the API at `url`, returning a report as a dictionary that
+    may be serialised as JSON.
+
+    The test runs for `duration` seconds after `warmup` seconds, or if
+    `n_requests` is given, until that many requests have been sent after
+    the warm-up.
+    """
+    url = url.rstrip('/')
+    results = []
+    started = threading.Event()
+    remaining = None
+    if n_requests is not None:
+        remaining = {'count': n_requests, 'lock': threading.Lock()}
+
+    start = clock()
+    warmup_end = start + warmup
+    deadline = float('inf') if n_requests is not None \
+            else warmup_end + duration
+    threads = [threading.Thread(target=client,
+                                args=(url, workload,
+                                      random.Random('{0}-{1}'.format(seed, k)),
+                                      results, started, deadline, warmup_end,
+                                      remaining))
+               for k in range(concurrency)]
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    started.set()
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - max(warmup_end, start)
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    latencies = sorted(latency for latency, _, _ in results)
+    statuses = Counter(status for _, status, _ in results)
+    errors = dict((str(status), count) for status, count in statuses.items()
+                  if status == 'failed' or status >= 400)
+
+    def ms(seconds):
+        return None if seconds is None else 1000 * seconds
+
+    return {
+        'url': url,
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'requests': len(results),
+        'errors': errors,
+        'statuses': dict((str(s), c) for s, c in statuses.items()),
+        'throughput': len(results) / elapsed if elapsed > 0 else None,
+        'points_per_second': sum(points for _, _, points in results) /
+                             elapsed if elapsed > 0 else None,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+        'client_cpu': (after.ru_utime + after.ru_stime) -
+                      (cpu.ru_utime + cpu.ru_stime),
+    }
+
+def format_report(report):
+    """Format a report from :func:`run` for people to read."""
+    latency = report['latency_ms']
+    lines = [
+        'URL:          {0}'.format(report['url']),
+        'Concurrency:  {0}'.format(report['concurrency']),
+        'Requests:     {0} in {1:.1f} s'.format(report['requests'],
+                                                report['duration']),
+        'Throughput:   {0:.1f} requests/s, {1:.1f} points/s'.format(
+            report['throughput'] or 0, report['points_per_second'] or 0),
+    ]
+    if latency['p50'] is not None:
+        lines.append('Latency (ms): mean {0:.2f}, p50 {1:.2f}, p95 {2:.2f}, '
+                     'p99 {3:.2f}, max {4:.2f}'.format(latency['mean'],
+                     latency['p50'], latency['p95'], latency['p99'],
+                     latency['max']))
+    lines.append('Errors:       {0}'.format(', '.join(
+        '{0} x {1}'.format(count, status)
+        for status, count in sorted(report['errors'].items())) or 'none'))
+    lines.append('Client CPU:   {0:.1f} s'.format(report['client_cpu']))
+    return '\n'.join(lines)
+
+def free_port():
+    """A TCP port on localhost that nothing is listening on."""
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+def serve(mode, port):
+    """Serve the API on localhost until killed."""
+    from . import api
+    if 'RUAUMOKO_SETTINGS' in os.environ:
+        api.app.config.from_envvar('RUAUMOKO_SETTINGS')
+
+    # Only errors are worth hearing about, not every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    if mode == 'async':
+        import uvicorn
+        from .aio import app
+        uvicorn.run(app, host='127.0.0.1', port=port, log_level='error')
+    else:
+        from werkzeug.serving import make_server
+        make_server('127.0.0.1', port, api.app, threaded=True).serve_forever()
+
+def start_server(mode='threaded'):
+    """Start the API in a child process. Returns the process and the URL
+    that it serves."""
+    if mode not in ('threaded', 'async'):
+        raise ValueError('Unknown server mode {0!r}'.format(mode))
+    if mode == 'async':
+        # Fail here, not in the child
+        import uvicorn
+
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(mode, port))
+    process.daemon = True
+    process.start()
+
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            break
+        except socket.error:
+            if not process.is_alive() or time.time() > deadline:
+                process.terminate()
+                raise RuntimeError('The server did not start')
+            time.sleep(0.05)
+
+    return process, 'http://127.0.0.1:{0}'.format(port)
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO if opts['--verbose'] else logging.WARN,
+        format='%(name)s:%(levelname)s: %(message)s'
+    )
+
+    try:
+        concurrency = int(opts['--concurrency'])
+        duration = float(opts['--duration'])
+        warmup = float(opts['--warmup'])
+        n_requests = int(opts['--requests']) if opts['--requests'] else None
+        batch = int(opts['--batch']) if opts['--batch'] else None
+        hot_fraction = float(opts['--hot-fraction'])
+        seed = int(opts['--seed'])
+        if concurrency < 1 or duration <= 0 or warmup < 0 or \
+                (n_requests is not None and n_requests < 1) or \
+                (batch is not None and batch < 1):
+            raise ValueError()
+    except ValueError:
+        LOG.error('Invalid concurrency, duration, warm-up, number of '
+                  'requests or batch size')
+        return 1
+
+    name = opts['--workload']
+    if name == 'uniform':
+        workload = PointWorkload(uniform_point, batch, opts['--binary'])
+    elif name == 'hotspot':
+        workload = PointWorkload(lambda rng: hotspot_point(rng, hot_fraction),
+                                 batch, opts['--binary'])
+    elif name == 'replay':
+        paths = []
+        for filename in opts['<log>']:
+            with open(filename) as f:
+                paths += read_log(f)
+        try:
+            workload = ReplayWorkload(paths)
+        except ValueError as e:
+            LOG.error(str(e))
+            return 1
+    else:
+        LOG.error('Unknown workload {0!r}'.format(name))
+        return 1
+
+    process = None
+    url = opts['--url']
+    if url is None:
+        process, url = start_server(opts['--server'])
+        LOG.info('Started a {0} server at {1}'.format(opts['--server'], url))
+
+    try:
+        report = run(url, workload, concurrency, duration, n_requests,
+                     warmup, seed)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    report['workload'] = name
+    if opts['--json']:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+    return 0 # success
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
@@ -0,0 +1,344 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Counters and histograms of the API's requests, shared by every process on a
+machine and exported in the Prometheus text format.
+
+The values live in a file, usually on a tmpfs such as /dev/shm, that each
+process maps into memory. Each process claims a row of the file for itself
+and only ever adds to its own row, so updates need no locks between
+processes; reading the metrics sums the rows. A process that claims the row
+of one that has exited carries on from its counts, so that totals never go
+down when workers are replaced. The file is named for the layout of its rows,
+so that processes counting other routes or slots (during a rolling upgrade,
+say) keep to a file of their own rather than resizing one that others have
+mapped. Without a file, the row table is an unlinked temporary file, shared
+only by processes forked after it is made.
+"""
+
+import bisect
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_SLOTS = 256
+
+MAGIC = b'RUAUMMET'
+VERSION = 1
+
+# magic, version, digest of the layout of a row, values per row, rows
+HEADER = struct.Struct('<8sI20sII')
+HEADER_SIZE = 4096
+
+# Upper bounds of the buckets of each histogram
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+BATCH_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+HISTOGRAMS = OrderedDict([
+    ('request_duration_seconds', LATENCY_BUCKETS),
+    ('lookup_duration_seconds', LATENCY_BUCKETS),
+    ('batch_size', BATCH_BUCKETS),
+])
+
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+# Route of requests that don't match any
+OTHER_ROUTE = 'other'
+
+PREFIX = 'ruaumoko_'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Name, type and help of each metric
+METRICS = [
+    ('requests_total', 'counter',
+     'Requests answered, by route and class of status.'),
+    ('request_duration_seconds', 'histogram',
+     'Time taken to answer requests.'),
+    ('lookup_duration_seconds', 'histogram',
+     'Time spent in calls to the dataset.'),
+    ('batch_size', 'histogram',
+     'Points in each batch, profile or trajectory.'),
+    ('out_of_range_total', 'counter',
+     'Requests rejected for positions outside the dataset.'),
+    ('page_faults_total', 'counter',
+     'Page faults taken by the whole process, in any thread, during calls '
+     'to the dataset.'),
+]
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+def escape(value):
+    """Escape a label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metrics(object):
+    """Metrics of requests to `routes`, in a file named by `path` with a
+    digest of its layout appended (see the `path` attribute).
+
+    Processes opening the same path with the same routes and slots share the
+    metrics. Up to `slots` processes may have counted at once; the rows of
+    processes that have exited are reused.
+    """
+
+    default_slots = DEFAULT_SLOTS
+
+    def __init__(self, routes, path=None, slots=DEFAULT_SLOTS):
+        self.routes = tuple(sorted(set(routes))) + (OTHER_ROUTE,)
+        self.index = {}
+        n_values = 0
+        for route in self.routes:
+            for key in [('requests_total', route, status)
+                        for status in STATUS_CLASSES] + \
+                       [('out_of_range_total', route),
+                        ('page_faults_total', route, 'minor'),
+                        ('page_faults_total', route, 'major')]:
+                self.index[key] = n_values
+                n_values += 1
+            for name, buckets in HISTOGRAMS.items():
+                # Counts of each bucket and of +Inf, then the sum and count
+                self.index[(name, route)] = n_values
+                n_values += len(buckets) + 3
+        self.n_values = n_values
+        self.slots = slots
+
+        layout = repr((sorted(self.index.items()), list(HISTOGRAMS.items())))
+        digest = hashlib.sha1(layout.encode('utf-8')).digest()
+
+        # Threads of a process share its row, so need a lock of their own
+        self.thread_lock = threading.Lock()
+        self.row = None
+        self.owner = None
+
+        # The first value of each row is the ID of the process that owns it
+        row_size = 8 * (1 + n_values)
+        total = HEADER_SIZE + slots * row_size
+        header = HEADER.pack(MAGIC, VERSION, digest, n_values, slots)
+        if path is None:
+            self.path = None
+            f = tempfile.TemporaryFile()
+            self.fd = os.dup(f.fileno())
+            f.close()
+        else:
+            self.path = '{0}.{1}'.format(path,
+                                         hashlib.sha1(header).hexdigest()[:12])
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            if os.read(self.fd, HEADER.size) != header or \
+                    os.fstat(self.fd).st_size != total:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, total)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, header)
+            self.map = mmap.mmap(self.fd, total)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+        self.rows = np.frombuffer(self.map, dtype=np.float64,
+                                  count=slots * (1 + n_values),
+                                  offset=HEADER_SIZE).reshape(slots, -1)
+
+    def close(self):
+        self.rows = self.row = None
+        self.map.close()
+        os.close(self.fd)
+
+    def claim(self):
+        """Claim a row for this process: its own if it has one already, a
+        free one, or that of a process that has exited. If every row is taken,
+        the process counts in a row of its own that isn't exported."""
+        pid = os.getpid()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            owners = self.rows[:, 0]
+            free = np.flatnonzero(owners == pid)
+            if not len(free):
+                free = np.flatnonzero(owners == 0)
+            if not len(free):
+                free = [k for k, owner in enumerate(owners)
+                        if not self.alive(int(owner))]
+            if len(free):
+                self.rows[free[0], 0] = pid
+                self.row = self.rows[free[0], 1:]
+            else:
+                LOG.warning('No free slots for the metrics of process {0}; '
+                            'open them with more'.format(pid))
+                self.row = np.zeros(self.n_values)
+            self.owner = pid
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    @staticmethod
+    def alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    @contextlib.contextmanager
+    def updating(self):
+        """This process's row, locked against its other threads."""
+        with self.thread_lock:
+            # Rows aren't shared with processes forked since claiming one
+            if self.owner != os.getpid():
+                self.claim()
+            yield self.row
+
+    def route(self, route):
+        return route if route in self.routes else OTHER_ROUTE
+
+    def observe(self, row, name, route, value):
+        buckets = HISTOGRAMS[name]
+        offset = self.index[(name, route)]
+        row[offset + bisect.bisect_left(buckets, value)] += 1
+        row[offset + len(buckets) + 1] += value
+        row[offset + len(buckets) + 2] += 1
+
+    def request(self, route, status, duration):
+        """Count a request answered with `status` after `duration` seconds."""
+        route = self.route(route)
+        status = STATUS_CLASSES[min(max(status // 100, 1), 5) - 1]
+        with self.updating() as row:
+            row[self.index[('requests_total', route, status)]] += 1
+            self.observe(row, 'request_duration_seconds', route, duration)
+
+    def batch(self, route, size):
+        """Record the number of points in a batch."""
+        with self.updating() as row:
+            self.observe(row, 'batch_size', self.route(route), size)
+
+    def out_of_range(self, route):
+        """Count a request rejected for positions outside the dataset."""
+        with self.updating() as row:
+            row[self.index[('out_of_range_total', self.route(route))]] += 1
+
+    @contextlib.contextmanager
+    def lookup(self, route):
+        """Time the calls to the dataset made within the context, and count
+        the page faults taken meanwhile.
+
+        Faults are those of the whole process, since batches may be looked up
+        in other threads; faults of concurrent requests are counted too.
+        """
+        route = self.route(route)
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = clock()
+        try:
+            yield
+        finally:
+            duration = clock() - start
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            with self.updating() as row:
+                self.observe(row, 'lookup_duration_seconds', route, duration)
+                row[self.index[('page_faults_total', route, 'minor')]] += \
+                    after.ru_minflt - before.ru_minflt
+                row[self.index[('page_faults_total', route, 'major')]] += \
+                    after.ru_majflt - before.ru_majflt
+
+    def totals(self):
+        """Sums of the values of every process, as an array indexed as the
+        rows are.
+
+        Rows aren't locked, so values may be slightly out of date.
+        """
+        rows = self.rows[self.rows[:, 0] != 0]
+        return rows[:, 1:].sum(axis=0)
+
+    def value(self, *key):
+        """Total of a counter, such as ``('requests_total', '/batch',
+        '2xx')``."""
+        return self.totals()[self.index[key]]
+
+    def exposition(self, extra=()):
+        """The metrics of every process in the Prometheus text format.
+
+        `extra` is a sequence of ``(name, type, help, value)`` of other
+        metrics to include.
+        """
+        totals = self.totals()
+        lines = []
+        for name, type_, help_ in METRICS:
+            lines.append('# HELP {0}{1} {2}'.format(PREFIX, name, help_))
+            lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, type_))
+            for route in self.routes:
+                labels = 'route="{0}"'.format(escape(route))
+                if type_ == 'histogram':
+                    lines += self.histogram_lines(totals, name, route, labels)
+                    continue
+                for key, offset in sorted(self.index.items()):
+                    if key[:2] != (name, route):
+                        continue
+                    extra_label = ''
+                    if name == 'requests_total':
+                        extra_label = ',code="{0}"'.format(key[2])
+                    elif name == 'page_faults_total':
+                        extra_label = ',type="{0}"'.format(key[2])
+                    lines.append('{0}{1}{{{2}{3}}} {4}'.format(PREFIX, name,
+                        labels, extra_label, format_value(totals[offset])))
+
+        for name, type_, help_, value in extra:
+            lines.append('# HELP {0}{1} {2}'.format(PREFIX, name, help_))
+            lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, type_))
+            lines.append('{0}{1} {2}'.format(PREFIX, name,
+                                             format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def histogram_lines(self, totals, name, route, labels):
+        buckets = HISTOGRAMS[name]
+        offset = self.index[(name, route)]
+        counts = np.cumsum(totals[offset:offset + len(buckets) + 1])
+        lines = []
+        for bound, count in zip(buckets + ('+Inf',), counts):
+            lines.append('{0}{1}_bucket{{{2},le="{3}"}} {4}'.format(PREFIX,
+                name, labels, bound, format_value(count)))
+        lines.append('{0}{1}_sum{{{2}}} {3}'.format(PREFIX, name, labels,
+            format_value(totals[offset + len(buckets) + 1])))
+        lines.append('{0}{1}_count{{{2}}} {3}'.format(PREFIX, name, labels,
+            format_value(totals[offset + len(buckets) + 2])))
+        return lines
@@ -0,0 +1,201 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Build reduced-resolution overviews of a Ruaumoko dataset.
+
+Usage:
+    {me} (-h | --help)
+    {me} [(-v | --verbose)] [--tile-shape WxH] [--levels N] [<dataset>]
+
+Options:
+    -h, --help                  Show a brief usage summary.
+    -v, --verbose               Be verbose in logging progress.
+
+    --tile-shape WxH            Expected shape of tiles is W pixels wide and H
+                                pixels high. [default: {def_tile_shape[0]}x{def_tile_shape[1]}]
+
+    --levels N                  Number of overview levels to build. By
+                                default, levels are built until cells are at
+                                least one degree across.
+
+    <dataset>                   Ruaumoko dataset to build overviews for.
+                                [default: {def_ds_loc}]
+
+Each level halves the resolution of the one before and is written next to the
+dataset as "<dataset>.overview-<level>". A level holds three planes: the mean,
+minimum and maximum of the cells it covers. Overviews are only used with the
+build of the dataset they were made from, so rebuild them when it changes.
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import sys
+
+import docopt
+import numpy as np
+
+from . import Dataset
+from .asciiart import parse_shape
+from .dataset import (cell_shape, grid_shape, overview_path, dataset_build,
+        OVERVIEW_MAGIC, OVERVIEW_VERSION, OVERVIEW_HEADER, OVERVIEW_HEADER_SIZE)
+from .tiles import read_chunk
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_tile_shape = Dataset.default_res,
+    def_ds_loc = Dataset.default_location,
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+# Output rows computed at a time
+BAND_ROWS = 256
+
+def default_levels(expected_res):
+    """Number of levels needed for cells to be at least a degree across."""
+    cells_per_degree = (expected_res[1] - 1) / 45.0
+    levels = 0
+    while cells_per_degree > 1:
+        cells_per_degree /= 2
+        levels += 1
+    return levels
+
+class ChunkRows(object):
+    """The chunks of a dataset in any layout, read a row of chunks at a
+    time."""
+
+    def __init__(self, filename, expected_res):
+        self.filename = filename
+        self.expected_res = expected_res
+        self.chunk_r = None
+        self.chunks = None
+
+    def __getitem__(self, chunk_r):
+        if chunk_r != self.chunk_r:
+            self.chunks = None
+            self.chunks = [read_chunk(self.filename, chunk_r, chunk_c,
+                                      self.expected_res)
+                           for chunk_c in range(cell_shape[1])]
+            self.chunk_r = chunk_r
+        return self.chunks
+
+def read_rows(chunks, start, stop):
+    """Rows [start, stop) of the whole grid of a dataset, whose chunks are
+    read from a ChunkRows."""
+    block_rows = chunks.expected_res[1] - 1
+    pieces = []
+    row = start
+    while row < stop:
+        # As in Dataset, rows shared by two chunks are read from the lower
+        # one, except for the last row of the grid.
+        block = min(row // block_rows, cell_shape[0] - 1)
+        local = row - block * block_rows
+        last = block_rows + 1 if block == cell_shape[0] - 1 else block_rows
+        count = min(stop - row, last - local)
+        # Drop the overlap column of each chunk and lay the chunks side by side
+        pieces.append(np.hstack([chunk[local:local + count, :-1]
+                                 for chunk in chunks[block]]))
+        row += count
+    return np.vstack(pieces)
+
+def reduce_band(planes):
+    """Halve the resolution of (mean, min, max) planes of shape (3, R, C)."""
+    _, rows, cols = planes.shape
+    planes = np.pad(planes, ((0, 0), (0, rows % 2), (0, cols % 2)), mode='edge')
+    blocks = planes.reshape(3, planes.shape[1] // 2, 2, planes.shape[2] // 2, 2)
+    return np.stack([
+        np.round(blocks[0].mean(axis=(1, 3))),
+        blocks[1].min(axis=(1, 3)),
+        blocks[2].max(axis=(1, 3)),
+    ]).astype(np.int16)
+
+def build_overviews(filename, expected_res=Dataset.default_res, levels=None):
+    """Build overview levels for a dataset in any layout, returning their
+    filenames."""
+    filename = filename.rstrip(os.sep)
+    if levels is None:
+        levels = default_levels(expected_res)
+
+    # Overviews are only used with the build they were made from
+    build_id, _ = dataset_build(filename, expected_res)
+    chunks = ChunkRows(filename, expected_res)
+
+    def read_full(start, stop):
+        band = read_rows(chunks, start, stop)
+        return np.stack([band, band, band])
+
+    read_band = read_full
+    paths = []
+    for level in range(1, levels + 1):
+        path = overview_path(filename, level)
+        rows, cols = grid_shape(expected_res, level)
+        LOG.info('Building level {0} ({1}x{2}) in "{3}"'.format(level, cols, rows, path))
+
+        in_rows = grid_shape(expected_res, level - 1)[0]
+        out = np.memmap(path, dtype=np.int16, mode='w+',
+                offset=OVERVIEW_HEADER_SIZE, shape=(3, rows, cols))
+        with open(path, 'r+b') as f:
+            f.write(OVERVIEW_HEADER.pack(OVERVIEW_MAGIC, OVERVIEW_VERSION,
+                level, expected_res[0], expected_res[1],
+                build_id.encode('ascii')))
+        for start in range(0, rows, BAND_ROWS):
+            stop = min(start + BAND_ROWS, rows)
+            out[:, start:stop, :] = reduce_band(
+                read_band(2 * start, min(2 * stop, in_rows)))
+        out.flush()
+
+        read_band = lambda start, stop, out=out: np.asarray(out[:, start:stop, :])
+        paths.append(path)
+
+    return paths
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO if opts['--verbose'] else logging.WARN,
+        format='%(name)s:%(levelname)s: %(message)s'
+    )
+
+    try:
+        tile_res = parse_shape(opts['--tile-shape'], 'tile shape')
+    except ValueError:
+        return 1
+
+    levels = opts['--levels']
+    if levels is not None:
+        try:
+            levels = int(levels)
+            if levels < 1:
+                raise ValueError()
+        except ValueError:
+            LOG.error('Invalid number of levels: {0}'.format(opts['--levels']))
+            return 1
+
+    ds_loc = opts['<dataset>'] or Dataset.default_location
+    build_overviews(ds_loc, tile_res, levels)
+    return 0 # success
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
@@ -0,0 +1,79 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Encoded polyline support.
+
+Points are packed using the encoded polyline algorithm format popularised by
+Google Maps: successive differences of coordinates scaled by 10^precision,
+zig-zag encoded and written five bits per character.
+"""
+
+from array import array
+
+def _values(encoded):
+    """Yield the signed integers encoded in a polyline string."""
+    value = shift = 0
+    for char in encoded:
+        byte = ord(char) - 63
+        if not 0 <= byte < 64:
+            raise ValueError("Bad character {0!r} in polyline".format(char))
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            yield ~(value >> 1) if value & 1 else value >> 1
+            value = shift = 0
+    if shift:
+        raise ValueError("Truncated polyline")
+
+def decode(encoded, precision=5):
+    """Decode a polyline into arrays of latitudes and longitudes.
+
+    Longitudes are returned in the range [0, 360), as expected by
+    :class:`ruaumoko.Dataset`.
+    """
+    values = list(_values(encoded))
+    if len(values) % 2:
+        raise ValueError("Polyline has an odd number of values")
+
+    scale = 10.0 ** precision
+    lats = array('d')
+    lngs = array('d')
+    lat = lng = 0
+    for k in range(0, len(values), 2):
+        lat += values[k]
+        lng += values[k + 1]
+        lats.append(lat / scale)
+        lngs.append((lng / scale) % 360)
+    return lats, lngs
+
+def encode(lats, lngs, precision=5):
+    """Encode latitudes and longitudes as a polyline."""
+    scale = 10.0 ** precision
+    chars = []
+    prev_lat = prev_lng = 0
+    for lat, lng in zip(lats, lngs):
+        lat = int(round(lat * scale))
+        lng = int(round(((lng + 180) % 360 - 180) * scale))
+        for value in (lat - prev_lat, lng - prev_lng):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                chars.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chars.append(chr(value + 63))
+        prev_lat, prev_lng = lat, lng
+    return ''.join(chars)
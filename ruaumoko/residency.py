@@ -0,0 +1,254 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Report which parts of a Ruaumoko dataset are in memory, or are most used.
+
+Usage:
+    {me} (-h | --help)
+    {me} [--tile-shape WxH] [--tile-size N] [--map] [<dataset>]
+    {me} hot [--top N] [--map] [--warm-list] <heatmap>...
+
+Options:
+    -h, --help                  Show a brief usage summary.
+
+    --tile-shape WxH            Expected shape of chunks is W pixels wide and
+                                H pixels high. [default: {def_tile_shape[0]}x{def_tile_shape[1]}]
+
+    --tile-size N               Report on N by N tiles. [default: {def_tile_size}]
+
+    --map                       Draw a map of the tiles.
+
+    --top N                     Number of hottest tiles to list. [default: 20]
+
+    --warm-list                 Print the hottest tiles as a list of boxes
+                                for the ELEVATION_WARM setting.
+
+    <dataset>                   Ruaumoko dataset to report on.
+                                [default: {def_ds_loc}]
+    <heatmap>                   Access counts written by the API (see
+                                ELEVATION_ACCESS_HEATMAP). Counts from
+                                several files, such as one per worker, are
+                                added together.
+
+The first form reports how much of the dataset, and of each chunk, is in the
+page cache. With --map, each tile is drawn with a character from " " (not
+resident) to "@" (fully resident), with chunks in rows from north to south
+and columns from longitude -180.
+
+The second form reports the tiles with the most sampled lookups. Its map
+shows the counts on a logarithmic scale.
+"""
+
+from __future__ import print_function
+
+import logging
+import math
+import os
+import struct
+import sys
+
+import docopt
+import numpy as np
+
+from . import Dataset
+from .asciiart import parse_shape
+from .dataset import cell_shape, tile_grid
+
+DEFAULT_TILE_SIZE = 256
+
+# Heatmaps of sampled lookups have a header like that of an index, followed
+# by the count for each tile as uint32, in the same order.
+HEATMAP_MAGIC = b'RUAUMHOT'
+HEATMAP_VERSION = 1
+HEATMAP_HEADER = struct.Struct('<8sHHIIQ')
+
+# Characters for increasing values on maps
+MAP_CHARS = ' .:-=+*#%@'
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_tile_shape = Dataset.default_res,
+    def_tile_size = DEFAULT_TILE_SIZE,
+    def_ds_loc = Dataset.default_location,
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+def write_heatmap(filename, expected_res, counts):
+    """Write the access counts of a dataset, as returned by
+    Dataset.access_counts, to a file."""
+    with open(filename, 'wb') as f:
+        f.write(HEATMAP_HEADER.pack(HEATMAP_MAGIC, HEATMAP_VERSION,
+            counts['tile_size'], expected_res[0], expected_res[1],
+            counts['every']))
+        f.write(np.asarray(counts['counts'], dtype='<u4').tobytes())
+
+def read_heatmap(filename):
+    """Read a heatmap, returning the chunk shape, the tile size, the
+    sampling interval and the counts as an array of shape (4, 6, tile rows,
+    tile columns)."""
+    with open(filename, 'rb') as f:
+        header = f.read(HEATMAP_HEADER.size)
+        if len(header) < HEATMAP_HEADER.size or not header.startswith(HEATMAP_MAGIC):
+            raise ValueError('{0} is not a heatmap'.format(filename))
+        _, version, tile_size, width, height, every = HEATMAP_HEADER.unpack(header)
+        if version != HEATMAP_VERSION:
+            raise ValueError('Unsupported heatmap version {0}'.format(version))
+        counts = np.frombuffer(f.read(), dtype='<u4')
+
+    shape = cell_shape + tile_grid((width, height), tile_size)
+    if counts.size != np.prod(shape):
+        raise ValueError('Heatmap {0} is truncated'.format(filename))
+    return (width, height), tile_size, every, counts.reshape(shape)
+
+def tile_box(expected_res, tile_size, chunk_r, chunk_c, tile_r, tile_c):
+    """The box covered by a tile, as (lat0, lng0, lat1, lng1) from its
+    north-west to its south-east corner."""
+    block_rows, block_cols = expected_res[1] - 1, expected_res[0] - 1
+    row0 = chunk_r * block_rows + tile_r * tile_size
+    row1 = chunk_r * block_rows + min((tile_r + 1) * tile_size - 1, block_rows)
+    col0 = chunk_c * block_cols + tile_c * tile_size
+    col1 = chunk_c * block_cols + min((tile_c + 1) * tile_size - 1, block_cols)
+
+    lat = lambda row: 90 - row * 45.0 / block_rows
+    lng = lambda col: (col * 60.0 / block_cols - 180) % 360
+    return (round(lat(row0), 6), round(lng(col0), 6),
+            round(lat(row1), 6), round(lng(col1), 6))
+
+def draw_map(values):
+    """Draw tiles of a (4, 6, tile rows, tile columns) array of values
+    between 0 and 1 as lines of characters."""
+    chunk_rows, chunk_cols, tile_rows, tile_cols = values.shape
+    grid = values.transpose(0, 2, 1, 3).reshape(
+        chunk_rows * tile_rows, chunk_cols * tile_cols)
+    levels = np.clip((grid * len(MAP_CHARS)).astype(int), 0, len(MAP_CHARS) - 1)
+    return [''.join(MAP_CHARS[level] for level in row) for row in levels]
+
+def format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or unit == 'GiB':
+            return '{0:.1f} {1}'.format(n, unit)
+        n /= 1024.0
+
+def format_fraction(resident, total):
+    """Percentage resident, or n/a if nothing is stored (as for a missing
+    chunk, or one whose tiles are all constant)."""
+    if not total:
+        return 'n/a'
+    return '{0:.1%}'.format(resident / float(total))
+
+def report_residency(filename, expected_res, tile_size, show_map=False):
+    ds = Dataset(filename, expected_res=expected_res)
+    resident, total = ds.resident()
+    print('{0} ({1} layout): {2} of {3} resident ({4})'.format(filename,
+        ds.layout, format_bytes(resident), format_bytes(total),
+        format_fraction(resident, total)))
+
+    print()
+    print('Resident by chunk, from north to south and from longitude -180:')
+    for chunk_r in range(cell_shape[0]):
+        fractions = []
+        for chunk_c in range(cell_shape[1]):
+            resident, total = ds.resident((chunk_r, chunk_c))
+            fractions.append('{0:>7}'.format(
+                format_fraction(resident, total)))
+        print(' '.join(fractions))
+
+    if show_map:
+        residency = np.asarray(ds.tile_residency(tile_size)).reshape(
+            cell_shape + tile_grid(expected_res, tile_size))
+        print()
+        for line in draw_map(residency):
+            print(line)
+
+def report_heat(filenames, top, show_map=False, warm_list=False):
+    expected_res = tile_size = total = None
+    for filename in filenames:
+        res, size, every, counts = read_heatmap(filename)
+        if total is None:
+            expected_res, tile_size = res, size
+            total = np.zeros(counts.shape, dtype=np.uint64)
+        elif (res, size) != (expected_res, tile_size):
+            raise ValueError('Heatmap {0} has different tiles'.format(filename))
+        total += counts
+
+    hottest = np.argsort(total, axis=None)[::-1][:top]
+    hottest = [np.unravel_index(k, total.shape) for k in hottest
+               if total.flat[k] > 0]
+
+    if warm_list:
+        print('[')
+        for tile in hottest:
+            print('    {0!r},'.format(tile_box(expected_res, tile_size,
+                *(int(i) for i in tile))))
+        print(']')
+        return
+
+    print('{0} sampled lookups in {1} file(s)'.format(int(total.sum()),
+        len(filenames)))
+    print()
+    print('  Count  Box (north-west to south-east)')
+    for tile in hottest:
+        print('{0:7d}  {1}'.format(int(total[tile]),
+            tile_box(expected_res, tile_size, *(int(i) for i in tile))))
+
+    if show_map and total.max() > 0:
+        print()
+        scaled = np.log1p(total) / math.log1p(total.max())
+        for line in draw_map(scaled):
+            print(line)
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(format='%(name)s:%(levelname)s: %(message)s')
+
+    if opts['hot']:
+        try:
+            top = int(opts['--top'])
+            if top < 1:
+                raise ValueError()
+        except ValueError:
+            LOG.error('Invalid number of tiles: {0}'.format(opts['--top']))
+            return 1
+        report_heat(opts['<heatmap>'], top, opts['--map'], opts['--warm-list'])
+        return 0 # success
+
+    try:
+        tile_res = parse_shape(opts['--tile-shape'], 'tile shape')
+    except ValueError:
+        return 1
+
+    try:
+        tile_size = int(opts['--tile-size'])
+        if tile_size < 1:
+            raise ValueError()
+    except ValueError:
+        LOG.error('Invalid tile size: {0}'.format(opts['--tile-size']))
+        return 1
+
+    ds_loc = opts['<dataset>'] or Dataset.default_location
+    report_residency(ds_loc, tile_res, tile_size, opts['--map'])
+    return 0 # success
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
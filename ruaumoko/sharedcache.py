@@ -0,0 +1,228 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+A bounded cache of results, shared by every process on a machine.
+
+The cache lives in a file, usually on a tmpfs such as /dev/shm, that each
+process maps into memory. It is divided into buckets of a few fixed-size
+slots. A key is hashed to pick a bucket, and within a full bucket the CLOCK
+algorithm picks which entry to evict: each slot has a reference bit, set
+when the entry is used, and a hand sweeps the bucket clearing bits until it
+finds an entry that hasn't been used since it last passed.
+
+Each bucket is locked with fcntl while it is used, so that processes only
+contend when they use the same bucket. The file is named for its layout, so
+that processes with other settings use a file of their own rather than
+resizing one that others have mapped.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+DEFAULT_SIZE = 64 * 1024 * 1024
+DEFAULT_SLOT_SIZE = 64 * 1024
+DEFAULT_WAYS = 8
+
+MAGIC = b'RUAUMCCH'
+VERSION = 1
+
+# magic, version, slot size, slots per bucket, buckets
+HEADER = struct.Struct('<8sIIII')
+HEADER_SIZE = 4096
+
+# CLOCK hand, then counts of hits, misses, stores and evictions
+BUCKET = struct.Struct('<I4xQQQQ')
+BUCKET_SIZE = 64
+
+# SHA-1 of the key, length of the value, reference bit, whether used
+SLOT = struct.Struct('<20sIBB6x')
+
+COUNTERS = ('hits', 'misses', 'stores', 'evictions')
+
+
+def digest(key):
+    return hashlib.sha1(key).digest()
+
+
+class SharedCache(object):
+    """A cache of byte strings, keyed by byte strings, in the file at
+    `path`.
+
+    Processes opening the same path with the same settings share the cache;
+    the file's name is `path` with a digest of its layout appended (see the
+    `path` attribute). It holds up to `size` bytes of values, in slots of
+    `slot_size` bytes; larger values aren't cached.
+    """
+
+    default_size = DEFAULT_SIZE
+    default_slot_size = DEFAULT_SLOT_SIZE
+
+    def __init__(self, path, size=DEFAULT_SIZE, slot_size=DEFAULT_SLOT_SIZE,
+                 ways=DEFAULT_WAYS):
+        self.slot_size = slot_size
+        self.ways = ways
+        self.bucket_size = BUCKET_SIZE + ways * (SLOT.size + slot_size)
+        self.buckets = max(size // (ways * slot_size), 1)
+        total = HEADER_SIZE + self.buckets * self.bucket_size
+
+        # Threads of a process share its fcntl locks, so need one of their own
+        self.thread_lock = threading.Lock()
+
+        header = HEADER.pack(MAGIC, VERSION, slot_size, ways, self.buckets)
+        self.path = '{0}.{1}'.format(path, hashlib.sha1(header).hexdigest()[:12])
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            if os.read(self.fd, HEADER.size) != header or \
+                    os.fstat(self.fd).st_size != total:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, total)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, header)
+            self.map = mmap.mmap(self.fd, total)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def locked(self, bucket):
+        """Lock a bucket, returning its offset in the file."""
+        offset = HEADER_SIZE + bucket * self.bucket_size
+        self.thread_lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, offset)
+        except:
+            self.thread_lock.release()
+            raise
+        return offset
+
+    def unlock(self, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, offset)
+        self.thread_lock.release()
+
+    def count(self, offset, counter, n=1):
+        fields = list(BUCKET.unpack_from(self.map, offset))
+        fields[1 + COUNTERS.index(counter)] += n
+        BUCKET.pack_into(self.map, offset, *fields)
+
+    def slot(self, offset, way):
+        """Offsets of the header and data of a slot in a bucket."""
+        header = offset + BUCKET_SIZE + way * SLOT.size
+        data = offset + BUCKET_SIZE + self.ways * SLOT.size + way * self.slot_size
+        return header, data
+
+    def find(self, offset, key_digest):
+        for way in range(self.ways):
+            header, data = self.slot(offset, way)
+            slot_digest, length, _, used = SLOT.unpack_from(self.map, header)
+            if used and slot_digest == key_digest:
+                return way
+        return None
+
+    def get(self, key):
+        """The value stored for a key, or None."""
+        key_digest = digest(key)
+        offset = self.locked(self.bucket(key_digest))
+        try:
+            way = self.find(offset, key_digest)
+            if way is None:
+                self.count(offset, 'misses')
+                return None
+
+            header, data = self.slot(offset, way)
+            _, length, _, _ = SLOT.unpack_from(self.map, header)
+            SLOT.pack_into(self.map, header, key_digest, length, 1, 1)
+            self.count(offset, 'hits')
+            return self.map[data:data + length]
+        finally:
+            self.unlock(offset)
+
+    def put(self, key, value):
+        """Store a value for a key, returning whether it fitted."""
+        if len(value) > self.slot_size:
+            return False
+
+        key_digest = digest(key)
+        offset = self.locked(self.bucket(key_digest))
+        try:
+            way = self.find(offset, key_digest)
+            if way is None:
+                way = self.victim(offset)
+            header, data = self.slot(offset, way)
+            # Free the slot while its data is rewritten, so that if this
+            # process dies part way, the old entry isn't found with new data
+            SLOT.pack_into(self.map, header, b'\0' * 20, 0, 0, 0)
+            self.map[data:data + len(value)] = value
+            SLOT.pack_into(self.map, header, key_digest, len(value), 1, 1)
+            self.count(offset, 'stores')
+            return True
+        finally:
+            self.unlock(offset)
+
+    def victim(self, offset):
+        """Choose a slot for a new entry in a locked bucket, evicting the
+        entry there if need be."""
+        for way in range(self.ways):
+            header, _ = self.slot(offset, way)
+            if not SLOT.unpack_from(self.map, header)[3]:
+                return way
+
+        hand = BUCKET.unpack_from(self.map, offset)[0]
+        while True:
+            header, _ = self.slot(offset, hand)
+            slot_digest, length, referenced, used = \
+                SLOT.unpack_from(self.map, header)
+            if not referenced:
+                break
+            SLOT.pack_into(self.map, header, slot_digest, length, 0, used)
+            hand = (hand + 1) % self.ways
+
+        fields = list(BUCKET.unpack_from(self.map, offset))
+        fields[0] = (hand + 1) % self.ways
+        fields[1 + COUNTERS.index('evictions')] += 1
+        BUCKET.pack_into(self.map, offset, *fields)
+        return hand
+
+    def bucket(self, key_digest):
+        return struct.unpack_from('<Q', key_digest)[0] % self.buckets
+
+    def stats(self):
+        """Counts of hits, misses, stores and evictions by all processes,
+        and the number of entries and slots.
+
+        Buckets aren't locked, so counts may be slightly out of date.
+        """
+        totals = dict.fromkeys(COUNTERS, 0)
+        totals['entries'] = 0
+        for bucket in range(self.buckets):
+            offset = HEADER_SIZE + bucket * self.bucket_size
+            fields = BUCKET.unpack_from(self.map, offset)
+            for counter, n in zip(COUNTERS, fields[1:]):
+                totals[counter] += n
+            for way in range(self.ways):
+                header, _ = self.slot(offset, way)
+                totals['entries'] += SLOT.unpack_from(self.map, header)[3]
+        totals['slots'] = self.buckets * self.ways
+        return totals
@@ -0,0 +1,307 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Generate a synthetic Ruaumoko dataset.
+
+Usage:
+    {me} (-h | --help)
+    {me} [(-v | --verbose)] [--tile-shape WxH] [--seed N] [--land PCT]
+        [--jobs N] [--split] <target>
+
+Options:
+    -h, --help                  Show a brief usage summary.
+    -v, --verbose               Be verbose in logging progress.
+
+    --tile-shape WxH            Generate chunks W pixels wide and H pixels
+                                high. [default: {def_tile_shape[0]}x{def_tile_shape[1]}]
+
+    --seed N                    Seed for the terrain. [default: {def_seed}]
+    --land PCT                  Roughly how much of the world is land, as a
+                                percentage. [default: {def_land}]
+    -j, --jobs N                Number of chunks to generate at once, each in
+                                its own process. [default: {def_jobs}]
+
+    --split                     Write a split dataset: a directory with a file
+                                per chunk.
+
+    <target>                    File (or with --split, directory) to write the
+                                dataset to.
+
+The terrain is fractal noise, continuous across the seams between chunks and
+around the world, on top of continents that are smoother noise. The ocean is
+all zero, as in the real data, and is not written at all: the dataset is a
+sparse file, so generating it takes time and space in proportion to the land.
+
+The result has the layout of a downloaded dataset, so it may be converted,
+indexed and benchmarked like one. It looks nothing like Earth.
+"""
+
+from __future__ import print_function
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import multiprocessing
+import os
+import sys
+
+import docopt
+import numpy as np
+
+from . import Dataset
+from .asciiart import parse_shape
+from .dataset import cell_shape, chunk_names, SPLIT_PATTERN
+
+DEFAULT_SEED = 0
+DEFAULT_LAND = 30
+
+# Cells generated at a time. Blocks that are entirely ocean are skipped
+BLOCK = 256
+
+# Shape of the noise giving the continents and how rugged they are, in rows
+# and columns covering the whole world
+COARSE_SHAPE = (90, 180)
+
+# Largest side of the periodic noise that gives the detail of the terrain
+DETAIL_SIZE = 2048
+
+# How high continents rise above the sea, and the scale of the detail on
+# them, in metres per standard deviation of the noise
+CONTINENT_HEIGHT = 1500
+DETAIL_HEIGHT = 1000
+
+# The detail is damped offshore, to this fraction at sea level and less
+# further out, so that the deep ocean is flat and may be skipped
+COAST_DETAIL = 0.3
+COAST_DEPTH = 1000
+
+MAX_ELEVATION = 8848
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_tile_shape = Dataset.default_res,
+    def_seed = DEFAULT_SEED,
+    def_land = DEFAULT_LAND,
+    def_jobs = multiprocessing.cpu_count(),
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+def fractal_noise(rng, shape, beta):
+    """Noise of zero mean and unit variance whose power spectrum falls off as
+    ``1 / f**beta``, made by filtering white noise. It wraps around in both
+    directions."""
+    freq = np.hypot(np.fft.fftfreq(shape[0])[:, np.newaxis],
+                    np.fft.rfftfreq(shape[1])[np.newaxis, :])
+    freq[0, 0] = np.inf
+    spectrum = (rng.normal(size=freq.shape) +
+                1j * rng.normal(size=freq.shape)) * freq ** (-beta / 2)
+    noise = np.fft.irfft2(spectrum, s=shape)
+    return ((noise - noise.mean()) / noise.std()).astype(np.float32)
+
+def largest_divisor(n, limit):
+    """Largest divisor of `n` that is at most `limit`."""
+    for d in range(min(n, limit), 0, -1):
+        if n % d == 0:
+            return d
+
+class Terrain(object):
+    """Elevation of every cell of a synthetic dataset with chunks of shape
+    `expected_res`.
+
+    Cells are addressed by row and column of the whole world, as in
+    :class:`Dataset`, so that chunks sharing a cell agree on its value.
+    """
+
+    def __init__(self, expected_res, seed=DEFAULT_SEED, land=DEFAULT_LAND):
+        rng = np.random.RandomState(seed)
+        self.n_rows = cell_shape[0] * (expected_res[1] - 1)
+        self.n_cols = cell_shape[1] * (expected_res[0] - 1)
+
+        self.continents = fractal_noise(rng, COARSE_SHAPE, 3.0)
+        self.ruggedness = fractal_noise(rng, COARSE_SHAPE, 3.0)
+        self.sea_level = np.percentile(self.continents, 100 - land)
+
+        # The detail repeats, but wraps around the world without a join
+        detail_shape = (min(DETAIL_SIZE, self.n_rows + 1),
+                        largest_divisor(self.n_cols, DETAIL_SIZE))
+        self.detail = fractal_noise(rng, detail_shape, 2.4)
+        self.detail_max = float(self.detail.max())
+
+    def coarse_position(self, rows, cols):
+        """Fractional positions of cells in the coarse noise."""
+        y = rows * ((COARSE_SHAPE[0] - 1) / float(self.n_rows))
+        x = (cols % self.n_cols) * (COARSE_SHAPE[1] / float(self.n_cols))
+        return y, x
+
+    def coarse(self, grid, y, x):
+        """Interpolate coarse noise at the cells in rows `y` and columns `x`,
+        wrapping around in longitude."""
+        iy = np.minimum(y.astype(np.intp), COARSE_SHAPE[0] - 2)
+        ix = x.astype(np.intp) % COARSE_SHAPE[1]
+        wy = (y - iy)[:, np.newaxis].astype(np.float32)
+        wx = (x - np.floor(x))[np.newaxis, :].astype(np.float32)
+        ix1 = (ix + 1) % COARSE_SHAPE[1]
+        top = grid[iy][:, ix] * (1 - wx) + grid[iy][:, ix1] * wx
+        bottom = grid[iy + 1][:, ix] * (1 - wx) + grid[iy + 1][:, ix1] * wx
+        return top * (1 - wy) + bottom * wy
+
+    def amplitude(self, continent, ruggedness):
+        """Scale of the detail, given the height of the continent and the
+        ruggedness."""
+        coast = np.clip(COAST_DETAIL * (1 + continent / COAST_DEPTH), 0, 1)
+        return DETAIL_HEIGHT * coast * np.clip(0.6 + 0.4 * ruggedness,
+                                               0.05, 1.5)
+
+    def elevation(self, rows, cols):
+        """Elevation of the cells in `rows` and `cols`, as an int16 array, or
+        None if they are all ocean."""
+        y, x = self.coarse_position(rows, cols)
+
+        # Interpolated values never exceed the grid points around them
+        iy = np.minimum(y.astype(np.intp), COARSE_SHAPE[0] - 2)
+        ix = x.astype(np.intp) % COARSE_SHAPE[1]
+        near_rows = np.arange(iy.min(), iy.max() + 2)
+        near_cols = np.union1d(ix, (ix + 1) % COARSE_SHAPE[1])
+        highest = CONTINENT_HEIGHT * (
+            self.continents[np.ix_(near_rows, near_cols)].max() -
+            self.sea_level)
+        largest = self.amplitude(highest,
+            self.ruggedness[np.ix_(near_rows, near_cols)].max())
+        if highest + largest * self.detail_max <= 0:
+            return None
+
+        detail = self.detail[np.ix_(rows % self.detail.shape[0],
+                                    (cols % self.n_cols) %
+                                    self.detail.shape[1])]
+        height = CONTINENT_HEIGHT * (self.coarse(self.continents, y, x) -
+                                     self.sea_level)
+        height += self.amplitude(height,
+                                 self.coarse(self.ruggedness, y, x)) * detail
+        height = np.clip(np.rint(height), 0, MAX_ELEVATION).astype(np.int16)
+        return height if height.any() else None
+
+# Each worker process builds the terrain once
+_terrain = {}
+
+def generate_chunk(target, expected_res, chunk_r, chunk_c,
+        seed=DEFAULT_SEED, land=DEFAULT_LAND, split=False):
+    """Write one chunk of a synthetic dataset into `target`, which must exist
+    and be of the right size. Returns the number of cells that were written,
+    which is the number in blocks that aren't entirely ocean."""
+    key = (tuple(expected_res), seed, land)
+    if key not in _terrain:
+        _terrain.clear()
+        _terrain[key] = Terrain(expected_res, seed, land)
+    terrain = _terrain[key]
+
+    shape = tuple(expected_res[::-1])
+    if split:
+        filename = os.path.join(target, SPLIT_PATTERN.format(
+            chunk_names[chunk_r * cell_shape[1] + chunk_c]))
+        data = np.memmap(filename, dtype=np.int16, mode='r+', shape=shape)
+        chunk = data
+    else:
+        data = np.memmap(target, dtype=np.int16, mode='r+',
+                         shape=cell_shape + shape)
+        chunk = data[chunk_r, chunk_c]
+
+    written = 0
+    for row in range(0, shape[0], BLOCK):
+        rows = np.arange(row, min(row + BLOCK, shape[0]))
+        for col in range(0, shape[1], BLOCK):
+            cols = np.arange(col, min(col + BLOCK, shape[1]))
+            block = terrain.elevation(rows + chunk_r * (shape[0] - 1),
+                                      cols + chunk_c * (shape[1] - 1))
+            if block is not None:
+                chunk[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] = block
+                written += block.size
+
+    data.flush()
+    return written
+
+def generate(target, expected_res=Dataset.default_res, seed=DEFAULT_SEED,
+        land=DEFAULT_LAND, split=False, jobs=None):
+    """Write a synthetic dataset to `target`, generating chunks in `jobs`
+    processes at once (by default, as many as there are CPUs). Returns the
+    fraction of cells that were written."""
+    chunk_size = 2 * expected_res[0] * expected_res[1]
+    n_chunks = cell_shape[0] * cell_shape[1]
+
+    # Truncating leaves a hole in the file, which reads as zero
+    if split:
+        if not os.path.isdir(target):
+            os.mkdir(target)
+        for name in chunk_names:
+            with open(os.path.join(target, SPLIT_PATTERN.format(name)),
+                      'wb') as f:
+                f.truncate(chunk_size)
+    else:
+        with open(target, 'wb') as f:
+            f.truncate(n_chunks * chunk_size)
+
+    written = 0
+    with ProcessPoolExecutor(jobs or multiprocessing.cpu_count()) as pool:
+        futures = dict(
+            (pool.submit(generate_chunk, target, expected_res,
+                         k // cell_shape[1], k % cell_shape[1], seed, land,
+                         split), k)
+            for k in range(n_chunks)
+        )
+        for future in as_completed(futures):
+            written += future.result()
+            LOG.info('Generated chunk {0}'.format(chunk_names[futures[future]]))
+
+    return written / float(n_chunks * chunk_size // 2)
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO if opts['--verbose'] else logging.WARN,
+        format='%(name)s:%(levelname)s: %(message)s'
+    )
+
+    try:
+        tile_res = parse_shape(opts['--tile-shape'], 'tile shape')
+    except ValueError:
+        return 1
+
+    try:
+        seed = int(opts['--seed'])
+        land = float(opts['--land'])
+        if not 0 <= land <= 100:
+            raise ValueError()
+        jobs = int(opts['--jobs'])
+        if jobs < 1:
+            raise ValueError()
+    except ValueError:
+        LOG.error('Invalid seed, land percentage or number of jobs')
+        return 1
+
+    written = generate(opts['<target>'], tile_res, seed, land,
+                       opts['--split'], jobs)
+    LOG.info('Wrote {0:.1f}% of the cells; the rest is ocean'.format(
+        100 * written))
+    return 0 # success
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
@@ -0,0 +1,375 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Decode the single-band 16-bit TIFFs in which the DEM chunks are distributed.
+
+Only what is needed for elevation data is supported: one 16-bit sample per
+pixel, stored in strips or tiles, either uncompressed or compressed with
+Deflate, LZW or PackBits, with or without horizontal differencing. Pixels are
+decoded a strip at a time, either into an array or straight into the
+chunk's place in a dataset file, so that each chunk is written exactly once
+and chunks can be decoded in any order.
+"""
+
+from __future__ import print_function
+
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+from ._compat import pwrite
+
+# Tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+
+# Compression schemes
+COMPRESSION_NONE = 1
+COMPRESSION_LZW = 5
+COMPRESSION_DEFLATE = 8
+COMPRESSION_PACKBITS = 32773
+COMPRESSION_ADOBE_DEFLATE = 32946
+
+# Predictors
+PREDICTOR_NONE = 1
+PREDICTOR_HORIZONTAL = 2
+
+# Field types we can read: type -> struct code
+FIELD_TYPES = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 16: 'Q'}
+FIELD_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4,
+               10: 8, 11: 4, 12: 8, 16: 8}
+
+# LZW control codes
+LZW_CLEAR = 256
+LZW_EOI = 257
+
+def read_tags(f):
+    """Read the first image file directory of the TIFF open as `f`.
+
+    Returns the byte order ('<' or '>') and a dict mapping each numeric tag
+    to a tuple of its values. Tags of types we don't need are left out.
+    """
+    f.seek(0)
+    header = f.read(8)
+    if header[:4] == b'II*\x00':
+        order = '<'
+    elif header[:4] == b'MM\x00*':
+        order = '>'
+    elif header[:2] in (b'II', b'MM'):
+        raise ValueError('BigTIFF files are not supported')
+    else:
+        raise ValueError('Not a TIFF file')
+
+    ifd_offset, = struct.unpack(order + 'I', header[4:8])
+    f.seek(ifd_offset)
+    n_entries = f.read(2)
+    if len(n_entries) < 2:
+        raise ValueError('Truncated TIFF file')
+    n_entries, = struct.unpack(order + 'H', n_entries)
+    entries = f.read(12 * n_entries)
+    if len(entries) < 12 * n_entries:
+        raise ValueError('Truncated TIFF file')
+
+    tags = {}
+    for i in range(n_entries):
+        key, type_, count = struct.unpack_from(order + 'HHI', entries, 12 * i)
+        if type_ not in FIELD_TYPES:
+            continue
+
+        size = FIELD_SIZES[type_] * count
+        if size <= 4:
+            data = entries[12 * i + 8:12 * i + 8 + size]
+        else:
+            value_offset, = struct.unpack_from(order + 'I', entries, 12 * i + 8)
+            pos = f.tell()
+            f.seek(value_offset)
+            data = f.read(size)
+            f.seek(pos)
+            if len(data) < size:
+                raise ValueError('Truncated TIFF file')
+
+        tags[key] = struct.unpack(order + FIELD_TYPES[type_] * count, data)
+    return order, tags
+
+def tag(tags, key, default=None):
+    """The single value of a tag, or `default` if it isn't present."""
+    if key not in tags:
+        if default is None:
+            raise ValueError('TIFF is missing required tag {0}'.format(key))
+        return default
+    return tags[key][0]
+
+def image_shape(filename):
+    """The (width, height) of the TIFF in `filename`."""
+    with open(filename, 'rb') as f:
+        _, tags = read_tags(f)
+    return tag(tags, IMAGE_WIDTH), tag(tags, IMAGE_LENGTH)
+
+def packbits_decode(data):
+    """Decode PackBits run-length encoded bytes."""
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        if n < 128:
+            # Literal run of n + 1 bytes
+            out += data[i + 1:i + n + 2]
+            i += n + 2
+        elif n > 128:
+            # Next byte repeated 257 - n times
+            out += data[i + 1:i + 2] * (257 - n)
+            i += 2
+        else:
+            i += 1
+    return bytes(out)
+
+def lzw_decode(data):
+    """Decode TIFF-flavoured LZW (MSB first, with early change)."""
+    out = bytearray()
+    table = [struct.pack('B', i) for i in range(256)] + [b'', b'']
+    width = 9
+    prev = None
+    bits = 0
+    n_bits = 0
+
+    for byte in bytearray(data):
+        bits = (bits << 8) | byte
+        n_bits += 8
+        while n_bits >= width:
+            n_bits -= width
+            code = bits >> n_bits
+            bits &= (1 << n_bits) - 1
+
+            if code == LZW_CLEAR:
+                del table[258:]
+                width = 9
+                prev = None
+                continue
+            if code == LZW_EOI:
+                return bytes(out)
+
+            if prev is None:
+                entry = table[code]
+            elif code < len(table):
+                entry = table[code]
+                table.append(prev + entry[:1])
+            else:
+                entry = prev + prev[:1]
+                table.append(entry)
+
+            out += entry
+            prev = entry
+            if len(table) + 1 >= 1 << width and width < 12:
+                width += 1
+
+    return bytes(out)
+
+def decompress(data, compression):
+    """Undo `compression` on the contents of a strip or tile."""
+    if compression == COMPRESSION_NONE:
+        return data
+    if compression in (COMPRESSION_DEFLATE, COMPRESSION_ADOBE_DEFLATE):
+        return zlib.decompress(data)
+    if compression == COMPRESSION_LZW:
+        return lzw_decode(data)
+    if compression == COMPRESSION_PACKBITS:
+        return packbits_decode(data)
+    raise ValueError('Unsupported TIFF compression {0}'.format(compression))
+
+def decode_block(data, order, rows, cols, predictor):
+    """Turn the decompressed bytes of a strip or tile into a rows by cols
+    array of native int16."""
+    if len(data) < 2 * rows * cols:
+        raise ValueError('TIFF block is truncated')
+    block = np.frombuffer(data, dtype=order + 'u2', count=rows * cols)
+    block = block.reshape(rows, cols)
+    if predictor == PREDICTOR_HORIZONTAL:
+        block = np.cumsum(block, axis=1, dtype=np.uint16)
+    return block.astype(np.uint16).view(np.int16)
+
+def iter_blocks(filename, expected_shape=None):
+    """Decode the TIFF in `filename` one strip or tile at a time.
+
+    Yields (row, col, block) where block is an int16 array holding the
+    pixels whose top-left corner is at (row, col), clipped to the image. If
+    given, `expected_shape` is checked against the image's (height, width).
+    """
+    with open(filename, 'rb') as f:
+        order, tags = read_tags(f)
+
+        width = tag(tags, IMAGE_WIDTH)
+        height = tag(tags, IMAGE_LENGTH)
+        if expected_shape is not None and expected_shape != (height, width):
+            raise ValueError('TIFF is {0}x{1} but expected {2[1]}x{2[0]}'.format(
+                width, height, expected_shape))
+
+        if tags.get(BITS_PER_SAMPLE, (16,)) != (16,) or \
+                tag(tags, SAMPLES_PER_PIXEL, 1) != 1:
+            raise ValueError('Only single-band 16-bit TIFFs are supported')
+        if tag(tags, SAMPLE_FORMAT, 1) not in (1, 2):
+            raise ValueError('Only integer TIFFs are supported')
+
+        compression = tag(tags, COMPRESSION, COMPRESSION_NONE)
+        predictor = tag(tags, PREDICTOR, PREDICTOR_NONE)
+        if predictor not in (PREDICTOR_NONE, PREDICTOR_HORIZONTAL):
+            raise ValueError('Unsupported TIFF predictor {0}'.format(predictor))
+
+        tiled = TILE_OFFSETS in tags
+        if tiled:
+            block_rows = tag(tags, TILE_LENGTH)
+            block_cols = tag(tags, TILE_WIDTH)
+            offsets = tags[TILE_OFFSETS]
+            counts = tags[TILE_BYTE_COUNTS]
+        else:
+            block_rows = min(tag(tags, ROWS_PER_STRIP, height), height)
+            block_cols = width
+            offsets = tags[STRIP_OFFSETS]
+            counts = tags[STRIP_BYTE_COUNTS]
+
+        blocks_across = (width + block_cols - 1) // block_cols
+        for i, (offset, count) in enumerate(zip(offsets, counts)):
+            row = (i // blocks_across) * block_rows
+            col = (i % blocks_across) * block_cols
+            if row >= height:
+                break
+
+            f.seek(offset)
+            data = decompress(f.read(count), compression)
+
+            # The last strip may be short; tiles are always whole
+            rows = block_rows if tiled else min(block_rows, height - row)
+            block = decode_block(data, order, rows, block_cols, predictor)
+            yield row, col, block[:height - row, :width - col]
+
+def iter_bands(filename, expected_shape=None):
+    """Decode the TIFF in `filename` as a sequence of full-width bands.
+
+    Yields (row, band) in order from the top of the image, where band is an
+    int16 array holding whole rows starting at row. For tiled TIFFs each
+    band is a row of tiles.
+    """
+    width, _ = image_shape(filename)
+    band = None
+    for row, col, block in iter_blocks(filename, expected_shape):
+        if block.shape[1] == width:
+            # A whole strip
+            yield row, block
+            continue
+        if col == 0:
+            band = np.empty((block.shape[0], width), dtype=np.int16)
+        band[:, col:col + block.shape[1]] = block
+        if col + block.shape[1] == width:
+            yield row, band
+
+def raw_offset(filename, expected_shape):
+    """Offset in `filename` of its pixels, stored as a contiguous array of
+    native int16 of `expected_shape` (height, width), so that the file may be
+    mapped straight into memory.
+
+    The file may be an uncompressed TIFF whose strips are stored one after
+    the other, or a file holding nothing but the pixels. ValueError is raised
+    for any other file.
+    """
+    height, width = expected_shape
+    size = 2 * height * width
+    native = '<' if sys.byteorder == 'little' else '>'
+
+    with open(filename, 'rb') as f:
+        try:
+            order, tags = read_tags(f)
+        except ValueError:
+            if os.fstat(f.fileno()).st_size == size:
+                return 0
+            raise ValueError('{0} is neither a TIFF nor a raw chunk'
+                             .format(filename))
+
+    if (tag(tags, IMAGE_WIDTH), tag(tags, IMAGE_LENGTH)) != (width, height):
+        raise ValueError('{0} is {1}x{2} but expected {3}x{4}'.format(
+            filename, tag(tags, IMAGE_WIDTH), tag(tags, IMAGE_LENGTH),
+            width, height))
+
+    offsets = tags.get(STRIP_OFFSETS, ())
+    counts = tags.get(STRIP_BYTE_COUNTS, ())
+    contiguous = all(offsets[i] + counts[i] == offsets[i + 1]
+                     for i in range(len(offsets) - 1))
+    if order != native or tags.get(BITS_PER_SAMPLE, (16,)) != (16,) or \
+            tag(tags, COMPRESSION, COMPRESSION_NONE) != COMPRESSION_NONE or \
+            tag(tags, PREDICTOR, PREDICTOR_NONE) != PREDICTOR_NONE or \
+            TILE_OFFSETS in tags or not offsets or not contiguous or \
+            sum(counts) != size or offsets[0] % 2:
+        raise ValueError('{0} is not a plain TIFF that can be mapped directly'
+                         .format(filename))
+    return offsets[0]
+
+def decode_into(filename, out):
+    """Decode the TIFF in `filename` into the int16 array `out`, which must
+    have the same shape as the image."""
+    for row, col, block in iter_blocks(filename, out.shape):
+        out[row:row + block.shape[0], col:col + block.shape[1]] = block
+
+def decode(filename):
+    """Decode the TIFF in `filename` into a new int16 array."""
+    width, height = image_shape(filename)
+    out = np.empty((height, width), dtype=np.int16)
+    decode_into(filename, out)
+    return out
+
+def decode_chunk(filename, target, chunk_idx, expected_res, digest=None):
+    """Decode the TIFF in `filename` straight into chunk `chunk_idx` of the
+    single-file dataset `target`.
+
+    `target` is a file name or an open file object. Each band of rows is
+    written with pwrite at its final offset, so different chunks may be
+    decoded concurrently into the same file, in any order. If given,
+    `digest` (a hashlib object) is updated with the chunk's data.
+    """
+    width, height = expected_res
+    base = chunk_idx * width * height * 2
+
+    if hasattr(target, 'fileno'):
+        fd = target.fileno()
+        close = False
+    else:
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+        close = True
+
+    try:
+        for row, band in iter_bands(filename, (height, width)):
+            data = band.tobytes()
+            pwrite(fd, data, base + 2 * row * width)
+            if digest is not None:
+                digest.update(data)
+    finally:
+        if close:
+            os.close(fd)
@@ -0,0 +1,315 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Convert a Ruaumoko dataset to a tiled layout.
+
+Usage:
+    {me} (-h | --help)
+    {me} [(-v | --verbose)] [--tile-shape WxH] [--tile-size N] [--morton]
+        [--compress] [--level N] <source> <target>
+
+Options:
+    -h, --help                  Show a brief usage summary.
+    -v, --verbose               Be verbose in logging progress.
+
+    --tile-shape WxH            Expected shape of chunks is W pixels wide and
+                                H pixels high. [default: {def_tile_shape[0]}x{def_tile_shape[1]}]
+
+    --tile-size N               Store the data in N by N tiles. [default: {def_tile_size}]
+
+    --morton                    Store tiles within each chunk in Morton
+                                (Z-order) rather than row-major order.
+
+    --compress                  Compress each tile with zlib. Tiles where
+                                every cell has the same value are not stored.
+    --level N                   zlib compression level. [default: {def_level}]
+
+    <source>                    Ruaumoko dataset to convert, in the original
+                                single-file layout.
+    <target>                    File to write the tiled dataset to.
+
+In the original layout, cells that are close north-south are a whole chunk
+row apart. In the tiled layout, small regions are held in a few tiles, so
+queries over them touch far fewer pages. Dataset reads either layout.
+
+Compressed datasets are much smaller, since large areas such as the oceans
+are constant, but tiles must be decompressed when read. Dataset keeps a
+cache of recently used tiles.
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import zlib
+
+import docopt
+import numpy as np
+
+from . import Dataset
+from .asciiart import parse_shape
+from .tiff import raw_offset, decode_into
+from .dataset import (cell_shape, tile_grid, read_tiled_header,
+        chunk_names, split_chunk_files, MissingChunkError,
+        TILED_MAGIC, TILED_VERSION,
+        TILED_HEADER, TILED_ENTRY, TILED_PLAIN, TILED_COMPRESSED, TILE_ORDERS,
+        TILE_CONSTANT)
+
+DEFAULT_TILE_SIZE = 256
+DEFAULT_LEVEL = 6
+
+# Alignment of the start of the tile data
+PAGE_SIZE = 4096
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_tile_shape = Dataset.default_res,
+    def_tile_size = DEFAULT_TILE_SIZE,
+    def_level = DEFAULT_LEVEL,
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+def morton(row, col):
+    """Interleave the bits of row and column to give a Z-order index."""
+    index = 0
+    bit = 0
+    while row or col:
+        index |= (col & 1) << (2 * bit) | (row & 1) << (2 * bit + 1)
+        row >>= 1
+        col >>= 1
+        bit += 1
+    return index
+
+def tile_order(tile_rows, tile_cols, order='row'):
+    """Positions of the tiles of a chunk, in the order they are stored."""
+    positions = [(r, c) for r in range(tile_rows) for c in range(tile_cols)]
+    if order == 'morton':
+        positions.sort(key=lambda p: morton(*p))
+    elif order != 'row':
+        raise ValueError('Unknown tile order {0!r}'.format(order))
+    return positions
+
+def read_tile(chunk, row, col, tile_size):
+    """Extract a tile from a chunk, padding it with the edge values if the
+    chunk doesn't fill it."""
+    tile = chunk[row * tile_size:(row + 1) * tile_size,
+                 col * tile_size:(col + 1) * tile_size]
+    if tile.shape != (tile_size, tile_size):
+        tile = np.pad(tile, ((0, tile_size - tile.shape[0]),
+                             (0, tile_size - tile.shape[1])), mode='edge')
+    return np.ascontiguousarray(tile, dtype=np.int16)
+
+def write_tiled(target, chunks, expected_res, tile_size, order='row',
+        compress=None):
+    """Write a tiled dataset to the file object `target`.
+
+    `chunks` is indexable as ``chunks[row][col]`` to give each chunk as a
+    NumPy array. If `compress` is a zlib compression level, tiles are
+    compressed and constant tiles are left out.
+    """
+    tile_rows, tile_cols = tile_grid(expected_res, tile_size)
+    n_tiles = cell_shape[0] * cell_shape[1] * tile_rows * tile_cols
+    tile_bytes = 2 * tile_size * tile_size
+
+    table_offset = TILED_HEADER.size
+    data_offset = table_offset + n_tiles * TILED_ENTRY.size
+    data_offset += -data_offset % PAGE_SIZE
+
+    layout = TILED_PLAIN if compress is None else TILED_COMPRESSED
+    target.write(TILED_HEADER.pack(TILED_MAGIC, TILED_VERSION, layout,
+        tile_size, expected_res[0], expected_res[1], TILE_ORDERS.index(order), 0,
+        table_offset, data_offset))
+
+    table = bytearray(n_tiles * TILED_ENTRY.size)
+    target.seek(data_offset)
+    offset = data_offset
+    for chunk_r in range(cell_shape[0]):
+        for chunk_c in range(cell_shape[1]):
+            LOG.info('Tiling chunk {0}'.format(chunk_r * cell_shape[1] + chunk_c))
+            chunk = chunks[chunk_r][chunk_c]
+            base = (chunk_r * cell_shape[1] + chunk_c) * tile_rows * tile_cols
+            for row, col in tile_order(tile_rows, tile_cols, order):
+                tile = read_tile(chunk, row, col, tile_size)
+                entry = (base + row * tile_cols + col) * TILED_ENTRY.size
+                if compress is None:
+                    blob, value, flags = tile.tobytes(), 0, 0
+                elif (tile == tile.flat[0]).all():
+                    blob, value, flags = b'', tile.flat[0], TILE_CONSTANT
+                else:
+                    blob = zlib.compress(tile.tobytes(), compress)
+                    value, flags = 0, 0
+                target.write(blob)
+                TILED_ENTRY.pack_into(table, entry, offset, len(blob),
+                        value, flags)
+                offset += len(blob)
+
+    target.seek(table_offset)
+    target.write(table)
+
+def _read_split_chunk(directory, chunk_r, chunk_c, expected_res):
+    k = chunk_r * cell_shape[1] + chunk_c
+    filename = split_chunk_files(directory, expected_res)[k]
+    if not os.path.exists(filename):
+        raise MissingChunkError(chunk_names[k], filename)
+
+    shape = tuple(expected_res[::-1])
+    try:
+        offset = raw_offset(filename, shape)
+    except ValueError:
+        # Compressed, or otherwise not mappable, so decode it
+        out = np.empty(shape, dtype=np.int16)
+        decode_into(filename, out)
+        return out
+    return np.memmap(filename, dtype=np.int16, mode='r', offset=offset,
+            shape=shape)
+
+def _read_tiled_chunk(data, header, table, chunk_r, chunk_c, expected_res,
+        chunk):
+    tile_size = header['tile_size']
+    tile_rows, tile_cols = tile_grid(expected_res, tile_size)
+    base = (chunk_r * cell_shape[1] + chunk_c) * tile_rows * tile_cols
+    for row in range(tile_rows):
+        for col in range(tile_cols):
+            offset, length, value, flags = TILED_ENTRY.unpack_from(
+                    table, (base + row * tile_cols + col) * TILED_ENTRY.size)
+            out = chunk[row * tile_size:(row + 1) * tile_size,
+                        col * tile_size:(col + 1) * tile_size]
+            if flags & TILE_CONSTANT:
+                out[...] = value
+                continue
+            blob = data[offset:offset + length].tobytes()
+            if header['layout'] == TILED_COMPRESSED:
+                blob = zlib.decompress(blob)
+            out[...] = np.frombuffer(blob, dtype='<i2').reshape(
+                    tile_size, tile_size)
+    return chunk[:expected_res[1], :expected_res[0]]
+
+def _open_tiled(filename, header, expected_res):
+    if tuple(header['res']) != tuple(expected_res):
+        raise ValueError('Dataset has tiles of resolution {0}, expected {1}'
+                .format(header['res'], tuple(expected_res)))
+
+    tile_size = header['tile_size']
+    tile_rows, tile_cols = tile_grid(expected_res, tile_size)
+    n_tiles = cell_shape[0] * cell_shape[1] * tile_rows * tile_cols
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    table = data[header['table_offset']:
+            header['table_offset'] + n_tiles * TILED_ENTRY.size].tobytes()
+    chunk = np.empty((tile_rows * tile_size, tile_cols * tile_size),
+            dtype=np.int16)
+    return data, table, chunk
+
+def read_chunk(filename, chunk_r, chunk_c, expected_res=Dataset.default_res):
+    """Read one chunk of a dataset, in any layout, as an array of shape
+    ``expected_res[::-1]``.
+
+    Chunks that are stored uncompressed are mapped from the file rather than
+    read. MissingChunkError is raised if the chunk of a split dataset is
+    missing.
+    """
+    if os.path.isdir(filename):
+        return _read_split_chunk(filename, chunk_r, chunk_c, expected_res)
+
+    with open(filename, 'rb') as f:
+        header = read_tiled_header(f)
+
+    if header is None:
+        data = np.memmap(filename, dtype=np.int16, mode='r',
+                shape=cell_shape + tuple(expected_res[::-1]))
+        return data[chunk_r, chunk_c]
+
+    data, table, chunk = _open_tiled(filename, header, expected_res)
+    return _read_tiled_chunk(data, header, table, chunk_r, chunk_c,
+            expected_res, chunk)
+
+def read_chunks(filename, expected_res=Dataset.default_res):
+    """Yield each chunk of a dataset, in any layout, as
+    ``((chunk_row, chunk_col), array)``.
+
+    For tiled datasets the same array is reused for every chunk, so copy it
+    to keep it.
+    """
+    header = None
+    if not os.path.isdir(filename):
+        with open(filename, 'rb') as f:
+            header = read_tiled_header(f)
+
+    if header is None:
+        for chunk_r in range(cell_shape[0]):
+            for chunk_c in range(cell_shape[1]):
+                yield (chunk_r, chunk_c), read_chunk(filename, chunk_r,
+                        chunk_c, expected_res)
+        return
+
+    data, table, chunk = _open_tiled(filename, header, expected_res)
+    for chunk_r in range(cell_shape[0]):
+        for chunk_c in range(cell_shape[1]):
+            yield (chunk_r, chunk_c), _read_tiled_chunk(data, header, table,
+                    chunk_r, chunk_c, expected_res, chunk)
+
+def convert(source, target, expected_res=Dataset.default_res,
+        tile_size=DEFAULT_TILE_SIZE, order='row', compress=None):
+    """Convert a dataset in the original layout to a tiled one."""
+    data = np.memmap(source, dtype=np.int16, mode='r',
+            shape=cell_shape + tuple(expected_res[::-1]))
+    with open(target, 'wb') as f:
+        write_tiled(f, data, expected_res, tile_size, order, compress)
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO if opts['--verbose'] else logging.WARN,
+        format='%(name)s:%(levelname)s: %(message)s'
+    )
+
+    try:
+        tile_res = parse_shape(opts['--tile-shape'], 'tile shape')
+    except ValueError:
+        return 1
+
+    try:
+        tile_size = int(opts['--tile-size'])
+        if tile_size < 1:
+            raise ValueError()
+    except ValueError:
+        LOG.error('Invalid tile size: {0}'.format(opts['--tile-size']))
+        return 1
+
+    compress = None
+    if opts['--compress']:
+        try:
+            compress = int(opts['--level'])
+            if not 0 <= compress <= 9:
+                raise ValueError()
+        except ValueError:
+            LOG.error('Invalid compression level: {0}'.format(opts['--level']))
+            return 1
+
+    convert(opts['<source>'], opts['<target>'], tile_res, tile_size,
+            'morton' if opts['--morton'] else 'row', compress)
+    return 0 # success
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
@@ -0,0 +1,385 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Check a Ruaumoko dataset for corruption.
+
+Usage:
+    {me} (-h | --help)
+    {me} [(-v | --verbose)] [--tile-shape WxH] [--jobs N] [--spike M]
+        [--tolerance M] [--bin-size M] [--json] [<dataset>]
+
+Options:
+    -h, --help                  Show a brief usage summary.
+    -v, --verbose               Be verbose in logging progress.
+
+    --tile-shape WxH            Expected shape of chunks is W pixels wide and
+                                H pixels high. [default: {def_tile_shape[0]}x{def_tile_shape[1]}]
+
+    -j, --jobs N                Number of chunks to check at once, each in its
+                                own process. [default: {def_jobs}]
+
+    --spike M                   Flag cells more than M metres above or below
+                                all four of their neighbours. [default: {def_spike}]
+    --tolerance M               Allow the cells that neighbouring chunks share
+                                to differ by up to M metres. [default: 0]
+    --bin-size M                Width of the histogram bins, in metres.
+                                [default: {def_bin_size}]
+
+    --json                      Print the report as JSON.
+
+    <dataset>                   Ruaumoko dataset to check, in any layout.
+                                [default: {def_ds_loc}]
+
+Each chunk is read by a separate worker, which computes its minimum, maximum,
+mean and histogram, counts void cells ({void}), cells outside the range of
+elevations found on Earth ({def_min} to {def_max} metres) and spikes, and
+returns the cells on its edges. Neighbouring chunks overlap by one row or
+column, which must match.
+
+The exit status is 1 if any chunk is missing, any seam doesn't match, or any
+void or out of range cells are found. Spikes are listed but are not errors,
+since real terrain has a few.
+"""
+
+from __future__ import print_function
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+import docopt
+import numpy as np
+
+from . import Dataset, MissingChunkError
+from .asciiart import parse_shape
+from .dataset import cell_shape, chunk_names
+from .tiles import read_chunk
+
+# Value of missing cells in SRTM derived data
+VOID = -32768
+
+# The deepest ocean trench and the highest mountain, with some room to spare
+MIN_ELEVATION = -11000
+MAX_ELEVATION = 8900
+
+DEFAULT_SPIKE = 1500
+DEFAULT_BIN_SIZE = 500
+
+# Rows of a chunk checked at a time, to bound the memory used by each worker
+BAND_ROWS = 1024
+
+# Number of positions of each kind of suspicious cell kept per chunk
+MAX_EXAMPLES = 5
+
+# HACK: Update doc-string with defaults
+__doc__ = __doc__.format(
+    me = os.path.basename(sys.argv[0]),
+    def_tile_shape = Dataset.default_res,
+    def_jobs = multiprocessing.cpu_count(),
+    def_spike = DEFAULT_SPIKE,
+    def_bin_size = DEFAULT_BIN_SIZE,
+    def_ds_loc = Dataset.default_location,
+    def_min = MIN_ELEVATION,
+    def_max = MAX_ELEVATION,
+    void = VOID,
+)
+
+LOG = logging.getLogger(os.path.basename(sys.argv[0]))
+
+def _examples(mask, values, row_offset=0, col_offset=0):
+    return [(int(r) + row_offset, int(c) + col_offset, int(values[r, c]))
+            for r, c in np.argwhere(mask)[:MAX_EXAMPLES]]
+
+def find_spikes(block, spike):
+    """Mask of the cells in the interior of `block` that are more than
+    `spike` above or below all four of their neighbours."""
+    block = block.astype(np.int32)
+    centre = block[1:-1, 1:-1]
+    neighbours = (block[:-2, 1:-1], block[2:, 1:-1],
+                  block[1:-1, :-2], block[1:-1, 2:])
+    highest = np.maximum(np.maximum(neighbours[0], neighbours[1]),
+                         np.maximum(neighbours[2], neighbours[3]))
+    lowest = np.minimum(np.minimum(neighbours[0], neighbours[1]),
+                        np.minimum(neighbours[2], neighbours[3]))
+    return (centre != VOID) & \
+           ((centre - highest > spike) | (lowest - centre > spike))
+
+def check_chunk(filename, expected_res, chunk_r, chunk_c,
+        spike=DEFAULT_SPIKE):
+    """Check one chunk of a dataset.
+
+    Returns a dictionary holding the values found in the chunk and how many
+    times each occurs, counts, positions (row and column within the chunk)
+    and values of some suspicious cells, and the cells on each of its edges.
+    """
+    try:
+        chunk = read_chunk(filename, chunk_r, chunk_c, expected_res)
+    except MissingChunkError:
+        return {'missing': True}
+
+    height = chunk.shape[0]
+    counts = np.zeros(1 << 16, dtype=np.int64)
+    spikes = 0
+    examples = {'void': [], 'implausible': [], 'spike': []}
+
+    for start in range(0, height, BAND_ROWS):
+        band = np.ascontiguousarray(chunk[start:start + BAND_ROWS])
+        # Flipping the sign bit maps -32768..32767 onto 0..65535 in order
+        counts += np.bincount((band.view(np.uint16) ^ 0x8000).ravel(),
+                minlength=1 << 16)
+
+        if len(examples['void']) < MAX_EXAMPLES:
+            examples['void'] += _examples(band == VOID, band, start)
+        if len(examples['implausible']) < MAX_EXAMPLES:
+            examples['implausible'] += _examples((band != VOID) &
+                ((band < MIN_ELEVATION) | (band > MAX_ELEVATION)), band, start)
+
+        # Include the rows either side, so that every row but the first and
+        # last of the chunk is the centre of some 3 by 3 block
+        lo = max(start - 1, 0)
+        block = chunk[lo:start + BAND_ROWS + 1]
+        mask = find_spikes(block, spike)
+        spikes += int(np.count_nonzero(mask))
+        if len(examples['spike']) < MAX_EXAMPLES:
+            examples['spike'] += _examples(mask, block[1:-1, 1:-1], lo + 1, 1)
+
+    values = np.flatnonzero(counts)
+    return {
+        'missing': False,
+        'values': values - (1 << 15),
+        'counts': counts[values],
+        'spikes': spikes,
+        'examples': dict((kind, positions[:MAX_EXAMPLES])
+                         for kind, positions in examples.items()),
+        'edges': {
+            'top': np.array(chunk[0]),
+            'bottom': np.array(chunk[-1]),
+            'left': np.array(chunk[:, 0]),
+            'right': np.array(chunk[:, -1]),
+        },
+    }
+
+def histogram(values, counts, bin_size):
+    """Bin the counts of each value into bins `bin_size` wide, returning a
+    list of ``[lowest value of bin, count]``."""
+    lows = (values // bin_size) * bin_size
+    bins, index = np.unique(lows, return_inverse=True)
+    totals = np.bincount(index, weights=counts, minlength=len(bins))
+    return [[int(low), int(total)] for low, total in zip(bins, totals)]
+
+def summarise(values, counts, bin_size):
+    """Statistics of a chunk, or of the whole dataset, given the values found
+    in it and how many times each occurs."""
+    void = values == VOID
+    implausible = ~void & ((values < MIN_ELEVATION) | (values > MAX_ELEVATION))
+    valid = values[~void]
+    valid_counts = counts[~void]
+
+    summary = {
+        'cells': int(counts.sum()),
+        'void': int(counts[void].sum()),
+        'implausible': int(counts[implausible].sum()),
+        'histogram': histogram(values, counts, bin_size),
+        'min': None, 'max': None, 'mean': None,
+    }
+    if len(valid):
+        summary['min'] = int(valid[0])
+        summary['max'] = int(valid[-1])
+        summary['mean'] = float(np.dot(valid, valid_counts.astype(np.float64))
+                                / valid_counts.sum())
+    return summary
+
+def cell_position(expected_res, chunk_r, chunk_c, row, col):
+    """Latitude and longitude of a cell of a chunk."""
+    block_rows, block_cols = expected_res[1] - 1, expected_res[0] - 1
+    row += chunk_r * block_rows
+    col += chunk_c * block_cols
+    return (90 - row * 45.0 / block_rows,
+            (col * 60.0 / block_cols + 180) % 360)
+
+def check_seam(a, b, tolerance=0):
+    """Compare the cells two chunks share, returning how many differ by more
+    than `tolerance` and the largest difference."""
+    difference = np.abs(a.astype(np.int32) - b.astype(np.int32))
+    return int(np.count_nonzero(difference > tolerance)), int(difference.max())
+
+def verify(filename, expected_res=Dataset.default_res, jobs=None,
+        spike=DEFAULT_SPIKE, tolerance=0, bin_size=DEFAULT_BIN_SIZE):
+    """Check a dataset, returning a report as a dictionary that may be
+    serialised as JSON.
+
+    Chunks are checked by `jobs` processes at once, one chunk per worker
+    (by default, as many as there are CPUs).
+    """
+    n_chunks = cell_shape[0] * cell_shape[1]
+    results = [None] * n_chunks
+    with ProcessPoolExecutor(jobs or multiprocessing.cpu_count()) as pool:
+        futures = dict(
+            (pool.submit(check_chunk, filename, expected_res,
+                         k // cell_shape[1], k % cell_shape[1], spike), k)
+            for k in range(n_chunks)
+        )
+        for future in as_completed(futures):
+            k = futures[future]
+            results[k] = future.result()
+            LOG.info('Checked chunk {0}'.format(chunk_names[k]))
+
+    report = {
+        'dataset': filename,
+        'resolution': list(expected_res),
+        'chunks': [],
+        'seams': [],
+        'suspicious': [],
+    }
+
+    all_counts = np.zeros(1 << 16, dtype=np.int64)
+    for k, result in enumerate(results):
+        chunk_r, chunk_c = divmod(k, cell_shape[1])
+        entry = {'chunk': chunk_names[k], 'missing': result['missing']}
+        report['chunks'].append(entry)
+        if result['missing']:
+            continue
+
+        entry.update(summarise(result['values'], result['counts'], bin_size))
+        entry['spikes'] = result['spikes']
+        all_counts[result['values'] + (1 << 15)] += result['counts']
+
+        for kind, positions in sorted(result['examples'].items()):
+            for row, col, value in positions:
+                lat, lng = cell_position(expected_res, chunk_r, chunk_c,
+                                         row, col)
+                report['suspicious'].append({
+                    'kind': kind, 'chunk': chunk_names[k], 'value': value,
+                    'row': row, 'col': col, 'lat': lat, 'lng': lng,
+                })
+
+    # Each chunk shares its last row with the chunk below, and its last
+    # column with the chunk to its right, wrapping around at 180 degrees
+    for k, result in enumerate(results):
+        chunk_r, chunk_c = divmod(k, cell_shape[1])
+        neighbours = [('right', 'left', 'column',
+                       chunk_r * cell_shape[1] + (chunk_c + 1) % cell_shape[1])]
+        if chunk_r + 1 < cell_shape[0]:
+            neighbours.append(('bottom', 'top', 'row', k + cell_shape[1]))
+
+        for edge, other_edge, kind, other in neighbours:
+            if result['missing'] or results[other]['missing']:
+                continue
+            mismatched, largest = check_seam(result['edges'][edge],
+                    results[other]['edges'][other_edge], tolerance)
+            report['seams'].append({
+                'chunks': [chunk_names[k], chunk_names[other]],
+                'kind': kind, 'mismatched': mismatched, 'largest': largest,
+            })
+
+    values = np.flatnonzero(all_counts)
+    report['summary'] = summarise(values - (1 << 15), all_counts[values],
+                                  bin_size)
+    report['summary']['spikes'] = sum(entry.get('spikes', 0)
+                                      for entry in report['chunks'])
+    report['missing'] = [entry['chunk'] for entry in report['chunks']
+                         if entry['missing']]
+    report['ok'] = not (report['missing'] or
+                        any(seam['mismatched'] for seam in report['seams']) or
+                        report['summary']['void'] or
+                        report['summary']['implausible'])
+    return report
+
+def format_report(report):
+    """Format a report from :func:`verify` for people to read."""
+    lines = ['{0:<6}{1:>8}{2:>8}{3:>10}{4:>10}{5:>12}{6:>8}'.format(
+        'Chunk', 'Min', 'Max', 'Mean', 'Void', 'Implausible', 'Spikes')]
+    for entry in report['chunks']:
+        if entry['missing']:
+            lines.append('{0:<6}missing'.format(entry['chunk']))
+            continue
+        lines.append('{0:<6}{1:>8}{2:>8}{3:>10}{4:>10}{5:>12}{6:>8}'.format(
+            entry['chunk'], entry['min'], entry['max'],
+            '-' if entry['mean'] is None else '{0:.1f}'.format(entry['mean']),
+            entry['void'], entry['implausible'], entry['spikes']))
+
+    bad_seams = [seam for seam in report['seams'] if seam['mismatched']]
+    lines += ['', '{0} of {1} seams match'.format(
+        len(report['seams']) - len(bad_seams), len(report['seams']))]
+    for seam in bad_seams:
+        lines.append('  {0}/{1}: {2} cells of the shared {3} differ, by up '
+                     'to {4} m'.format(seam['chunks'][0], seam['chunks'][1],
+                                       seam['mismatched'], seam['kind'],
+                                       seam['largest']))
+
+    if report['suspicious']:
+        lines += ['', 'Suspicious cells (up to {0} of each kind per chunk):'
+                      .format(MAX_EXAMPLES)]
+        for cell in report['suspicious']:
+            lines.append('  {0:<12}{1:>7} m  chunk {2} row {3} col {4} '
+                         '({5:.5f}, {6:.5f})'.format(cell['kind'],
+                         cell['value'], cell['chunk'], cell['row'],
+                         cell['col'], cell['lat'], cell['lng']))
+
+    lines += ['', 'Histogram:']
+    total = float(report['summary']['cells']) or 1
+    for low, count in report['summary']['histogram']:
+        lines.append('  {0:>7} {1:>14} {2:7.3f}%'.format(
+            low, count, 100 * count / total))
+
+    lines += ['', 'OK' if report['ok'] else 'PROBLEMS FOUND']
+    return '\n'.join(lines)
+
+def _parse_int(opts, name, minimum):
+    try:
+        value = int(opts[name])
+        if value < minimum:
+            raise ValueError()
+    except ValueError:
+        LOG.error('Invalid {0}: {1}'.format(name.lstrip('-'), opts[name]))
+        raise
+    return value
+
+def main():
+    opts = docopt.docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO if opts['--verbose'] else logging.WARN,
+        format='%(name)s:%(levelname)s: %(message)s'
+    )
+
+    try:
+        tile_res = parse_shape(opts['--tile-shape'], 'tile shape')
+        jobs = _parse_int(opts, '--jobs', 1)
+        spike = _parse_int(opts, '--spike', 0)
+        tolerance = _parse_int(opts, '--tolerance', 0)
+        bin_size = _parse_int(opts, '--bin-size', 1)
+    except ValueError:
+        return 1
+
+    ds_loc = opts['<dataset>'] or Dataset.default_location
+    report = verify(ds_loc, tile_res, jobs, spike, tolerance, bin_size)
+    if opts['--json']:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+    return 0 if report['ok'] else 1
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        LOG.error('Unrecoverable error: {0}'.format(e))
+        sys.exit(1)
@@ -16,7 +16,12 @@
 # You should have received a copy of the GNU General Public License
 # along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import print_function
+
+import os
+import shutil
 import sys
+import tempfile
 
 from setuptools import setup, Extension
 
@@ -26,10 +31,59 @@ try:
 except ImportError:
      cython_present = False
 
+# Set RUAUMOKO_OPENMP=0 to build without OpenMP, or =1 to insist on it. By
+# default OpenMP is used if the compiler supports it.
+OPENMP_FLAGS = ['-fopenmp']
+OPENMP_TEST = """
+#include <omp.h>
+int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }
+"""
+
+def have_openmp():
+    """Check whether the C compiler can build and link OpenMP code."""
+    from distutils.ccompiler import new_compiler
+    from distutils.errors import CCompilerError, DistutilsExecError
+    from distutils.sysconfig import customize_compiler
+
+    compiler = new_compiler()
+    customize_compiler(compiler)
+
+    tmp_dir = tempfile.mkdtemp(prefix='ruaumoko-openmp-')
+    try:
+        src = os.path.join(tmp_dir, 'test.c')
+        with open(src, 'w') as f:
+            f.write(OPENMP_TEST)
+        objects = compiler.compile([src], output_dir=tmp_dir,
+                extra_postargs=OPENMP_FLAGS)
+        compiler.link_executable(objects, os.path.join(tmp_dir, 'test'),
+                extra_postargs=OPENMP_FLAGS)
+    except (CCompilerError, DistutilsExecError):
+        return False
+    finally:
+        shutil.rmtree(tmp_dir)
+    return True
+
+openmp_setting = os.environ.get('RUAUMOKO_OPENMP', 'auto')
+if openmp_setting == '0':
+    use_openmp = False
+elif have_openmp():
+    use_openmp = True
+elif openmp_setting == '1':
+    sys.exit('RUAUMOKO_OPENMP=1 but the compiler does not support OpenMP')
+else:
+    print('OpenMP not available; building single-threaded dataset module',
+          file=sys.stderr)
+    use_openmp = False
+
+dataset_ext = Extension('ruaumoko.dataset', ['ruaumoko/dataset.pyx'],
+        extra_compile_args=OPENMP_FLAGS if use_openmp else [],
+        extra_link_args=OPENMP_FLAGS if use_openmp else [])
+
 if cython_present:
-    ext_modules = cythonize("ruaumoko/dataset.pyx")
+    ext_modules = cythonize([dataset_ext])
 else:
-    ext_modules = [Extension('ruaumoko.dataset', ['ruaumoko/dataset.c'])]
+    dataset_ext.sources = ['ruaumoko/dataset.c']
+    ext_modules = [dataset_ext]
 
 try:
     import pypandoc
@@ -46,9 +100,17 @@ def get_version():
 
 console_scripts = [
     "ruaumoko-api = ruaumoko.manager:main",
+    "ruaumoko-api-async = ruaumoko.aio:main",
     "ruaumoko-get = ruaumoko.get_cmd:main",
     "ruaumoko-download = ruaumoko.download:main",
     "ruaumoko-ascii-map = ruaumoko.asciiart:main",
+    "ruaumoko-build-overviews = ruaumoko.overviews:main",
+    "ruaumoko-convert = ruaumoko.tiles:main",
+    "ruaumoko-build-index = ruaumoko.index:main",
+    "ruaumoko-residency = ruaumoko.residency:main",
+    "ruaumoko-verify = ruaumoko.verify:main",
+    "ruaumoko-generate = ruaumoko.synthetic:main",
+    "ruaumoko-loadtest = ruaumoko.loadtest:main",
 ]
 
 setup(
@@ -74,9 +136,16 @@ setup(
         # Core functionality
         "magicmemoryview",
 
+        # Dataset tools
+        "numpy",
+
         # Downloader
-        "sh", "requests",
+        "requests", "futures; python_version < '3'",
     ],
+    extras_require={
+        # Asynchronous server
+        "async": ["uvicorn"],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Science/Research',
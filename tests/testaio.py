@@ -0,0 +1,181 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests of the asynchronous server.
+
+"""
+import asyncio
+import json
+import os
+import struct
+import threading
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from ruaumoko import Dataset, MissingChunkError
+import ruaumoko.api as api
+from ruaumoko.aio import ElevationApp, MicroBatcher
+
+from .util import MOCK_DATASET_PATH, MOCK_DATASET_TILE_SIZE, extract_mock_chunks
+
+class ThreadRecordingDataset(object):
+    """A dataset that records the threads single points are looked up on."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.threads = set()
+
+    def get_many(self, *args):
+        return self.dataset.get_many(*args)
+
+    def get(self, lat, lng):
+        self.threads.add(threading.current_thread())
+        return self.dataset.get(lat, lng)
+
+class TestAsync(TestCase):
+    def setUp(self):
+        self.ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.loop = asyncio.new_event_loop()
+
+        api.app.config['ELEVATION_DIRECTORY'] = MOCK_DATASET_PATH
+        api.app.config['ELEVATION_TILE_RESOLUTION'] = MOCK_DATASET_TILE_SIZE
+        self.config = dict(api.app.config, ELEVATION_BATCH_WINDOW=0.01,
+                ELEVATION_BATCH_SIZE=16)
+        self.app = ElevationApp(self.config)
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def request(self, path, method='GET', body=b'',
+                      content_type=b'application/json', headers=()):
+        """Make a request of the application, returning the status and body."""
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'headers': [(b'content-type', content_type)] + list(headers)}
+        await self.app(scope, receive, send)
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.headers = dict(sent[0]['headers'])
+        return sent[0]['status'], sent[1]['body']
+
+    def fetch(self, *requests):
+        """Make requests concurrently, returning their statuses and bodies."""
+        async def fetch_all():
+            return await asyncio.gather(*(self.request(*r) for r in requests))
+        return self.loop.run_until_complete(fetch_all())
+
+    def test_single_points(self):
+        points = [(lat, lng) for lat in range(-85, 90, 10) for lng in range(1, 360, 40)]
+        responses = self.fetch(*[('/{0},{1}'.format(*p),) for p in points])
+
+        for (lat, lng), (status, body) in zip(points, responses):
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body.decode())['elevation'], self.ds.get(lat, lng))
+
+        # Concurrent requests are coalesced into full batches
+        batcher = self.app.batcher
+        self.assertEqual(batcher.points, len(points))
+        self.assertEqual(batcher.batches, -(-len(points) // 16))
+
+    def test_caching(self):
+        self.fetch(('/10,10',))
+        etag = self.headers[b'etag']
+        self.assertIn(self.ds.build_id.encode(), etag)
+        self.assertIn(b'max-age', self.headers[b'cache-control'])
+        (status, _), = self.fetch(('/10,10', 'GET', b'', b'', [(b'if-none-match', etag)]))
+        self.assertEqual(status, 304)
+
+    def test_bad_points(self):
+        statuses = [status for status, _ in self.fetch(('/100,0',), ('/0,360',),
+                ('/a,b',), ('/',), ('/1,2,3',))]
+        self.assertEqual(statuses, [400, 400, 404, 404, 404])
+
+    def test_batch(self):
+        points = [[lat, lng] for lat in range(-85, 85, 5) for lng in range(1, 359, 10)]
+        (status, body), = self.fetch(('/batch', 'POST', json.dumps(points).encode()))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())['elevations'],
+                [self.ds.get(lat, lng) for lat, lng in points])
+
+        (status, body), = self.fetch(('/batch', 'POST', json.dumps([[0, 400]]).encode()))
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body.decode())['indices'], [0])
+
+    def test_batch_binary(self):
+        body = struct.pack('<4d', 52.2, 0.1, -33.9, 151.2)
+        (status, result), = self.fetch(('/batch', 'POST', body,
+                b'application/octet-stream'))
+        self.assertEqual(status, 200)
+        self.assertEqual(struct.unpack('<2h', result),
+                (self.ds.get(52.2, 0.1), self.ds.get(-33.9, 151.2)))
+
+    def test_window(self):
+        # A lone point is looked up once the window has passed
+        batcher = MicroBatcher(self.ds, window=0.001, max_size=100)
+
+        async def lookup():
+            return await batcher.lookup(10, 20)
+
+        elevation = self.loop.run_until_complete(lookup())
+        self.assertEqual(elevation, self.ds.get(10, 20))
+        self.assertEqual(batcher.batches, 1)
+
+    def test_missing_chunk(self):
+        tmp_dir = mkdtemp(prefix='ruaumoko.test.')
+        try:
+            extract_mock_chunks(tmp_dir)
+            os.unlink(os.path.join(tmp_dir, '15-H.tif'))
+            dataset = ThreadRecordingDataset(Dataset(tmp_dir,
+                    expected_res=MOCK_DATASET_TILE_SIZE))
+            batcher = MicroBatcher(dataset, window=0.001, max_size=100)
+
+            async def lookup():
+                return await asyncio.gather(batcher.lookup(10, 10),
+                        batcher.lookup(10, 270), return_exceptions=True)
+
+            present, missing = self.loop.run_until_complete(lookup())
+            self.assertEqual(present, self.ds.get(10, 10))
+            self.assertIsInstance(missing, MissingChunkError)
+
+            # Points are looked up again off the event loop
+            self.assertEqual(batcher.batches, 1)
+            self.assertTrue(dataset.threads)
+            self.assertNotIn(threading.current_thread(), dataset.threads)
+        finally:
+            rmtree(tmp_dir)
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        self.loop.run_until_complete(self.app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                'lifespan.shutdown.complete'])
+        self.assertIsNotNone(self.app.batcher)
@@ -1,13 +1,27 @@
 """
 Test of Flask-based web API.
 """
+import json
 import logging
+import os
+import struct
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import skipIf
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 from flask.ext.testing import TestCase
 from ruaumoko.dataset import Dataset
 from ruaumoko.api import app
+import ruaumoko.api as api
+from ruaumoko import polyline
+from ruaumoko.residency import read_heatmap
 
-from .util import MOCK_DATASET_PATH, MOCK_DATASET_TILE_SIZE
+from .util import MOCK_DATASET_PATH, MOCK_DATASET_TILE_SIZE, extract_mock_chunks
 
 LOG = logging.getLogger(__name__)
 
@@ -18,6 +32,31 @@ class TestAPI(TestCase):
         app.config['ELEVATION_TILE_RESOLUTION'] = MOCK_DATASET_TILE_SIZE
         return app
 
+    def setUp(self):
+        # Tests may change the settings and reopen the dataset; each starts
+        # from the same state, with a directory of its own for files
+        self.tmp_dir = mkdtemp(prefix='ruaumoko.test.')
+        self.metrics_dir = api.DEFAULT_METRICS_DIRECTORY
+        api.DEFAULT_METRICS_DIRECTORY = self.tmp_dir
+        api.open_dataset()
+        api.open_metrics()
+        self.config = dict(app.config)
+        self.opened = (api.elevation, api.result_cache, api.metrics)
+
+    def tearDown(self):
+        app.config.clear()
+        app.config.update(self.config)
+        api.elevation, api.result_cache, api.metrics = self.opened
+        api.DEFAULT_METRICS_DIRECTORY = self.metrics_dir
+        rmtree(self.tmp_dir)
+
+    def reopen(self, **settings):
+        """Change settings, and open the dataset and metrics again."""
+        app.config.update(settings)
+        api.elevation = api.result_cache = api.metrics = None
+        api.open_dataset()
+        api.open_metrics()
+
     def test_root(self):
         """Tests that the root route returns "not found"."""
         self.assert404(self.client.get('/'))
@@ -57,3 +96,332 @@ class TestAPI(TestCase):
         for lat in range(-85, 85, 5):
             for lng in range(1, 359, 10):
                 compare_request(lat, lng, self.client.get('/{0},{1}'.format(lat,lng)))
+
+    def post_json(self, url, body):
+        return self.client.post(url, data=json.dumps(body),
+                content_type='application/json')
+
+    def test_batch(self):
+        """Tests that a batch of points gives the same results as
+        Dataset.get().
+
+        """
+        ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        points = [[lat, lng] for lat in range(-85, 85, 5) for lng in range(1, 359, 10)]
+
+        resp = self.post_json('/batch', points)
+        self.assert200(resp)
+        self.assertEqual(resp.json['elevations'], [ds.get(lat, lng) for lat, lng in points])
+
+    def test_batch_polyline(self):
+        """Tests that points may be given as a polyline."""
+        ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        lats = [52.2, 40.7, -33.9]
+        lngs = [0.1, 286.0, 151.2]
+        encoded = polyline.encode(lats, lngs)
+        expected = [ds.get(lat, lng) for lat, lng in zip(lats, lngs)]
+
+        resp = self.client.get('/batch', query_string={'polyline': encoded})
+        self.assert200(resp)
+        self.assertEqual(resp.json['elevations'], expected)
+
+        resp = self.post_json('/batch', {'polyline': encoded})
+        self.assert200(resp)
+        self.assertEqual(resp.json['elevations'], expected)
+
+    def test_batch_bad_points(self):
+        """Tests that malformed and out of range points are rejected."""
+        self.assert400(self.client.post('/batch', data='not json'))
+        self.assert400(self.post_json('/batch', {'points': []}))
+        self.assert400(self.post_json('/batch', [[1, 2, 3]]))
+        self.assert400(self.post_json('/batch', [['a', 'b']]))
+        self.assert400(self.client.get('/batch', query_string={'polyline': '_p~iF~ps|'}))
+
+        resp = self.post_json('/batch', [[0, 0], [100, 0], [0, 1], [0, 400]])
+        self.assert400(resp)
+        self.assertEqual(resp.json['indices'], [1, 3])
+
+    def test_batch_too_large(self):
+        app.config['ELEVATION_MAX_BATCH_SIZE'] = 2
+        self.assertStatus(self.post_json('/batch', [[0, 0]] * 3), 413)
+        self.assert200(self.post_json('/batch', [[0, 0]] * 2))
+
+    def test_batch_binary(self):
+        """Tests packed binary batches."""
+        ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        points = [(lat, lng) for lat in range(-85, 85, 5) for lng in range(1, 359, 10)]
+        body = b''.join(struct.pack('<dd', lat, lng) for lat, lng in points)
+
+        resp = self.client.post('/batch', data=body,
+                content_type='application/octet-stream')
+        self.assert200(resp)
+        self.assertEqual(resp.mimetype, 'application/octet-stream')
+        elevations = struct.unpack('<{0}h'.format(len(points)), resp.data)
+        self.assertEqual(list(elevations), [ds.get(lat, lng) for lat, lng in points])
+
+        # Truncated and out of range points
+        self.assert400(self.client.post('/batch', data=body[:-8],
+                content_type='application/octet-stream'))
+        resp = self.client.post('/batch', data=struct.pack('<4d', 0, 0, 0, 360),
+                content_type='application/octet-stream')
+        self.assert400(resp)
+        self.assertEqual(resp.json['indices'], [1])
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_batch_msgpack(self):
+        """Tests msgpack batches, with packed and unpacked points."""
+        ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        points = [(lat, lng) for lat in range(-85, 85, 15) for lng in range(1, 359, 30)]
+        expected = [ds.get(lat, lng) for lat, lng in points]
+        packed = b''.join(struct.pack('<dd', lat, lng) for lat, lng in points)
+
+        for body in ({'points': packed}, {'points': [list(p) for p in points]}):
+            resp = self.client.post('/batch', data=msgpack.packb(body, use_bin_type=True),
+                    content_type='application/msgpack')
+            self.assert200(resp)
+            elevations = msgpack.unpackb(resp.data, raw=False)['elevations']
+            self.assertEqual(list(struct.unpack('<{0}h'.format(len(points)), elevations)),
+                    expected)
+
+        self.assert400(self.client.post('/batch', data=b'\xc1',
+                content_type='application/msgpack'))
+
+    def test_profile(self):
+        """Tests that the profile route matches Dataset.profile()."""
+        ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        lats, lngs = [52.2, 40.7, -33.9], [0.1, 286.0, 151.2]
+        distances, elevations = ds.profile(lats, lngs, step=100000, method='bilinear')
+
+        resp = self.post_json('/profile?step=100000&method=bilinear',
+                [list(p) for p in zip(lats, lngs)])
+        self.assert200(resp)
+        self.assertEqual(resp.json['distances'], distances.tolist())
+        self.assertEqual(resp.json['elevations'], elevations.tolist())
+
+        self.assert400(self.post_json('/profile?step=far', [[0, 0], [1, 1]]))
+        self.assert400(self.post_json('/profile?method=spline', [[0, 0], [1, 1]]))
+        self.assert400(self.post_json('/profile', [[0, 0], [0, 180]]))
+        self.assert400(self.post_json('/profile', []))
+
+    def test_intersect(self):
+        """Tests the ground intersection route."""
+        ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        trajectory = [[40 - k * 0.2, 70 + k * 0.2, 20000 - k * 200, k * 10.0]
+                for k in range(101)]
+        expected = ds.intersect(*zip(*trajectory))
+
+        resp = self.post_json('/intersect', trajectory)
+        self.assert200(resp)
+        found = resp.json['intersection']
+        self.assertEqual(
+            [found['latitude'], found['longitude'], found['altitude'], found['time']],
+            list(expected))
+
+        resp = self.post_json('/intersect', [[0, 10, 9000, 0], [0, 20, 8000, 1]])
+        self.assert200(resp)
+        self.assertIsNone(resp.json['intersection'])
+
+        self.assert400(self.post_json('/intersect', [[0, 10, 9000]]))
+        self.assert400(self.post_json('/intersect', []))
+        self.assert400(self.post_json('/intersect', [[0, 10, 9000, 0], [95, 10, 0, 1]]))
+        self.assert400(self.post_json('/intersect?method=bicubic', [[0, 10, 9000, 0]]))
+
+    def test_open_options(self):
+        """Tests that warm-up and access options are applied on opening."""
+        self.reopen(ELEVATION_ACCESS_ADVICE='random',
+                    ELEVATION_WARM=[(0, 0), (10, 10, -10, 20)])
+        self.assertIsNot(api.elevation, self.opened[0])
+
+        # Opening again leaves the dataset alone
+        ds = api.elevation
+        api.open_dataset()
+        self.assertIs(api.elevation, ds)
+
+        self.assertRaises(ValueError, self.reopen,
+                          ELEVATION_ACCESS_ADVICE='soon')
+
+    def test_access_heatmap(self):
+        """Tests that sampled access counts are saved per process."""
+        self.reopen(ELEVATION_ACCESS_SAMPLING=1,
+                    ELEVATION_ACCESS_HEATMAP=os.path.join(self.tmp_dir, 'heat'))
+        self.assert200(self.post_json('/batch', [[0, 0], [10, 10], [20, 20]]))
+
+        path = api.save_heatmap()
+        self.assertEqual(path, os.path.join(self.tmp_dir,
+                                            'heat.{0}'.format(os.getpid())))
+        counts = read_heatmap(path)[3]
+        self.assertEqual(counts.sum(), 3)
+
+    def test_caching_headers(self):
+        """Tests that GET responses may be cached until the dataset changes."""
+        resp = self.client.get('/52,1')
+        self.assert200(resp)
+        etag = resp.headers['ETag']
+        self.assertIn(Dataset(MOCK_DATASET_PATH,
+                expected_res=MOCK_DATASET_TILE_SIZE).build_id, etag)
+        self.assertIn('Last-Modified', resp.headers)
+        self.assertIn('public', resp.headers['Cache-Control'])
+        self.assertIn('max-age=604800', resp.headers['Cache-Control'])
+
+        self.assertStatus(self.client.get('/52,1',
+                headers={'If-None-Match': etag}), 304)
+        self.assertStatus(self.client.get('/10,10',
+                headers={'If-Modified-Since': resp.headers['Last-Modified']}), 304)
+        self.assert200(self.client.get('/52,1',
+                headers={'If-None-Match': '"other-build"'}))
+
+        resp = self.client.get('/batch', query_string={
+            'polyline': polyline.encode([52.2], [0.1])})
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        # Errors and POST requests aren't cached
+        self.assertNotIn('ETag', self.client.get('/100,0').headers)
+        self.assertNotIn('ETag', self.post_json('/batch', [[0, 0]]).headers)
+
+        # Invalid requests fail even if the client has a copy
+        for path in ['/abc,def', '/100,0']:
+            self.assert400(self.client.get(path, headers={'If-None-Match': etag}))
+        self.assert400(self.client.get('/batch', headers={'If-None-Match': etag},
+            query_string={'polyline': polyline.encode([95], [0.1])}))
+
+        # Nor are GET requests whose points are in the body, which caches
+        # keyed by URL would share
+        resp = self.client.get('/batch', data=json.dumps([[52.2, 0.1]]),
+                               headers={'If-None-Match': etag})
+        self.assert200(resp)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertIn('no-store', resp.headers['Cache-Control'])
+        self.assertIn('private', resp.headers['Cache-Control'])
+
+    def test_snap_redirect(self):
+        """Tests that positions are redirected to the centres of their cells."""
+        ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        app.config['ELEVATION_SNAP_REDIRECT'] = True
+        resp = self.client.get('/52.2,1.3')
+        self.assertStatus(resp, 301)
+        self.assertIn('ETag', resp.headers)
+        location = resp.headers['Location']
+        self.assertTrue(location.endswith('/50,0'), location)
+
+        resp = self.client.get('/50,0')
+        self.assert200(resp)
+        self.assertEqual(resp.json['elevation'], ds.get(52.2, 1.3))
+
+        # Cells at the antimeridian and below the equator
+        for lat, lng in [(-0.0001, 179.9), (-87.6, 359.99), (33.3, 12.6)]:
+            resp = self.client.get('/{0},{1}'.format(lat, lng))
+            self.assertStatus(resp, 301)
+            path = resp.headers['Location'].split('/')[-1]
+            resp = self.client.get('/' + path)
+            self.assert200(resp)
+            self.assertEqual(resp.json['elevation'], ds.get(lat, lng))
+
+    def test_result_cache(self):
+        """Tests that profiles are shared through the result cache."""
+        self.assert404(self.client.get('/cache-stats'))
+        self.reopen(ELEVATION_RESULT_CACHE=os.path.join(self.tmp_dir, 'cache'),
+                    ELEVATION_RESULT_CACHE_SIZE=1024 * 1024)
+
+        points = [[52.2, 0.1], [40.7, 286.0]]
+        first = self.post_json('/profile?step=100000', points)
+        self.assert200(first)
+
+        # The same points as a polyline are the same query
+        second = self.client.get('/profile', query_string={'step': '100000',
+            'polyline': polyline.encode(*zip(*points))})
+        self.assert200(second)
+        self.assertEqual(first.json, second.json)
+
+        self.assert200(self.post_json('/profile?step=200000', points))
+        self.assert400(self.post_json('/profile', [[52.2, 0.1], [-52.2, 180.1]]))
+
+        stats = self.client.get('/cache-stats').json
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (1, 3, 2))
+
+    def test_metrics(self):
+        """Tests that requests are counted in the metrics."""
+        self.reopen(ELEVATION_METRICS=os.path.join(self.tmp_dir, 'metrics'))
+        metrics = api.metrics
+
+        self.assert200(self.client.get('/52.2,0.1'))
+        self.assert400(self.client.get('/100,0'))
+        self.assert404(self.client.get('/'))
+        self.assert200(self.post_json('/batch', [[0, 0], [1, 1], [2, 2]]))
+        self.assert400(self.post_json('/batch', [[0, 0], [100, 0]]))
+
+        point = '/<latitude>,<longitude>'
+        self.assertEqual(metrics.value('requests_total', point, '2xx'), 1)
+        self.assertEqual(metrics.value('out_of_range_total', point), 1)
+        self.assertEqual(metrics.value('requests_total', 'other', '4xx'), 1)
+        self.assertEqual(metrics.value('out_of_range_total', '/batch'), 1)
+
+        resp = self.client.get('/metrics')
+        self.assert200(resp)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        text = resp.get_data(as_text=True)
+        self.assertIn('ruaumoko_requests_total{route="/batch",code="4xx"} 1\n', text)
+        self.assertIn('ruaumoko_batch_size_bucket{route="/batch",le="10"} 2\n', text)
+        self.assertIn('ruaumoko_batch_size_sum{route="/batch"} 5\n', text)
+        # Batches out of range are rejected without looking any points up
+        self.assertIn('ruaumoko_lookup_duration_seconds_count{route="/batch"} 1\n', text)
+        self.assertIn('ruaumoko_page_faults_total{route="/batch",type="major"}', text)
+
+    def test_metrics_default(self):
+        """Tests that workers started separately share the default metrics."""
+        pids = []
+        for requests in (2, 3):
+            pid = os.fork()
+            if pid == 0:
+                # As a worker of a server that doesn't preload the application
+                code = 1
+                try:
+                    self.reopen()
+                    for _ in range(requests):
+                        self.client.get('/52.2,0.1')
+                    code = 0
+                finally:
+                    os._exit(code)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        self.reopen()
+        self.assertEqual(api.metrics.value('requests_total',
+            '/<latitude>,<longitude>', '2xx'), 5)
+        path = api.default_metrics_path()
+        self.assertEqual(os.listdir(self.tmp_dir),
+                         [os.path.basename(api.metrics.path)])
+        self.assertTrue(api.metrics.path.startswith(path))
+
+        # Another dataset has metrics of its own
+        app.config['ELEVATION_DIRECTORY'] = self.tmp_dir
+        self.assertNotEqual(api.default_metrics_path(), path)
+
+    def test_split_dataset(self):
+        """Tests serving a directory of chunks, some of them missing."""
+        extract_mock_chunks(self.tmp_dir)
+        os.unlink(os.path.join(self.tmp_dir, '15-H.tif'))
+        self.reopen(ELEVATION_DIRECTORY=self.tmp_dir)
+        resp = self.client.get('/10,10')
+        self.assert200(resp)
+        self.assertEqual(resp.json['elevation'], self.opened[0].get(10, 10))
+
+        resp = self.client.get('/10,270')
+        self.assertStatus(resp, 503)
+        self.assertEqual(resp.json['chunk'], 'H')
+        self.assertStatus(self.post_json('/batch', [[10, 10], [10, 270]]), 503)
+
+        # A chunk that can't be read is the server's fault, not the client's
+        with open(os.path.join(self.tmp_dir, '15-H.tif'), 'wb') as f:
+            f.write(b'not a chunk')
+        out_of_range = api.metrics.value('out_of_range_total',
+                                         '/<latitude>,<longitude>')
+        resp = self.client.get('/10,270')
+        self.assertStatus(resp, 503)
+        self.assertEqual(resp.json['chunk'], 'H')
+        self.assertEqual(api.metrics.value('out_of_range_total',
+                '/<latitude>,<longitude>'), out_of_range)
+        os.unlink(os.path.join(self.tmp_dir, '15-H.tif'))
+
+        self.reopen(ELEVATION_MISSING_FILL=0)
+        self.assertEqual(self.client.get('/10,270').json['elevation'], 0)
@@ -1,12 +1,17 @@
+from array import array
 from tempfile import mkdtemp
 from shutil import rmtree
+import json
 import logging
+import math
 import os
-from unittest import TestCase
+from unittest import TestCase, SkipTest
 
-from .util import MOCK_DATASET_PATH
+from .util import MOCK_DATASET_PATH, extract_mock_chunks
 
-from ruaumoko import Dataset
+from ruaumoko import Dataset, MissingChunkError, BadChunkError, OutOfRangeError
+from ruaumoko.dataset import manifest_path
+from ruaumoko.dataset import earth_radius
 
 LOG = logging.getLogger(__name__)
 
@@ -19,3 +24,345 @@ class TestGet(TestCase):
     def test_create_dataset(self):
         """Check a dataset may be successfully opened."""
         ds = Dataset(MOCK_DATASET_PATH, expected_res=(20,10))
+
+class TestGetMany(TestCase):
+    def setUp(self):
+        self.ds = Dataset(MOCK_DATASET_PATH, expected_res=(20,10))
+
+    def grid(self):
+        points = [(lat, lng) for lat in range(-90, 91, 5) for lng in range(0, 360, 7)]
+        points.append((45, 359.99))
+        return ([float(p[0]) for p in points], [float(p[1]) for p in points])
+
+    def test_matches_get(self):
+        """Check get_many() agrees with get() for every point."""
+        lats, lngs = self.grid()
+        result = self.ds.get_many(array('d', lats), array('d', lngs))
+        self.assertEqual(len(result), len(lats))
+        for lat, lng, elev in zip(lats, lngs, result):
+            self.assertEqual(elev, self.ds.get(lat, lng))
+
+    def test_sequences_and_output_buffer(self):
+        """Check plain sequences are accepted and results go into `out`."""
+        lats, lngs = self.grid()
+        out = array('h', [0] * len(lats))
+        result = self.ds.get_many(lats, lngs, out=out)
+        self.assertIs(result, out)
+        self.assertEqual(list(out), list(self.ds.get_many(array('d', lats), array('d', lngs))))
+
+    def test_out_of_range(self):
+        """Check all out of range points are reported."""
+        lats = [0.0, 91.0, 10.0, -90.5, 0.0]
+        lngs = [0.0, 0.0, 360.0, 10.0, 10.0]
+        try:
+            self.ds.get_many(lats, lngs)
+        except OutOfRangeError as e:
+            self.assertEqual(e.indices, [1, 2, 3])
+            self.assertIsInstance(e, ValueError)
+        else:
+            self.fail('OutOfRangeError not raised')
+
+    def test_threads(self):
+        """Check multi-threaded lookups agree with single-threaded ones."""
+        n = 20000
+        lats = array('d', (-90 + (k * 0.37) % 180 for k in range(n)))
+        lngs = array('d', ((k * 1.13) % 360 for k in range(n)))
+        expected = self.ds.get_many(lats, lngs)
+        for threads in (0, 2, 4):
+            self.assertEqual(self.ds.get_many(lats, lngs, threads=threads), expected)
+        self.assertRaises(ValueError, self.ds.get_many, lats, lngs, threads=-1)
+
+    def test_length_mismatch(self):
+        self.assertRaises(ValueError, self.ds.get_many, [0.0, 1.0], [0.0])
+        self.assertRaises(ValueError, self.ds.get_many, [0.0], [0.0], array('h', [0, 0]))
+
+class TestInterpolate(TestCase):
+    def setUp(self):
+        self.ds = Dataset(MOCK_DATASET_PATH, expected_res=(20,10))
+        # Cells per degree in the mock dataset
+        self.lat_res = 9 / 45.0
+        self.lng_res = 19 / 60.0
+
+    def cell_position(self, row, col):
+        return 90 - row / self.lat_res, (col / self.lng_res - 180) % 360
+
+    def test_cell_centres(self):
+        """Check every method reproduces the data at cell centres."""
+        for row in range(0, 37, 3):
+            for col in range(0, 114, 5):
+                lat, lng = self.cell_position(row, col)
+                expected = self.ds.get(lat, lng)
+                for method in ('nearest', 'bilinear', 'bicubic'):
+                    self.assertAlmostEqual(
+                        self.ds.interpolate(lat, lng, method), expected, places=6)
+
+    def test_bilinear_midpoints(self):
+        """Check bilinear interpolation half way between cells, including
+        across chunk boundaries (row 9, column 19) and the antimeridian."""
+        for row, col in ((4, 10), (8, 18), (9, 19), (27, 113), (35, 0)):
+            lat, lng = self.cell_position(row + 0.5, col)
+            above = self.ds.get(*self.cell_position(row, col))
+            below = self.ds.get(*self.cell_position(row + 1, col))
+            self.assertAlmostEqual(self.ds.interpolate(lat, lng), (above + below) / 2.0)
+
+            lat, lng = self.cell_position(row, col + 0.5)
+            left = self.ds.get(*self.cell_position(row, col))
+            right = self.ds.get(*self.cell_position(row, (col + 1) % 114))
+            self.assertAlmostEqual(self.ds.interpolate(lat, lng), (left + right) / 2.0)
+
+    def test_antimeridian_continuity(self):
+        for method in ('bilinear', 'bicubic'):
+            for lat in (-60.1, -12.3, 0, 33.3, 71.9):
+                self.assertAlmostEqual(
+                    self.ds.interpolate(lat, 180 - 1e-9, method),
+                    self.ds.interpolate(lat, 180, method), places=4)
+
+    def test_poles(self):
+        for method in ('bilinear', 'bicubic'):
+            for row in (0, 36):
+                lat, lng = self.cell_position(row, 50)
+                self.assertAlmostEqual(self.ds.interpolate(lat, lng, method), self.ds.get(lat, lng))
+
+    def test_many_matches_scalar(self):
+        lats = array('d', (-89 + k * 0.731 % 178 for k in range(5000)))
+        lngs = array('d', ((k * 2.17) % 360 for k in range(5000)))
+        for method in ('nearest', 'bilinear', 'bicubic'):
+            result = self.ds.interpolate_many(lats, lngs, method, threads=2)
+            for lat, lng, elev in list(zip(lats, lngs, result))[::50]:
+                self.assertEqual(elev, self.ds.interpolate(lat, lng, method))
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, self.ds.interpolate, 0, 0, 'spline')
+        self.assertRaises(ValueError, self.ds.interpolate, 91, 0)
+        self.assertRaises(OutOfRangeError, self.ds.interpolate_many, [0.0, 0.0], [0.0, 360.0])
+
+class TestProfile(TestCase):
+    def setUp(self):
+        self.ds = Dataset(MOCK_DATASET_PATH, expected_res=(20,10))
+
+    def test_great_circle(self):
+        """Check sampling along a meridian, where the path is easy to follow."""
+        distances, elevations = self.ds.profile([60, -30], [10, 10], step=1000000)
+        self.assertEqual(len(distances), len(elevations))
+        # 10000 km at no more than 1000 km steps
+        self.assertEqual(len(distances), 12)
+        self.assertAlmostEqual(distances[-1], earth_radius * math.pi / 2, places=3)
+        for distance, elev in zip(distances, elevations):
+            lat = 60 - math.degrees(distance / earth_radius)
+            self.assertEqual(elev, self.ds.get(max(-90, lat), 10))
+
+    def test_step_limits(self):
+        """Check the step never goes below the resolution or over max_samples."""
+        fine = self.ds.profile([0, 0], [10, 50], step=1)[0]
+        default = self.ds.profile([0, 0], [10, 50])[0]
+        self.assertEqual(len(fine), len(default))
+        self.assertLessEqual(len(self.ds.profile([0, 0, 20], [10, 50, 50], max_samples=3)[0]), 3)
+
+    def test_waypoints(self):
+        """Check each waypoint is sampled and distances accumulate."""
+        lats, lngs = [10, 10, -20], [350, 5, 5]
+        distances, elevations = self.ds.profile(lats, lngs, step=200000)
+        self.assertEqual(list(distances), sorted(distances))
+        self.assertEqual(elevations[0], self.ds.get(10, 350))
+        self.assertEqual(elevations[-1], self.ds.get(-20, 5))
+
+    def test_bad_paths(self):
+        self.assertRaises(ValueError, self.ds.profile, [], [])
+        self.assertRaises(ValueError, self.ds.profile, [0, 0], [0, 180])
+        self.assertRaises(OutOfRangeError, self.ds.profile, [0, 95], [0, 0])
+
+class TestIntersect(TestCase):
+    def setUp(self):
+        self.ds = Dataset(MOCK_DATASET_PATH, expected_res=(20,10))
+
+    def descent(self, lat0, lng0, lat1, lng1, n=100, top=20000.0, bottom=-500.0):
+        lats = [lat0 + (lat1 - lat0) * k / (n - 1.0) for k in range(n)]
+        lngs = [(lng0 + (lng1 - lng0) * k / (n - 1.0)) % 360 for k in range(n)]
+        alts = [top + (bottom - top) * k / (n - 1.0) for k in range(n)]
+        return lats, lngs, alts
+
+    def test_intersection_on_ground(self):
+        """Check the intersection is on the ground and that the trajectory
+        is above ground before it."""
+        for path in ((40, 70, 20, 90), (10, 175, -10, 185), (60, 350, 50, 10)):
+            lats, lngs, alts = self.descent(*path)
+            times = [k * 10.0 for k in range(len(lats))]
+            lat, lng, alt, t = self.ds.intersect(lats, lngs, alts, times)
+            self.assertAlmostEqual(alt, self.ds.interpolate(lat, lng), places=3)
+
+            # Samples before the intersection are above ground
+            for k in range(len(lats)):
+                if times[k] >= t:
+                    break
+                self.assertGreater(alts[k], self.ds.interpolate(lats[k], lngs[k]))
+
+    def test_matches_nearest(self):
+        lats, lngs, alts = self.descent(40, 70, 20, 90)
+        lat, lng, alt, t = self.ds.intersect(lats, lngs, alts, method='nearest')
+        self.assertAlmostEqual(alt, self.ds.get(lat, lng), delta=1)
+
+    def test_no_intersection(self):
+        lats, lngs, alts = self.descent(40, 70, 20, 90, bottom=9000)
+        self.assertIsNone(self.ds.intersect(lats, lngs, alts))
+        self.assertIsNone(self.ds.intersect([0], [10], [1000]))
+        self.assertEqual(self.ds.intersect([0], [10], [100]), (0, 10, 100, 0))
+
+    def test_starts_underground(self):
+        self.assertEqual(self.ds.intersect([0, 1], [10, 11], [-1000, 100], [5, 6]),
+                (0, 10, -1000, 5))
+
+    def test_void(self):
+        """Check that blocks of voids, whose maximum is the lowest int16, are
+        summarised like any others."""
+        tmp_dir = mkdtemp(prefix='ruaumoko.test.')
+        try:
+            path = os.path.join(tmp_dir, 'void')
+            with open(path, 'wb') as f:
+                array('h', [-32768] * (24 * 20 * 10)).tofile(f)
+            ds = Dataset(path, expected_res=(20, 10))
+            lats, lngs, alts = self.descent(40, 70, 20, 90, bottom=-30000)
+            for _ in range(2):
+                self.assertIsNone(ds.intersect(lats, lngs, alts))
+            lats, lngs, alts = self.descent(40, 70, 20, 90, bottom=-40000)
+            lat, lng, alt, t = ds.intersect(lats, lngs, alts)
+            self.assertAlmostEqual(alt, -32768, delta=1)
+        finally:
+            rmtree(tmp_dir)
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, self.ds.intersect, [0, 1], [0, 1], [0])
+        self.assertRaises(ValueError, self.ds.intersect, [0, 1], [0, 1], [0, 1], [0])
+        self.assertRaises(ValueError, self.ds.intersect, [0], [0], [0], method='bicubic')
+        self.assertRaises(ValueError, self.ds.intersect, [], [], [])
+
+class TestMemory(TestCase):
+    def setUp(self):
+        self.ds = Dataset(MOCK_DATASET_PATH, expected_res=(20,10))
+        self.size = os.path.getsize(MOCK_DATASET_PATH)
+
+    def test_advise(self):
+        for advice in ('random', 'sequential', 'willneed', 'normal'):
+            self.ds.advise(advice)
+        self.ds.advise('willneed', (1, 2))
+        self.ds.advise('random', (10, 350, -10, 10))
+
+    def test_warm(self):
+        page = 4096
+        whole = self.ds.warm()
+        self.assertEqual(whole, self.size + -self.size % page)
+
+        # A chunk is 400 bytes, and only the rows of a box are needed
+        self.assertLessEqual(self.ds.warm((3, 5)), 2 * page)
+        self.assertLessEqual(self.ds.warm((1, 1, 0, 2)), 2 * page)
+        self.assertEqual(self.ds.warm((-90, 0, 90, 359.9)), whole)
+
+        self.assertEqual(self.ds.get(1, 1), Dataset(MOCK_DATASET_PATH,
+                expected_res=(20,10)).get(1, 1))
+
+    def test_lock(self):
+        try:
+            self.ds.lock((1, 2))
+        except OSError as e:
+            raise SkipTest('Cannot lock memory: {0}'.format(e))
+        self.ds.unlock((1, 2))
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, self.ds.advise, 'soon')
+        self.assertRaises(ValueError, self.ds.warm, (4, 0))
+        self.assertRaises(ValueError, self.ds.warm, (0, 0, 0))
+        self.assertRaises(ValueError, self.ds.warm, (100, 0, 0, 0))
+
+class TestSplit(TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='ruaumoko.test.')
+        extract_mock_chunks(self.tmp_dir)
+        self.raw = Dataset(MOCK_DATASET_PATH, expected_res=(20,10))
+
+        lats, lngs = array('d'), array('d')
+        for lat in range(-90, 91, 7):
+            for lng in range(0, 360, 11):
+                lats.append(lat + 0.3)
+                lngs.append(lng + 0.7)
+        lats[-1] = 90
+        self.points = lats, lngs
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_matches_single_file(self):
+        ds = Dataset(self.tmp_dir, expected_res=(20,10))
+        self.assertEqual(ds.layout, 'split')
+        self.assertEqual(ds.missing_chunks, [])
+        self.assertEqual(ds.get_many(*self.points, threads=4),
+                         self.raw.get_many(*self.points))
+        self.assertEqual(ds.interpolate_many(*self.points, method='bicubic'),
+                         self.raw.interpolate_many(*self.points, method='bicubic'))
+
+    def test_memory(self):
+        ds = Dataset(self.tmp_dir + os.sep, expected_res=(20,10))
+        ds.advise('random')
+        self.assertEqual(ds.warm(), 24 * 4096)
+        self.assertEqual(ds.warm((1, 2)), 4096)
+        self.assertEqual(ds.resident((1, 2)), (4096, 4096))
+        self.assertEqual(len(ds.tile_residency(8)), 24 * 2 * 3)
+
+    def test_missing_chunk(self):
+        os.unlink(os.path.join(self.tmp_dir, '15-H.tif'))
+        ds = Dataset(self.tmp_dir, expected_res=(20,10))
+        self.assertEqual(ds.missing_chunks, ['H'])
+
+        # Other chunks are unaffected; H is 0 to 45N, 120W to 60W
+        self.assertEqual(ds.get(10, 10), self.raw.get(10, 10))
+        try:
+            ds.get(10, 270)
+        except MissingChunkError as e:
+            self.assertEqual(e.chunk, 'H')
+        else:
+            self.fail('Missing chunk was read')
+        self.assertRaises(MissingChunkError, ds.get_many, *self.points)
+        self.assertEqual(ds.warm((1, 1)), 0)
+
+    def test_bad_chunk(self):
+        chunk = os.path.join(self.tmp_dir, '15-H.tif')
+        with open(chunk, 'r+b') as f:
+            f.truncate(100)
+        self.assertRaises(BadChunkError, Dataset, self.tmp_dir,
+                          expected_res=(20,10))
+
+        # Or if it is damaged once the dataset is open
+        extract_mock_chunks(self.tmp_dir)
+        ds = Dataset(self.tmp_dir, expected_res=(20,10), missing=0)
+        with open(chunk, 'r+b') as f:
+            f.truncate(100)
+        try:
+            ds.get(10, 270)
+        except BadChunkError as e:
+            self.assertEqual(e.chunk, 'H')
+            self.assertNotIsInstance(e, ValueError)
+        else:
+            self.fail('Bad chunk was read')
+        self.assertEqual(ds.get(10, 10), self.raw.get(10, 10))
+
+    def test_missing_fill(self):
+        os.unlink(os.path.join(self.tmp_dir, '15-H.tif'))
+        ds = Dataset(self.tmp_dir, expected_res=(20,10), missing=-9999)
+        self.assertEqual(ds.get(10, 270), -9999)
+        self.assertEqual(ds.get(10, 10), self.raw.get(10, 10))
+
+    def test_manifest_names(self):
+        # As written by ruaumoko-download --chunk-file-prefix
+        entries = {}
+        for k, name in enumerate('ABCDEFGHIJKLMNOPQRSTUVWX'):
+            filename = 'chunk-{0:02d}.tiff'.format(k)
+            os.rename(os.path.join(self.tmp_dir, '15-{0}.tif'.format(name)),
+                      os.path.join(self.tmp_dir, filename))
+            entries[name] = {'file': filename}
+        with open(manifest_path(self.tmp_dir), 'w') as f:
+            json.dump({'resolution': [20, 10], 'chunks': entries}, f)
+
+        try:
+            ds = Dataset(self.tmp_dir, expected_res=(20,10))
+            self.assertEqual(ds.get_many(*self.points),
+                             self.raw.get_many(*self.points))
+        finally:
+            os.unlink(manifest_path(self.tmp_dir))
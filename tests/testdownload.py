@@ -29,11 +29,17 @@ try:
 except ImportError:
     from mock import patch
 
+import numpy as np
 import responses
 
+from ruaumoko import Dataset
+from ruaumoko.dataset import index_path, overview_path
 import ruaumoko.download as rd
+import ruaumoko.index as ri
+import ruaumoko.overviews as ro
 
-from .util import TemporaryDirectoryTestCase, responses_add_dem_mocks
+from .util import (TemporaryDirectoryTestCase, responses_add_dem_mocks,
+        MOCK_DATASET_PATH)
 
 LOG = logging.getLogger(__name__)
 
@@ -85,6 +91,27 @@ class TestFullStackDownloader(TemporaryDirectoryTestCase):
 
         self.check_single_file_download(2, tgt_path, ws_dir)
 
+    @responses.activate
+    def test_download_matches_mock_dataset(self):
+        responses_add_dem_mocks()
+        ws_dir, tgt_path = self.prepare_single_file_download()
+
+        with open(tgt_path, 'wb') as tgt:
+            rd.download(tgt, ws_dir, expect_res=(20,10), jobs=8)
+
+        with open(tgt_path, 'rb') as f, open(MOCK_DATASET_PATH, 'rb') as expected:
+            self.assertEqual(f.read(), expected.read())
+
+    @responses.activate
+    def test_download_two_chunks_in_parallel(self):
+        responses_add_dem_mocks()
+        ws_dir, tgt_path = self.prepare_single_file_download()
+
+        with open(tgt_path, 'w+b') as tgt:
+            rd.download(tgt, ws_dir, chunks=('A', 'X'), expect_res=(20,10), jobs=2)
+
+        self.check_single_file_download(2, tgt_path, ws_dir)
+
     @responses.activate
     def test_download_all_chunks(self):
         responses_add_dem_mocks()
@@ -194,3 +221,180 @@ class TestFullStackDownloader(TemporaryDirectoryTestCase):
         with patch('sys.argv', new_argv):
             status = rd.main()
         self.assertEqual(status, 1)
+
+class TestFetch(TemporaryDirectoryTestCase):
+    url = 'http://example.com/file.zip'
+    body = bytes(bytearray(range(256))) * 100
+
+    def range_callback(self, request):
+        """Serve self.body, honouring Range headers like a real server."""
+        self.ranges.append(request.headers.get('Range'))
+        if 'Range' not in request.headers:
+            return (200, {}, self.body)
+        start = int(request.headers['Range'][len('bytes='):-1])
+        if start >= len(self.body):
+            return (416, {'Content-Range': 'bytes */{0}'.format(len(self.body))}, b'')
+        return (206, {}, self.body[start:])
+
+    def fetch(self, partial):
+        self.ranges = []
+        part_path = os.path.join(self.tmp_dir, 'file.zip.part')
+        if partial is not None:
+            with open(part_path, 'wb') as f:
+                f.write(partial)
+        rd.fetch(self.url, part_path)
+        with open(part_path, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+
+    @responses.activate
+    def test_fetch(self):
+        responses.add_callback(responses.GET, self.url, callback=self.range_callback)
+        self.fetch(None)
+        self.assertEqual(self.ranges, [None])
+
+    @responses.activate
+    def test_resume(self):
+        responses.add_callback(responses.GET, self.url, callback=self.range_callback)
+        self.fetch(self.body[:1000])
+        self.assertEqual(self.ranges, ['bytes=1000-'])
+
+    @responses.activate
+    def test_already_complete(self):
+        responses.add_callback(responses.GET, self.url, callback=self.range_callback)
+        self.fetch(self.body)
+        self.assertEqual(self.ranges, ['bytes={0}-'.format(len(self.body))])
+
+    @responses.activate
+    def test_range_ignored(self):
+        # A server which ignores Range sends the whole file again
+        responses.add(responses.GET, self.url, body=self.body)
+        self.fetch(b'stale data')
+
+class TestIncremental(TemporaryDirectoryTestCase):
+    def run_main(self, *args):
+        new_argv = ['ruaumoko-download', '--expect-resolution', '20x10'] + list(args)
+        with patch('sys.argv', new_argv):
+            return rd.main()
+
+    def fetched(self):
+        """Chunk zips requested since the last call."""
+        names = sorted(call.request.url.rsplit('/', 1)[1] for call in responses.calls)
+        responses.calls.reset()
+        return names
+
+    def read_manifest(self, location):
+        return rd.read_manifest(rd.manifest_path(location), (20, 10))
+
+    def check_dataset(self, tgt_path):
+        with open(tgt_path, 'rb') as f, open(MOCK_DATASET_PATH, 'rb') as expected:
+            self.assertEqual(f.read(), expected.read())
+
+    @responses.activate
+    def test_manifest(self):
+        responses_add_dem_mocks()
+        tgt_path = os.path.join(self.tmp_dir, 'dataset')
+        self.assertEqual(self.run_main(tgt_path), 0)
+
+        entries = self.read_manifest(tgt_path)
+        self.assertEqual(sorted(entries), rd.CHUNKS)
+        entry = entries['C']
+        self.assertEqual(entry['offset'], 2 * 400)
+        self.assertEqual(entry['size'], 400)
+        self.assertTrue(entry['url'].endswith('/DEM/TIF15/15-C.zip'))
+        self.assertEqual(entry['sha256'], rd.hash_range(tgt_path, 800, 400))
+
+    @responses.activate
+    def test_resume(self):
+        responses_add_dem_mocks()
+        tgt_path = os.path.join(self.tmp_dir, 'dataset')
+        self.assertEqual(self.run_main(tgt_path), 0)
+        self.fetched()
+
+        # Nothing to do
+        self.assertEqual(self.run_main('--resume', tgt_path), 0)
+        self.assertEqual(self.fetched(), [])
+
+        # As if the download had been interrupted before chunk D finished
+        entries = self.read_manifest(tgt_path)
+        del entries['D']
+        rd.write_manifest(rd.manifest_path(tgt_path), (20, 10), entries)
+        with open(tgt_path, 'r+b') as f:
+            f.seek(3 * 400)
+            f.write(b'\0' * 400)
+
+        self.assertEqual(self.run_main('--resume', tgt_path), 0)
+        self.assertEqual(self.fetched(), ['15-D.zip'])
+        self.assertEqual(sorted(self.read_manifest(tgt_path)), rd.CHUNKS)
+        self.check_dataset(tgt_path)
+
+    @responses.activate
+    def test_verify(self):
+        responses_add_dem_mocks()
+        tgt_path = os.path.join(self.tmp_dir, 'dataset')
+        self.assertEqual(self.run_main(tgt_path), 0)
+        self.fetched()
+
+        # Silent corruption isn't noticed by --resume, but is by --verify
+        with open(tgt_path, 'r+b') as f:
+            f.seek(5 * 400 + 17)
+            f.write(b'\xff')
+        self.assertEqual(self.run_main('--resume', tgt_path), 0)
+        self.assertEqual(self.fetched(), [])
+
+        self.assertEqual(self.run_main('--verify', '-j', '3', tgt_path), 0)
+        self.assertEqual(self.fetched(), ['15-F.zip'])
+        self.check_dataset(tgt_path)
+
+    @responses.activate
+    def test_verify_indexed(self):
+        responses_add_dem_mocks()
+        tgt_path = os.path.join(self.tmp_dir, 'dataset')
+        self.assertEqual(self.run_main(tgt_path), 0)
+        self.fetched()
+
+        # An index and overviews of a corrupt chunk D
+        data = np.memmap(tgt_path, dtype=np.int16, mode='r+',
+                         shape=(4, 6, 10, 20))
+        data[0, 3] = 1234
+        data.flush()
+        del data
+        ri.build_index(tgt_path, (20, 10), 4)
+        ro.build_overviews(tgt_path, (20, 10), 2)
+
+        self.assertEqual(self.run_main('--verify', tgt_path), 0)
+        self.assertEqual(self.fetched(), ['15-D.zip'])
+        self.check_dataset(tgt_path)
+        self.assertFalse(os.path.exists(index_path(tgt_path)))
+        self.assertFalse(os.path.exists(overview_path(tgt_path, 1)))
+
+        ds = Dataset(tgt_path, expected_res=(20, 10))
+        expected = Dataset(MOCK_DATASET_PATH, expected_res=(20, 10))
+        lats = np.repeat(np.linspace(-90, 90, 37), 72)
+        lngs = np.tile(np.linspace(0, 355, 72), 37)
+        self.assertEqual(ds.get_many(lats, lngs), expected.get_many(lats, lngs))
+        self.assertEqual(ds.get_overview(80, 10, 90), ds.get(80, 10))
+
+    @responses.activate
+    def test_verify_without_manifest(self):
+        responses_add_dem_mocks()
+        tgt_path = os.path.join(self.tmp_dir, 'dataset')
+        self.assertEqual(self.run_main('--verify', tgt_path), 0)
+        self.assertEqual(len(self.fetched()), 24)
+        self.check_dataset(tgt_path)
+
+    @responses.activate
+    def test_verify_split_chunks(self):
+        responses_add_dem_mocks()
+        chunk_dir = os.path.join(self.tmp_dir, 'chunks')
+        os.mkdir(chunk_dir)
+        self.assertEqual(self.run_main('--split-chunks', chunk_dir), 0)
+        self.fetched()
+
+        os.unlink(os.path.join(chunk_dir, '15-A.tif'))
+        with open(os.path.join(chunk_dir, '15-X.tif'), 'r+b') as f:
+            f.seek(300)
+            f.write(b'\x01\x02')
+
+        self.assertEqual(self.run_main('--split-chunks', '--verify', chunk_dir), 0)
+        self.assertEqual(self.fetched(), ['15-A.zip', '15-X.zip'])
+        self.assertEqual(len(os.listdir(chunk_dir)), 24)
@@ -0,0 +1,184 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for dataset indexes.
+
+"""
+import os
+import shutil
+import warnings
+from array import array
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import numpy as np
+from nose.tools import raises
+
+from ruaumoko import Dataset, StaleBuildWarning
+from ruaumoko.dataset import index_path, INDEX_HEADER
+import ruaumoko.index as ri
+import ruaumoko.tiles as rt
+
+from .util import (TemporaryDirectoryTestCase, MOCK_DATASET_PATH,
+        MOCK_DATASET_TILE_SIZE, extract_mock_chunks)
+
+class TestIndex(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestIndex, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'dataset')
+        shutil.copy(MOCK_DATASET_PATH, self.path)
+
+        lats = [lat * 0.5 for lat in range(-180, 181, 3)]
+        lngs = [lng * 0.5 for lng in range(0, 720, 7)]
+        self.lats = array('d', [lat for lat in lats for lng in lngs])
+        self.lngs = array('d', [lng for lat in lats for lng in lngs])
+
+    def write_sea(self):
+        """Write a dataset that is zero except for an island in chunk (1, 2)."""
+        data = np.zeros((4, 6, 10, 20), dtype=np.int16)
+        data[1, 2, 4:6, 5:7] = 1234
+        data.tofile(self.path)
+
+    def test_build(self):
+        self.assertEqual(ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 4),
+                index_path(self.path))
+        # 24 chunks of 3x5 tiles, plus a header
+        self.assertEqual(os.path.getsize(index_path(self.path)),
+                INDEX_HEADER.size + 2 * 2 * 24 * 15)
+
+        raw = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertFalse(raw.has_index)
+        self.assertTrue(ds.has_index)
+        self.assertEqual(ds.get_many(self.lats, self.lngs),
+                raw.get_many(self.lats, self.lngs))
+
+    def test_tiled_source(self):
+        ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 3)
+        tiled = os.path.join(self.tmp_dir, 'tiled')
+        rt.convert(self.path, tiled, MOCK_DATASET_TILE_SIZE, 4, compress=6)
+        ri.build_index(tiled, MOCK_DATASET_TILE_SIZE, 3)
+        # The same but for the build of the dataset in the header
+        with open(index_path(self.path), 'rb') as a:
+            with open(index_path(tiled), 'rb') as b:
+                self.assertEqual(a.read()[INDEX_HEADER.size:],
+                                 b.read()[INDEX_HEADER.size:])
+
+    def test_split_source(self):
+        split = os.path.join(self.tmp_dir, 'split')
+        os.mkdir(split)
+        extract_mock_chunks(split)
+        # The index is found whether or not the directory is given with a
+        # trailing separator
+        self.assertEqual(ri.build_index(split + os.sep, MOCK_DATASET_TILE_SIZE, 4),
+                index_path(split))
+        self.assertTrue(Dataset(split + os.sep,
+                expected_res=MOCK_DATASET_TILE_SIZE).has_index)
+
+    def test_constant_tiles(self):
+        self.write_sea()
+        ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 4)
+
+        # Scribble over the sea, without changing the build; lookups there
+        # must come from the index
+        st = os.stat(self.path)
+        data = np.memmap(self.path, dtype=np.int16, mode='r+',
+                shape=(4, 6, 10, 20))
+        data[0, 0] = 999
+        data.flush()
+        del data
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertEqual(ds.get(85, 10), 0)
+        self.assertEqual(ds.tile_range(85, 10), (0, 0))
+
+    def test_elevation_range(self):
+        self.write_sea()
+        ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 4)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+
+        # The island is at latitudes 25 to 20 and longitudes 316 to 319
+        self.assertEqual(ds.elevation_range(80, 200, 60, 300), (0, 0))
+        self.assertEqual(ds.elevation_range(30, 310, 10, 330), (0, 1234))
+        self.assertEqual(ds.elevation_range(30, 350, 10, 10), (0, 0))
+        self.assertEqual(ds.elevation_range(30, 330, 10, 320), (0, 1234))
+        self.assertEqual(ds.elevation_range(-90, 0, 90, 359), (0, 1234))
+        self.assertEqual(ds.tile_range(22, 318)[1], 1234)
+        self.assertEqual(ds.get(22, 318), 1234)
+
+    def test_bounds(self):
+        ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 4)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        for lat0, lng0, lat1, lng1 in [(10, 10, -10, 50), (90, 350, 70, 20),
+                (-70, 100, -90, 101)]:
+            lowest, highest = ds.elevation_range(lat0, lng0, lat1, lng1)
+            lats = np.linspace(lat1, lat0, 17)
+            lngs = np.linspace(lng0, lng1 + (360 if lng1 < lng0 else 0), 23) % 360
+            values = ds.interpolate_many(np.repeat(lats, len(lngs)),
+                    np.tile(lngs, len(lats)), 'bilinear')
+            self.assertGreaterEqual(min(values), lowest)
+            self.assertLessEqual(max(values), highest)
+
+    def test_stale(self):
+        self.write_sea()
+        ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 4)
+        data = np.memmap(self.path, dtype=np.int16, mode='r+',
+                shape=(4, 6, 10, 20))
+        data[:] = 1234
+        data.flush()
+        del data
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertEqual([w.category for w in caught], [StaleBuildWarning])
+        self.assertFalse(ds.has_index)
+        self.assertEqual(ds.get(-30, 100), 1234)
+
+        ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 4)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertTrue(ds.has_index)
+        self.assertEqual(ds.tile_range(-30, 100), (1234, 1234))
+
+    @raises(ValueError)
+    def test_no_index(self):
+        Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE).tile_range(0, 0)
+
+    @raises(ValueError)
+    def test_wrong_resolution(self):
+        ri.build_index(self.path, MOCK_DATASET_TILE_SIZE, 4)
+        with open(index_path(self.path), 'r+b') as f:
+            f.seek(12)
+            f.write(b'\x15')
+        Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+
+    def test_main(self):
+        argv = ['ruaumoko-build-index', '--tile-shape', '20x10',
+                '--tile-size', '5', self.path]
+        with patch('sys.argv', argv):
+            self.assertEqual(ri.main(), 0)
+        self.assertTrue(Dataset(self.path,
+                expected_res=MOCK_DATASET_TILE_SIZE).has_index)
+
+        argv[4] = 'x'
+        with patch('sys.argv', argv):
+            self.assertEqual(ri.main(), 1)
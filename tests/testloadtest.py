@@ -0,0 +1,139 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the load tester.
+
+"""
+import json
+import math
+import os
+import random
+from unittest import TestCase
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import ruaumoko.loadtest as lt
+
+from .util import (TemporaryDirectoryTestCase, MOCK_DATASET_PATH,
+        MOCK_DATASET_TILE_SIZE)
+
+class TestWorkloads(TestCase):
+    def test_read_log(self):
+        lines = [
+            '127.0.0.1 - - [10/Oct/2014:13:55:36 +0000] "GET /52.2,0.1 '
+            'HTTP/1.1" 200 20 "-" "curl/7.35.0"',
+            '127.0.0.1 - - [10/Oct/2014:13:55:37 +0000] "POST /batch '
+            'HTTP/1.1" 200 100',
+            '127.0.0.1 - - [10/Oct/2014:13:55:38 +0000] "GET '
+            '/batch?polyline=_p~iF~ps|U HTTP/1.0" 200 35',
+            '/-10.5,300',
+            'garbage',
+        ]
+        self.assertEqual(lt.read_log(lines), ['/52.2,0.1',
+            '/batch?polyline=_p~iF~ps|U', '/-10.5,300'])
+
+    def test_replay(self):
+        workload = lt.ReplayWorkload(['/1,2', '/batch?polyline=x'])
+        requests = [workload.request(None) for _ in range(3)]
+        self.assertEqual([r[1] for r in requests],
+                ['/1,2', '/batch?polyline=x', '/1,2'])
+        self.assertEqual([r[4] for r in requests], [1, 0, 1])
+        self.assertRaises(ValueError, lt.ReplayWorkload, [])
+
+    def test_hotspot(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            lat, lng = lt.hotspot_point(rng, hot_fraction=1)
+            self.assertTrue(0 <= lng < 360)
+            self.assertTrue(min(
+                math.hypot(lat - site_lat,
+                           (lng - site_lng + 180) % 360 - 180)
+                for _, site_lat, site_lng in lt.LAUNCH_SITES) < 5)
+
+    def test_batches(self):
+        rng = random.Random(0)
+        method, path, body, content_type, points = \
+                lt.PointWorkload(lt.uniform_point).request(rng)
+        self.assertEqual((method, body, points), ('GET', None, 1))
+        lat, lng = [float(x) for x in path[1:].split(',')]
+        self.assertTrue(-90 <= lat <= 90 and 0 <= lng < 360)
+
+        method, path, body, content_type, points = \
+                lt.PointWorkload(lt.uniform_point, 10).request(rng)
+        self.assertEqual((method, path, content_type, points),
+                ('POST', '/batch', 'application/json', 10))
+        self.assertEqual(len(json.loads(body.decode('utf-8'))), 10)
+
+        _, _, body, content_type, _ = \
+                lt.PointWorkload(lt.uniform_point, 10, True).request(rng)
+        self.assertEqual((len(body), content_type),
+                (160, 'application/octet-stream'))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(lt.percentile(values, 50), 50)
+        self.assertEqual(lt.percentile(values, 99), 99)
+        self.assertEqual(lt.percentile(values, 100), 100)
+        self.assertEqual(lt.percentile([7], 95), 7)
+        self.assertEqual(lt.percentile([], 50), None)
+
+class TestRun(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestRun, self).setUp()
+        settings = os.path.join(self.tmp_dir, 'settings.cfg')
+        with open(settings, 'w') as f:
+            f.write('ELEVATION_DIRECTORY = {0!r}\n'
+                    'ELEVATION_TILE_RESOLUTION = {1!r}\n'.format(
+                        MOCK_DATASET_PATH, MOCK_DATASET_TILE_SIZE))
+        with patch.dict(os.environ, {'RUAUMOKO_SETTINGS': settings}):
+            self.process, self.url = lt.start_server('threaded')
+
+    def tearDown(self):
+        self.process.terminate()
+        self.process.join()
+        super(TestRun, self).tearDown()
+
+    def test_requests(self):
+        workload = lt.PointWorkload(lt.uniform_point, 5)
+        report = lt.run(self.url, workload, concurrency=3, n_requests=40,
+                        warmup=0.1)
+        self.assertEqual(report['requests'], 40)
+        self.assertEqual(report['statuses'], {'200': 40})
+        self.assertEqual(report['errors'], {})
+        latency = report['latency_ms']
+        self.assertTrue(0 < latency['p50'] <= latency['p95'] <=
+                        latency['p99'] <= latency['max'])
+        self.assertAlmostEqual(report['points_per_second'],
+                5 * report['throughput'])
+        self.assertIn('p99', lt.format_report(report))
+        json.dumps(report)
+
+    def test_errors(self):
+        workload = lt.ReplayWorkload(['/0,0', '/100,0'])
+        report = lt.run(self.url, workload, concurrency=1, n_requests=10,
+                        warmup=0)
+        self.assertEqual(report['errors'], {'400': 5})
+
+    def test_duration(self):
+        report = lt.run(self.url, lt.PointWorkload(lt.uniform_point),
+                        concurrency=2, duration=0.3, warmup=0)
+        self.assertTrue(report['requests'] > 0)
+        self.assertTrue(0.3 <= report['duration'] < 1)
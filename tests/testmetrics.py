@@ -0,0 +1,148 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the shared metrics.
+
+"""
+import multiprocessing
+import os
+import threading
+
+from ruaumoko.metrics import Metrics
+
+from .util import TemporaryDirectoryTestCase
+
+ROUTES = ['/batch', '/<latitude>,<longitude>']
+
+def count_requests(path, n):
+    metrics = Metrics(ROUTES, path, slots=4)
+    for _ in range(n):
+        metrics.request('/batch', 200, 0.01)
+    metrics.close()
+
+def count_forked(metrics, n):
+    for _ in range(n):
+        metrics.request('/batch', 200, 0.01)
+
+class TestMetrics(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'metrics')
+
+    def test_counts(self):
+        metrics = Metrics(ROUTES, self.path)
+        metrics.request('/batch', 200, 0.003)
+        metrics.request('/batch', 400, 0.02)
+        metrics.request('/nowhere', 404, 0.001)
+        metrics.out_of_range('/batch')
+        metrics.batch('/batch', 1)
+        metrics.batch('/batch', 500)
+        with metrics.lookup('/batch'):
+            bytearray(16 * 1024 * 1024)
+
+        self.assertEqual(metrics.value('requests_total', '/batch', '2xx'), 1)
+        self.assertEqual(metrics.value('requests_total', '/batch', '4xx'), 1)
+        self.assertEqual(metrics.value('requests_total', 'other', '4xx'), 1)
+        self.assertEqual(metrics.value('out_of_range_total', '/batch'), 1)
+        self.assertGreater(
+                metrics.value('page_faults_total', '/batch', 'minor'), 0)
+
+        text = metrics.exposition()
+        self.assertIn('ruaumoko_requests_total{route="/batch",code="2xx"} 1\n',
+                      text)
+        self.assertIn('ruaumoko_batch_size_bucket{route="/batch",le="1"} 1\n',
+                      text)
+        self.assertIn('ruaumoko_batch_size_bucket{route="/batch",le="1000"} 2\n',
+                      text)
+        self.assertIn('ruaumoko_batch_size_bucket{route="/batch",le="+Inf"} 2\n',
+                      text)
+        self.assertIn('ruaumoko_batch_size_sum{route="/batch"} 501\n', text)
+        self.assertIn('ruaumoko_request_duration_seconds_bucket'
+                      '{route="/batch",le="0.005"} 1\n', text)
+        self.assertIn('ruaumoko_lookup_duration_seconds_count'
+                      '{route="/batch"} 1\n', text)
+        self.assertIn('# TYPE ruaumoko_page_faults_total counter\n', text)
+
+    def test_faults_in_threads(self):
+        # Batches may be looked up by threads other than the request's
+        metrics = Metrics(ROUTES, self.path)
+        with metrics.lookup('/batch'):
+            thread = threading.Thread(target=bytearray,
+                                      args=(16 * 1024 * 1024,))
+            thread.start()
+            thread.join()
+        self.assertGreaterEqual(
+                metrics.value('page_faults_total', '/batch', 'minor'),
+                16 * 1024 * 1024 // os.sysconf('SC_PAGESIZE') // 2)
+
+    def test_shared(self):
+        procs = [multiprocessing.Process(target=count_requests,
+                    args=(self.path, 10 + k)) for k in range(3)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+
+        metrics = Metrics(ROUTES, self.path, slots=4)
+        self.assertEqual(metrics.value('requests_total', '/batch', '2xx'), 33)
+
+        # Processes that have exited leave their counts to those after them
+        for k in range(5):
+            count_requests(self.path, 1)
+            proc = multiprocessing.Process(target=count_requests,
+                                           args=(self.path, 1))
+            proc.start()
+            proc.join()
+        self.assertEqual(metrics.value('requests_total', '/batch', '2xx'), 43)
+
+    def test_fork(self):
+        metrics = Metrics(ROUTES)
+        metrics.request('/batch', 200, 0.01)
+        procs = [multiprocessing.Process(target=count_forked,
+                    args=(metrics, 5)) for k in range(2)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        self.assertEqual(metrics.value('requests_total', '/batch', '2xx'), 11)
+        metrics.request('/batch', 200, 0.01)
+        self.assertEqual(metrics.value('requests_total', '/batch', '2xx'), 12)
+
+    def test_full(self):
+        metrics = Metrics(ROUTES, self.path, slots=1)
+        metrics.request('/batch', 200, 0.01)
+        proc = multiprocessing.Process(target=count_forked, args=(metrics, 1))
+        proc.start()
+        proc.join()
+
+        # The process went uncounted, but carried on
+        self.assertEqual(proc.exitcode, 0)
+        self.assertEqual(metrics.value('requests_total', '/batch', '2xx'), 1)
+
+    def test_layout_change(self):
+        # Processes with other settings count in a file of their own,
+        # leaving the one mapped by the others alone
+        old = Metrics(ROUTES, self.path)
+        old.request('/batch', 200, 0.01)
+        for metrics in [Metrics(ROUTES + ['/profile'], self.path),
+                        Metrics(ROUTES, self.path, slots=4)]:
+            self.assertNotEqual(metrics.path, old.path)
+            self.assertEqual(metrics.value('requests_total', '/batch', '2xx'), 0)
+            metrics.request('/batch', 200, 0.01)
+        self.assertEqual(old.value('requests_total', '/batch', '2xx'), 1)
+        self.assertEqual(Metrics(ROUTES, self.path).path, old.path)
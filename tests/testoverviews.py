@@ -0,0 +1,150 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for building and reading overview levels.
+
+"""
+import os
+import shutil
+import warnings
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import numpy as np
+
+from ruaumoko import Dataset, StaleBuildWarning
+from ruaumoko.dataset import overview_path, OVERVIEW_HEADER_SIZE
+import ruaumoko.overviews as ro
+import ruaumoko.tiles as rt
+
+from .util import (TemporaryDirectoryTestCase, MOCK_DATASET_PATH,
+        MOCK_DATASET_TILE_SIZE, extract_mock_chunks)
+
+class TestOverviews(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestOverviews, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'dataset')
+        shutil.copy(MOCK_DATASET_PATH, self.path)
+
+    def cell(self, ds, row, col):
+        """Value of a cell in the whole grid of the mock dataset."""
+        return ds.get(90 - row * 5.0, (col * 60.0 / 19 - 180) % 360)
+
+    def test_build(self):
+        paths = ro.build_overviews(self.path, MOCK_DATASET_TILE_SIZE, levels=2)
+        self.assertEqual(paths, [overview_path(self.path, 1), overview_path(self.path, 2)])
+
+        # The whole grid is 37x114 cells, so level 1 is 19x57 and level 2 10x29
+        self.assertEqual(os.stat(paths[0]).st_size,
+                OVERVIEW_HEADER_SIZE + 3 * 19 * 57 * 2)
+        self.assertEqual(os.stat(paths[1]).st_size,
+                OVERVIEW_HEADER_SIZE + 3 * 10 * 29 * 2)
+
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertEqual(ds.overview_levels, 2)
+
+        # Level 1 cells summarise 2x2 blocks of cells
+        for row in range(0, 36, 2):
+            for col in range(0, 114, 6):
+                lat, lng = 90 - row * 5.0, (col * 60.0 / 19 - 180) % 360
+                values = [self.cell(ds, row + i, col + j) for i in (0, 1) for j in (0, 1)]
+                self.assertEqual(ds.get_overview(lat, lng, 10, 'min'), min(values))
+                self.assertEqual(ds.get_overview(lat, lng, 10, 'max'), max(values))
+                self.assertAlmostEqual(ds.get_overview(lat, lng, 10, 'mean'),
+                        sum(values) / 4.0, delta=0.5)
+
+    def test_level_choice(self):
+        ro.build_overviews(self.path, MOCK_DATASET_TILE_SIZE, levels=2)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+
+        # Cells are 5 degrees high at level 0, so overview_level picks the
+        # coarsest level no larger than the resolution.
+        self.assertEqual(ds.overview_level(1), 0)
+        self.assertEqual(ds.overview_level(5), 0)
+        self.assertEqual(ds.overview_level(10), 1)
+        self.assertEqual(ds.overview_level(15), 1)
+        self.assertEqual(ds.overview_level(90), 2)
+        self.assertEqual(ds.get_overview(30, 80, 1, 'max'), ds.get(30, 80))
+        self.assertRaises(ValueError, ds.get_overview, 30, 80, 10, 'median')
+
+    def overview_data(self, filename, level):
+        with open(overview_path(filename, level), 'rb') as f:
+            return f.read()[OVERVIEW_HEADER_SIZE:]
+
+    def test_layouts(self):
+        ro.build_overviews(self.path, MOCK_DATASET_TILE_SIZE, levels=2)
+
+        tiled = os.path.join(self.tmp_dir, 'tiled')
+        rt.convert(self.path, tiled, MOCK_DATASET_TILE_SIZE, 4, compress=6)
+        split = os.path.join(self.tmp_dir, 'split')
+        os.mkdir(split)
+        extract_mock_chunks(split)
+        for source in (tiled, split):
+            # Directories may be named with a trailing separator
+            name = source + os.sep if source == split else source
+            self.assertEqual(ro.build_overviews(name, MOCK_DATASET_TILE_SIZE,
+                                                levels=2),
+                             [overview_path(source, 1), overview_path(source, 2)])
+            for level in (1, 2):
+                self.assertEqual(self.overview_data(source, level),
+                                 self.overview_data(self.path, level))
+            ds = Dataset(source, expected_res=MOCK_DATASET_TILE_SIZE)
+            self.assertEqual(ds.overview_levels, 2)
+
+    def test_stale(self):
+        ro.build_overviews(self.path, MOCK_DATASET_TILE_SIZE, levels=2)
+        data = np.memmap(self.path, dtype=np.int16, mode='r+')
+        data[:] = 1234
+        data.flush()
+        del data
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertEqual([w.category for w in caught], [StaleBuildWarning])
+        self.assertEqual(ds.overview_levels, 0)
+        self.assertEqual(ds.get_overview(30, 80, 90), 1234)
+
+        ro.build_overviews(self.path, MOCK_DATASET_TILE_SIZE, levels=2)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertEqual(ds.overview_levels, 2)
+        self.assertEqual(ds.get_overview(30, 80, 90, 'max'), 1234)
+
+    def test_no_overviews(self):
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertEqual(ds.overview_levels, 0)
+        self.assertEqual(ds.get_overview(30, 80, 90), ds.get(30, 80))
+
+    def test_main(self):
+        argv = ['ruaumoko-build-overviews', '--tile-shape', '20x10', self.path]
+        with patch('sys.argv', argv):
+            self.assertEqual(ro.main(), 0)
+
+        # The mock dataset has 0.2 cells per degree, so no levels are needed
+        # to get to a degree per cell.
+        self.assertFalse(os.path.exists(overview_path(self.path, 1)))
+
+        with patch('sys.argv', argv[:1] + ['--levels', '3'] + argv[1:]):
+            self.assertEqual(ro.main(), 0)
+        self.assertTrue(os.path.exists(overview_path(self.path, 3)))
+
+        with patch('sys.argv', argv[:1] + ['--levels', '0'] + argv[1:]):
+            self.assertEqual(ro.main(), 1)
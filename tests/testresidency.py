@@ -0,0 +1,132 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for page cache residency and access heatmaps.
+
+"""
+import os
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import numpy as np
+
+from ruaumoko import Dataset
+import ruaumoko.residency as rr
+import ruaumoko.tiles as rt
+
+from .util import (TemporaryDirectoryTestCase, MOCK_DATASET_PATH,
+        MOCK_DATASET_TILE_SIZE, extract_mock_chunks)
+
+class TestResidency(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestResidency, self).setUp()
+        self.ds = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.path = os.path.join(self.tmp_dir, 'heatmap')
+
+    def test_resident(self):
+        self.ds.warm()
+        resident, total = self.ds.resident()
+        self.assertEqual(resident, total)
+        self.assertEqual(total % 4096, 0)
+        self.assertEqual(self.ds.resident((2, 3)), self.ds.resident((2, 3))[::-1])
+
+    def test_tile_residency(self):
+        self.ds.warm()
+        residency = self.ds.tile_residency(4)
+        self.assertEqual(len(residency), 24 * 3 * 5)
+        self.assertEqual(set(residency), set([1.0]))
+
+        tiled = os.path.join(self.tmp_dir, 'tiled')
+        rt.convert(MOCK_DATASET_PATH, tiled, MOCK_DATASET_TILE_SIZE, 3, compress=6)
+        ds = Dataset(tiled, expected_res=MOCK_DATASET_TILE_SIZE)
+        ds.warm()
+        self.assertEqual(set(ds.tile_residency(4)), set([1.0]))
+
+    def test_missing_chunk(self):
+        split = os.path.join(self.tmp_dir, 'split')
+        os.mkdir(split)
+        extract_mock_chunks(split)
+        os.unlink(os.path.join(split, '15-H.tif'))
+        self.assertEqual(Dataset(split, expected_res=MOCK_DATASET_TILE_SIZE)
+                         .resident((1, 1)), (0, 0))
+
+        with patch('sys.stdout') as stdout:
+            rr.report_residency(split, MOCK_DATASET_TILE_SIZE, 4)
+        output = ''.join(call[0][0] for call in stdout.write.call_args_list)
+        self.assertIn('    n/a', output)
+
+    def test_count_accesses(self):
+        self.assertIsNone(self.ds.access_counts)
+        self.ds.count_accesses(1, 5)
+        self.ds.get(90, 0)
+        self.ds.get_many([-90] * 3, [0] * 3)
+        self.ds.interpolate(-90, 359.9)
+
+        counts = self.ds.access_counts
+        self.assertEqual((counts['every'], counts['tile_size']), (1, 5))
+        self.assertEqual(len(counts['counts']), 24 * 2 * 4)
+        self.assertEqual(sum(counts['counts']), 5)
+
+        # The north pole at longitude 0 is in chunk (0, 3), and the south
+        # pole near 0 in the last tile row of chunk (3, 3)
+        counts = np.asarray(counts['counts']).reshape(4, 6, 2, 4)
+        self.assertEqual(counts[0, 3, 0, 0], 1)
+        self.assertEqual(counts[3, 3, 1, 0], 4)
+
+        self.ds.count_accesses(3, 5)
+        self.ds.get_many([0] * 10, [0] * 10)
+        self.assertEqual(sum(self.ds.access_counts['counts']), 3)
+
+        self.ds.count_accesses(0)
+        self.ds.get(0, 0)
+        self.assertEqual(sum(self.ds.access_counts['counts']), 3)
+
+    def test_heatmap(self):
+        self.ds.count_accesses(1, 4)
+        self.ds.get_many([22.5] * 7, [5] * 7)
+        rr.write_heatmap(self.path, MOCK_DATASET_TILE_SIZE, self.ds.access_counts)
+
+        res, tile_size, every, counts = rr.read_heatmap(self.path)
+        self.assertEqual((res, tile_size, every), (MOCK_DATASET_TILE_SIZE, 4, 1))
+        self.assertEqual(counts.shape, (4, 6, 3, 5))
+        self.assertEqual(counts.sum(), 7)
+
+        # The hottest tile covers the point looked up
+        tile = np.unravel_index(np.argmax(counts), counts.shape)
+        lat0, lng0, lat1, lng1 = rr.tile_box(res, tile_size, *tile)
+        self.assertTrue(lat1 <= 22.5 <= lat0)
+        self.assertTrue(lng0 <= 5 <= lng1)
+        self.ds.warm((lat0, lng0, lat1, lng1))
+
+    def test_main(self):
+        self.ds.count_accesses(1, 4)
+        self.ds.get_many([22.5] * 7, [5] * 7)
+        rr.write_heatmap(self.path, MOCK_DATASET_TILE_SIZE, self.ds.access_counts)
+
+        for argv in (['ruaumoko-residency', '--tile-shape', '20x10',
+                      '--tile-size', '4', '--map', MOCK_DATASET_PATH],
+                     ['ruaumoko-residency', 'hot', '--map', self.path, self.path],
+                     ['ruaumoko-residency', 'hot', '--warm-list', self.path]):
+            with patch('sys.argv', argv):
+                self.assertEqual(rr.main(), 0)
+
+        with patch('sys.argv', ['ruaumoko-residency', 'hot', '--top', '0', self.path]):
+            self.assertEqual(rr.main(), 1)
@@ -0,0 +1,101 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the shared result cache.
+
+"""
+import multiprocessing
+import os
+
+from ruaumoko.sharedcache import SharedCache
+
+from .util import TemporaryDirectoryTestCase
+
+def put_values(path, start, stop):
+    cache = SharedCache(path, size=64 * 1024, slot_size=1024)
+    for k in range(start, stop):
+        cache.put(str(k).encode(), str(k * k).encode())
+    cache.close()
+
+class TestSharedCache(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestSharedCache, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'cache')
+
+    def test_get_put(self):
+        cache = SharedCache(self.path, size=64 * 1024, slot_size=1024)
+        self.assertIsNone(cache.get(b'a'))
+        self.assertTrue(cache.put(b'a', b'alpha'))
+        self.assertTrue(cache.put(b'b', b''))
+        self.assertEqual(cache.get(b'a'), b'alpha')
+        self.assertEqual(cache.get(b'b'), b'')
+
+        self.assertTrue(cache.put(b'a', b'aleph'))
+        self.assertEqual(cache.get(b'a'), b'aleph')
+
+        # Too large to cache
+        self.assertFalse(cache.put(b'c', b'x' * 1025))
+        self.assertIsNone(cache.get(b'c'))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (3, 2, 3))
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['slots'], 64)
+
+    def test_clock_eviction(self):
+        # A single bucket of four slots
+        cache = SharedCache(self.path, size=4 * 1024, slot_size=1024, ways=4)
+        for key in (b'a', b'b', b'c', b'd'):
+            cache.put(key, key)
+
+        # Every entry has been used, so the hand goes all the way round and
+        # evicts the first; then "b" is evicted, as "a" is used again
+        cache.put(b'e', b'e')
+        self.assertIsNone(cache.get(b'a'))
+        cache.get(b'c')
+        cache.get(b'd')
+        cache.get(b'e')
+        cache.put(b'f', b'f')
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual([cache.get(k) for k in (b'c', b'd', b'e', b'f')],
+                [b'c', b'd', b'e', b'f'])
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_shared(self):
+        procs = [multiprocessing.Process(target=put_values,
+                    args=(self.path, 10 * k, 10 * k + 10)) for k in range(3)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+
+        cache = SharedCache(self.path, size=64 * 1024, slot_size=1024)
+        self.assertEqual(cache.stats()['stores'], 30)
+        hits = [k for k in range(30) if cache.get(str(k).encode()) == str(k * k).encode()]
+        # Almost all of them fit in buckets of eight slots
+        self.assertGreater(len(hits), 25)
+
+    def test_layout_change(self):
+        old = SharedCache(self.path, size=64 * 1024, slot_size=1024)
+        old.put(b'a', b'a')
+        cache = SharedCache(self.path, size=64 * 1024, slot_size=2048)
+        self.assertNotEqual(cache.path, old.path)
+        self.assertIsNone(cache.get(b'a'))
+        self.assertEqual(cache.stats()['stores'], 0)
+        cache.put(b'a', b'b')
+        self.assertEqual(old.get(b'a'), b'a')
@@ -0,0 +1,114 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the synthetic dataset generator.
+
+"""
+import os
+from array import array
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import numpy as np
+
+from ruaumoko import Dataset
+import ruaumoko.synthetic as rs
+import ruaumoko.verify as rv
+
+from .util import TemporaryDirectoryTestCase
+
+RES = (61, 31)
+
+class TestSynthetic(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestSynthetic, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'dataset')
+
+    def read(self, path=None, res=RES):
+        return np.fromfile(path or self.path, dtype=np.int16) \
+                .reshape((4, 6) + res[::-1])
+
+    def test_generate(self):
+        written = rs.generate(self.path, RES, jobs=2)
+        self.assertEqual(os.path.getsize(self.path), 24 * RES[0] * RES[1] * 2)
+        self.assertTrue(0 < written < 1)
+
+        data = self.read()
+        land = np.count_nonzero(data) / float(data.size)
+        self.assertTrue(0.05 < land < 0.6)
+        self.assertTrue(land <= written)
+        self.assertTrue(0 <= data.min() and data.max() <= rs.MAX_ELEVATION)
+
+        # Neighbouring chunks agree where they overlap, even at 180 degrees
+        report = rv.verify(self.path, RES, jobs=2)
+        self.assertFalse([seam for seam in report['seams']
+                          if seam['mismatched']])
+
+        ds = Dataset(self.path, expected_res=RES)
+        lats = array('d', [-90, -30, 0, 45, 90])
+        lngs = array('d', [0, 100, 180, 270, 359])
+        self.assertEqual(list(ds.get_many(lats, lngs)),
+                [ds.get(lat, lng) for lat, lng in zip(lats, lngs)])
+
+    def test_deterministic(self):
+        rs.generate(self.path, RES, seed=3, jobs=1)
+        other = os.path.join(self.tmp_dir, 'other')
+        rs.generate(other, RES, seed=3, jobs=2)
+        self.assertTrue((self.read() == self.read(other)).all())
+
+        rs.generate(other, RES, seed=4, jobs=2)
+        self.assertFalse((self.read() == self.read(other)).all())
+
+    def test_land(self):
+        rs.generate(self.path, RES, land=10, jobs=2)
+        less = np.count_nonzero(self.read())
+        rs.generate(self.path, RES, land=60, jobs=2)
+        self.assertTrue(np.count_nonzero(self.read()) > less)
+
+        rs.generate(self.path, RES, land=0, jobs=2)
+        self.assertFalse(self.read().any())
+
+    def test_blocks(self):
+        # Blocks are only a unit of work, and don't change the terrain
+        rs.generate(self.path, RES, jobs=1)
+        expected = self.read()
+        with patch.object(rs, 'BLOCK', 7):
+            rs.generate(self.path, RES, jobs=1)
+        self.assertTrue((self.read() == expected).all())
+
+    def test_resolutions(self):
+        for res in [(2, 2), (20, 10), (97, 13)]:
+            rs.generate(self.path, res, jobs=2)
+            self.assertEqual(os.path.getsize(self.path),
+                    24 * res[0] * res[1] * 2)
+            Dataset(self.path, expected_res=res).get(10, 10)
+
+    def test_split(self):
+        rs.generate(self.path, RES, jobs=2)
+        split = os.path.join(self.tmp_dir, 'split')
+        rs.generate(split, RES, split=True, jobs=2)
+
+        raw = Dataset(self.path, expected_res=RES)
+        ds = Dataset(split, expected_res=RES)
+        self.assertEqual(ds.layout, 'split')
+        lats = array('d', np.linspace(-90, 90, 41))
+        lngs = array('d', np.linspace(0, 359, 41))
+        self.assertEqual(ds.get_many(lats, lngs), raw.get_many(lats, lngs))
@@ -0,0 +1,268 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the TIFF decoder.
+
+"""
+import os
+import struct
+import zlib
+
+import numpy as np
+from nose.tools import raises
+
+import ruaumoko.tiff as tiff
+
+from .util import (TemporaryDirectoryTestCase, MOCK_DATASET_PATH,
+        extract_mock_chunks)
+
+def packbits_encode(data):
+    """Encode as PackBits, using only literal runs."""
+    out = bytearray()
+    for i in range(0, len(data), 128):
+        piece = data[i:i + 128]
+        out.append(len(piece) - 1)
+        out += piece
+    return bytes(out)
+
+def lzw_encode(data):
+    """Encode as TIFF LZW."""
+    table = dict((struct.pack('B', i), i) for i in range(256))
+    codes = [(tiff.LZW_CLEAR, 9)]
+    next_code = 258
+    width = 9
+    current = b''
+    for i in range(len(data)):
+        byte = data[i:i + 1]
+        if current + byte in table:
+            current += byte
+            continue
+        codes.append((table[current], width))
+        table[current + byte] = next_code
+        next_code += 1
+        if next_code == 4094:
+            # Table full, so start again
+            codes.append((tiff.LZW_CLEAR, width))
+            table = dict((struct.pack('B', i), i) for i in range(256))
+            next_code = 258
+            width = 9
+        elif next_code >= 1 << width:
+            width += 1
+        current = byte
+    codes.append((table[current], width))
+    codes.append((tiff.LZW_EOI, width))
+
+    out = bytearray()
+    bits = n_bits = 0
+    for code, code_width in codes:
+        bits = (bits << code_width) | code
+        n_bits += code_width
+        while n_bits >= 8:
+            n_bits -= 8
+            out.append((bits >> n_bits) & 0xff)
+    if n_bits:
+        out.append((bits << (8 - n_bits)) & 0xff)
+    return bytes(out)
+
+def write_tiff(filename, data, order='<', compression=tiff.COMPRESSION_NONE,
+        predictor=tiff.PREDICTOR_NONE, rows_per_strip=None, tile_size=None):
+    """Write a minimal single-band int16 TIFF."""
+    height, width = data.shape
+    encoded = data.astype(order + 'i2')
+    if predictor == tiff.PREDICTOR_HORIZONTAL:
+        encoded = encoded.astype(np.int32)
+        encoded[:, 1:] -= encoded[:, :-1].copy()
+        encoded = (encoded & 0xffff).astype(order + 'u2')
+
+    if tile_size is not None:
+        blocks = []
+        for r in range(0, height, tile_size):
+            for c in range(0, width, tile_size):
+                tile = np.zeros((tile_size, tile_size), dtype=encoded.dtype)
+                piece = encoded[r:r + tile_size, c:c + tile_size]
+                tile[:piece.shape[0], :piece.shape[1]] = piece
+                blocks.append(tile)
+    else:
+        rows_per_strip = rows_per_strip or height
+        blocks = [encoded[r:r + rows_per_strip]
+                  for r in range(0, height, rows_per_strip)]
+
+    compressors = {
+        tiff.COMPRESSION_NONE: lambda b: b,
+        tiff.COMPRESSION_DEFLATE: zlib.compress,
+        tiff.COMPRESSION_PACKBITS: packbits_encode,
+        tiff.COMPRESSION_LZW: lzw_encode,
+    }
+    blocks = [compressors[compression](b.tobytes()) for b in blocks]
+
+    offsets = []
+    body = b''
+    for block in blocks:
+        offsets.append(8 + len(body))
+        body += block
+    if len(body) % 2:
+        body += b'\0'
+
+    # Long arrays go after the body, followed by the IFD
+    arrays_offset = 8 + len(body)
+    entries = [
+        (tiff.IMAGE_WIDTH, 4, [width]),
+        (tiff.IMAGE_LENGTH, 4, [height]),
+        (tiff.BITS_PER_SAMPLE, 3, [16]),
+        (tiff.COMPRESSION, 3, [compression]),
+        (tiff.PREDICTOR, 3, [predictor]),
+        (tiff.SAMPLE_FORMAT, 3, [2]),
+    ]
+    if tile_size is not None:
+        entries += [
+            (tiff.TILE_WIDTH, 4, [tile_size]),
+            (tiff.TILE_LENGTH, 4, [tile_size]),
+            (tiff.TILE_OFFSETS, 4, offsets),
+            (tiff.TILE_BYTE_COUNTS, 4, [len(b) for b in blocks]),
+        ]
+    else:
+        entries += [
+            (tiff.ROWS_PER_STRIP, 4, [rows_per_strip]),
+            (tiff.STRIP_OFFSETS, 4, offsets),
+            (tiff.STRIP_BYTE_COUNTS, 4, [len(b) for b in blocks]),
+        ]
+    entries.sort()
+
+    arrays = b''
+    ifd = struct.pack(order + 'H', len(entries))
+    for key, type_, values in entries:
+        code = 'H' if type_ == 3 else 'I'
+        packed = struct.pack(order + code * len(values), *values)
+        if len(packed) <= 4:
+            value = packed.ljust(4, b'\0')
+        else:
+            value = struct.pack(order + 'I', arrays_offset + len(arrays))
+            arrays += packed
+        ifd += struct.pack(order + 'HHI', key, type_, len(values)) + value
+    ifd += struct.pack(order + 'I', 0)
+
+    magic = b'II*\0' if order == '<' else b'MM\0*'
+    with open(filename, 'wb') as f:
+        f.write(magic + struct.pack(order + 'I', arrays_offset + len(arrays)))
+        f.write(body + arrays + ifd)
+
+class TestDecode(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestDecode, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'chunk.tif')
+        rng = np.random.RandomState(0)
+        self.data = rng.randint(-500, 9000, size=(37, 53)).astype(np.int16)
+
+    def check(self, **kwargs):
+        write_tiff(self.path, self.data, **kwargs)
+        self.assertEqual(tiff.image_shape(self.path), self.data.shape[::-1])
+        self.assertTrue((tiff.decode(self.path) == self.data).all())
+
+    def test_uncompressed(self):
+        self.check()
+
+    def test_big_endian(self):
+        self.check(order='>')
+
+    def test_strips(self):
+        self.check(rows_per_strip=8)
+
+    def test_tiles(self):
+        self.check(tile_size=16)
+
+    def test_deflate(self):
+        self.check(compression=tiff.COMPRESSION_DEFLATE, rows_per_strip=5)
+
+    def test_deflate_predictor(self):
+        self.check(compression=tiff.COMPRESSION_DEFLATE,
+                predictor=tiff.PREDICTOR_HORIZONTAL, order='>')
+
+    def test_packbits(self):
+        self.check(compression=tiff.COMPRESSION_PACKBITS, rows_per_strip=3)
+
+    def test_lzw(self):
+        self.check(compression=tiff.COMPRESSION_LZW, tile_size=32)
+
+    def test_lzw_long(self):
+        # Long enough for the code width to reach 12 bits and the table to
+        # be cleared
+        self.data = np.random.RandomState(1).randint(0, 4, size=(200, 300)) \
+                .astype(np.int16)
+        self.check(compression=tiff.COMPRESSION_LZW,
+                predictor=tiff.PREDICTOR_HORIZONTAL)
+
+    @raises(ValueError)
+    def test_wrong_shape(self):
+        write_tiff(self.path, self.data)
+        tiff.decode_into(self.path, np.empty((53, 37), dtype=np.int16))
+
+    @raises(ValueError)
+    def test_not_tiff(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'GIF89a' + b'\0' * 100)
+        tiff.decode(self.path)
+
+    def test_decode_chunk(self):
+        target = os.path.join(self.tmp_dir, 'dataset')
+        with open(target, 'wb') as f:
+            f.truncate(3 * self.data.size * 2)
+
+        # Chunks may be written in any order, and via any means
+        write_tiff(self.path, self.data + 2, tile_size=16)
+        tiff.decode_chunk(self.path, target, 2, (53, 37))
+        write_tiff(self.path, self.data, rows_per_strip=4)
+        with open(target, 'r+b') as f:
+            tiff.decode_chunk(self.path, f, 0, (53, 37))
+
+        result = np.fromfile(target, dtype=np.int16).reshape(3, 37, 53)
+        self.assertTrue((result[0] == self.data).all())
+        self.assertTrue((result[1] == 0).all())
+        self.assertTrue((result[2] == self.data + 2).all())
+
+class TestMockChunks(TemporaryDirectoryTestCase):
+    def test_matches_mock_dataset(self):
+        expected = np.fromfile(MOCK_DATASET_PATH, dtype=np.int16) \
+                .reshape(24, 10, 20)
+
+        extract_mock_chunks(self.tmp_dir)
+        for i, chunk in enumerate('ABCDEFGHIJKLMNOPQRSTUVWX'):
+            path = os.path.join(self.tmp_dir, '15-{0}.tif'.format(chunk))
+            self.assertTrue((tiff.decode(path) == expected[i]).all())
+            self.assertEqual(tiff.raw_offset(path, (10, 20)) % 2, 0)
+
+    def test_raw_offset(self):
+        rng = np.random.RandomState(0)
+        data = rng.randint(-500, 9000, size=(10, 20)).astype(np.int16)
+        path = os.path.join(self.tmp_dir, 'chunk.tif')
+
+        write_tiff(path, data, rows_per_strip=3)
+        offset = tiff.raw_offset(path, (10, 20))
+        mapped = np.fromfile(path, dtype=np.int16, count=200,
+                offset=offset).reshape(10, 20)
+        self.assertTrue((mapped == data).all())
+
+        # Raw chunks are mapped from the start
+        data.tofile(path)
+        self.assertEqual(tiff.raw_offset(path, (10, 20)), 0)
+
+        write_tiff(path, data, compression=tiff.COMPRESSION_DEFLATE)
+        self.assertRaises(ValueError, tiff.raw_offset, path, (10, 20))
+        write_tiff(path, data, tile_size=16)
+        self.assertRaises(ValueError, tiff.raw_offset, path, (10, 20))
+        write_tiff(path, data)
+        self.assertRaises(ValueError, tiff.raw_offset, path, (20, 10))
@@ -0,0 +1,126 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for tiled datasets.
+
+"""
+import os
+from array import array
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import numpy as np
+from nose.tools import raises
+
+from ruaumoko import Dataset
+import ruaumoko.tiles as rt
+
+from .util import TemporaryDirectoryTestCase, MOCK_DATASET_PATH, MOCK_DATASET_TILE_SIZE
+
+class TestTiles(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestTiles, self).setUp()
+        self.raw = Dataset(MOCK_DATASET_PATH, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.path = os.path.join(self.tmp_dir, 'tiled')
+
+        lats = [lat * 0.5 for lat in range(-180, 181, 3)]
+        lngs = [lng * 0.5 for lng in range(0, 720, 7)]
+        self.lats = array('d', [lat for lat in lats for lng in lngs])
+        self.lngs = array('d', [lng for lat in lats for lng in lngs])
+
+    def check_same(self, ds, layout='tiled'):
+        self.assertEqual(ds.layout, layout)
+        self.assertEqual(ds.get_many(self.lats, self.lngs),
+                self.raw.get_many(self.lats, self.lngs))
+        self.assertEqual(ds.interpolate_many(self.lats, self.lngs, 'bicubic'),
+                self.raw.interpolate_many(self.lats, self.lngs, 'bicubic'))
+
+    def test_row_major(self):
+        # Tiles that don't divide the chunks exactly
+        rt.convert(MOCK_DATASET_PATH, self.path, MOCK_DATASET_TILE_SIZE, 3)
+        self.check_same(Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE))
+
+    def test_morton(self):
+        rt.convert(MOCK_DATASET_PATH, self.path, MOCK_DATASET_TILE_SIZE, 4, 'morton')
+        self.check_same(Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE))
+
+    def test_morton_order(self):
+        self.assertEqual(rt.tile_order(2, 3, 'morton'),
+                [(0, 0), (0, 1), (1, 0), (1, 1), (0, 2), (1, 2)])
+
+    @raises(ValueError)
+    def test_wrong_resolution(self):
+        rt.convert(MOCK_DATASET_PATH, self.path, MOCK_DATASET_TILE_SIZE, 4)
+        Dataset(self.path, expected_res=(40, 20))
+
+    def test_main(self):
+        argv = ['ruaumoko-convert', '--tile-shape', '20x10', '--tile-size', '8',
+                '--morton', MOCK_DATASET_PATH, self.path]
+        with patch('sys.argv', argv):
+            self.assertEqual(rt.main(), 0)
+        self.check_same(Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE))
+
+        argv[4] = '0'
+        with patch('sys.argv', argv):
+            self.assertEqual(rt.main(), 1)
+
+    def test_compressed(self):
+        rt.convert(MOCK_DATASET_PATH, self.path, MOCK_DATASET_TILE_SIZE, 4,
+                compress=6)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.check_same(ds, 'compressed')
+        stats = ds.cache_stats
+        self.assertGreater(stats['hits'], 0)
+        self.assertEqual(stats['tiles'], stats['misses'])
+
+    def test_compressed_eviction(self):
+        rt.convert(MOCK_DATASET_PATH, self.path, MOCK_DATASET_TILE_SIZE, 4,
+                compress=1)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE,
+                cache_tiles=2)
+        self.check_same(ds, 'compressed')
+        self.assertEqual(ds.cache_stats['tiles'], 2)
+        self.assertGreater(ds.cache_stats['misses'], 2)
+
+    def test_constant_tiles(self):
+        source = os.path.join(self.tmp_dir, 'source')
+        data = np.zeros((4, 6, 10, 20), dtype=np.int16)
+        data[1, 2, 4:6, 5:7] = 1234
+        data.tofile(source)
+
+        rt.convert(source, self.path, MOCK_DATASET_TILE_SIZE, 4, compress=6)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        raw = Dataset(source, expected_res=MOCK_DATASET_TILE_SIZE)
+        self.assertEqual(ds.get_many(self.lats, self.lngs),
+                raw.get_many(self.lats, self.lngs))
+        # Only the single tile that isn't constant is stored and cached
+        self.assertEqual(ds.cache_stats['tiles'], 1)
+        self.assertLess(os.path.getsize(self.path), os.path.getsize(source))
+
+    @raises(IOError)
+    def test_corrupt_tile(self):
+        rt.convert(MOCK_DATASET_PATH, self.path, MOCK_DATASET_TILE_SIZE, 4,
+                compress=6)
+        with open(self.path, 'r+b') as f:
+            f.seek(-16, os.SEEK_END)
+            f.write(b'\0' * 16)
+        ds = Dataset(self.path, expected_res=MOCK_DATASET_TILE_SIZE)
+        ds.get_many(self.lats, self.lngs)
@@ -0,0 +1,184 @@
+# Copyright 2014 (C) Priyesh Patel, Daniel Richman
+#
+# This file is part of Ruaumoko.
+# https://github.com/cuspaceflight/ruaumoko
+#
+# Ruaumoko is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ruaumoko is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ruaumoko. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for dataset verification.
+
+"""
+import json
+import os
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import numpy as np
+
+from ruaumoko.dataset import chunk_names
+import ruaumoko.tiles as rt
+import ruaumoko.verify as rv
+
+from .util import (TemporaryDirectoryTestCase, MOCK_DATASET_PATH,
+        MOCK_DATASET_TILE_SIZE)
+
+def consistent_dataset():
+    """A dataset whose chunks agree where they overlap, cut from one grid
+    of the whole world."""
+    width, height = MOCK_DATASET_TILE_SIZE
+    rng = np.random.RandomState(0)
+    world = rng.randint(0, 1000, size=(4 * (height - 1) + 1,
+                                       6 * (width - 1))).astype(np.int16)
+    data = np.empty((4, 6, height, width), dtype=np.int16)
+    for r in range(4):
+        for c in range(6):
+            cols = np.arange(c * (width - 1), (c + 1) * (width - 1) + 1)
+            data[r, c] = world[r * (height - 1):(r + 1) * (height - 1) + 1,
+                               cols % world.shape[1]]
+    return data
+
+class TestVerify(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(TestVerify, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'dataset')
+        self.data = consistent_dataset()
+        self.data.tofile(self.path)
+
+    def verify(self, path=None, **kwargs):
+        return rv.verify(path or self.path, MOCK_DATASET_TILE_SIZE, jobs=2,
+                **kwargs)
+
+    def test_consistent(self):
+        report = self.verify()
+        self.assertTrue(report['ok'])
+        # 18 north-south seams, and 24 east-west ones including those at 180
+        self.assertEqual(len(report['seams']), 42)
+        self.assertFalse(any(seam['mismatched'] for seam in report['seams']))
+        self.assertEqual(report['suspicious'], [])
+        json.dumps(report)
+
+    def test_statistics(self):
+        data = np.fromfile(MOCK_DATASET_PATH, dtype=np.int16).reshape(24, -1)
+        report = self.verify(MOCK_DATASET_PATH, bin_size=100)
+        for entry, chunk in zip(report['chunks'], data):
+            self.assertEqual(entry['min'], chunk.min())
+            self.assertEqual(entry['max'], chunk.max())
+            self.assertAlmostEqual(entry['mean'], chunk.mean())
+            self.assertEqual(sum(count for _, count in entry['histogram']),
+                    chunk.size)
+            for low, count in entry['histogram']:
+                self.assertEqual(count, np.count_nonzero(
+                    (chunk >= low) & (chunk < low + 100)))
+        self.assertEqual(report['summary']['cells'], data.size)
+        self.assertEqual(report['summary']['min'], data.min())
+
+    def test_seam_mismatch(self):
+        # The last row of chunk (1, 2) is the first of chunk (2, 2)
+        self.data[1, 2, -1, 7] += 5
+        self.data.tofile(self.path)
+
+        report = self.verify()
+        self.assertFalse(report['ok'])
+        bad = [seam for seam in report['seams'] if seam['mismatched']]
+        self.assertEqual(bad, [{'chunks': ['I', 'O'], 'kind': 'row',
+                                'mismatched': 1, 'largest': 5}])
+        self.assertTrue(self.verify(tolerance=5)['ok'])
+
+    def test_wrapping_seam(self):
+        self.data[3, 0, 4, 0] -= 1
+        self.data.tofile(self.path)
+        bad = [seam['chunks'] for seam in self.verify()['seams']
+               if seam['mismatched']]
+        self.assertEqual(bad, [['X', 'S']])
+
+    def test_suspicious(self):
+        self.data[0, 1, 3, 4] = rv.VOID
+        self.data[2, 3, 5, 6] = 9500
+        self.data.tofile(self.path)
+
+        report = self.verify()
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['chunks'][1]['void'], 1)
+        self.assertEqual(report['chunks'][15]['implausible'], 1)
+        self.assertEqual(report['summary']['void'], 1)
+        self.assertEqual(report['summary']['implausible'], 1)
+        # Voids are left out of the statistics
+        self.assertEqual(report['chunks'][1]['min'],
+                self.data[0, 1][self.data[0, 1] != rv.VOID].min())
+
+        cells = dict((cell['kind'], cell) for cell in report['suspicious'])
+        self.assertEqual(set(cells), set(['void', 'implausible', 'spike']))
+        implausible = cells['implausible']
+        self.assertEqual((implausible['chunk'], implausible['row'],
+                          implausible['col'], implausible['value']),
+                         ('P', 5, 6, 9500))
+        self.assertAlmostEqual(implausible['lat'], 90 - 45 * (2 + 5 / 9.0))
+        self.assertAlmostEqual(implausible['lng'],
+                               (60 * (3 + 6 / 19.0) + 180) % 360)
+
+    def test_spikes(self):
+        self.data[1, 4, 6, 10] = 4000
+        self.data.tofile(self.path)
+
+        report = self.verify()
+        # Spikes are only flagged
+        self.assertTrue(report['ok'])
+        self.assertEqual(report['chunks'][10]['spikes'], 1)
+        self.assertEqual(report['summary']['spikes'], 1)
+        self.assertEqual([(cell['chunk'], cell['row'], cell['col'])
+                          for cell in report['suspicious']], [('K', 6, 10)])
+        self.assertEqual(self.verify(spike=5000)['summary']['spikes'], 0)
+
+    def test_bands(self):
+        # Spikes next to the boundaries between bands are found once each
+        for row in (1, 2, 3, 8):
+            self.data[0, 0, row, 2 * row] = 3000
+        self.data.tofile(self.path)
+
+        expected = rv.check_chunk(self.path, MOCK_DATASET_TILE_SIZE, 0, 0)
+        with patch.object(rv, 'BAND_ROWS', 3):
+            result = rv.check_chunk(self.path, MOCK_DATASET_TILE_SIZE, 0, 0)
+        self.assertEqual(result['spikes'], 4)
+        self.assertEqual(result['examples'], expected['examples'])
+        self.assertTrue((result['counts'] == expected['counts']).all())
+
+    def test_layouts(self):
+        expected = self.verify()
+
+        tiled = os.path.join(self.tmp_dir, 'tiled')
+        rt.convert(self.path, tiled, MOCK_DATASET_TILE_SIZE, 4, compress=6)
+        self.assertEqual(self.verify(tiled)['chunks'], expected['chunks'])
+
+        split = os.path.join(self.tmp_dir, 'split')
+        os.mkdir(split)
+        for name, chunk in zip(chunk_names, self.data.reshape(24, 10, 20)):
+            chunk.tofile(os.path.join(split, '15-{0}.tif'.format(name)))
+        self.assertEqual(self.verify(split)['seams'], expected['seams'])
+
+        os.remove(os.path.join(split, '15-H.tif'))
+        report = self.verify(split)
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['missing'], ['H'])
+        self.assertEqual(len(report['seams']), 42 - 4)
+
+    def test_format_report(self):
+        self.data[1, 2, -1, 7] += 5
+        self.data.tofile(self.path)
+        text = rv.format_report(self.verify())
+        self.assertIn('41 of 42 seams match', text)
+        self.assertIn('I/O: 1 cells of the shared row differ', text)
+        self.assertTrue(text.endswith('PROBLEMS FOUND'))
@@ -1,3 +1,4 @@
+import io
 import logging
 from tempfile import mkdtemp
 import os
@@ -45,3 +46,12 @@ def responses_add_dem_mocks(host='www.viewfinderpanoramas.org', path='DEM/TIF15'
                 body=mock_zip.open(info).read(),
                 content_type='application/zip')
 
+
+def extract_mock_chunks(directory):
+    """Extract the TIFF of each mock DEM chunk into directory.
+
+    """
+    with zipfile.ZipFile(os.path.join(DATA_DIR, 'dem-chunks.zip')) as mock_zip:
+        for info in mock_zip.infolist():
+            with zipfile.ZipFile(io.BytesIO(mock_zip.read(info))) as pack:
+                pack.extractall(directory)